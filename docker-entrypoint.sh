@@ -284,10 +284,19 @@ if [ "$1" = 'runtests' ]; then
 	exec django-admin.py test --noinput -v 3 "$single_test"
 
     else
-	exec django-admin.py test --noinput -v 3 dashboards rdrf
+	exec django-admin.py test --noinput -v 3 --exclude-tag benchmark dashboards rdrf
     fi
 fi
 
+# runbenchmarks entrypoint, the tests left out of runtests as they take long
+if [ "$1" = 'runbenchmarks' ]; then
+    info "[Run] Starting benchmarks"
+    export DJANGO_SETTINGS_MODULE="${DJANGO_SETTINGS_MODULE}"_test
+
+    set -x
+    exec django-admin.py test --noinput -v 3 --tag benchmark dashboards rdrf
+fi
+
 # aloe entrypoint
 if [ "$1" = 'aloe' ]; then
     info "[Run] Starting aloe"
@@ -301,7 +310,7 @@ if [ "$1" = "management-command" ]; then
     exec $command_line
 fi
 
-warn "[RUN]: Builtin command not provided [tarball|aloe|runtests|runserver|runserver_plus|uwsgi|uwsgi_local]"
+warn "[RUN]: Builtin command not provided [tarball|aloe|runtests|runbenchmarks|runserver|runserver_plus|uwsgi|uwsgi_local]"
 info "[RUN]: $*"
 
 set -x
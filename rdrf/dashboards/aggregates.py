@@ -0,0 +1,135 @@
+"""
+Cohort statistics of the all patients base data.
+
+They are computed by generate_visualisation_dataframe when the base data is
+generated and stored with it, so the all patients components and the
+cohort comparisons on the single patient dashboard read them instead of
+aggregating the whole frame every time a tab renders.
+"""
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SEQ = "SEQ"
+cdf = "COLLECTIONDATE"
+
+
+def seq_value_counts(df: pd.DataFrame, field) -> pd.DataFrame:
+    """
+    The number of rows with each value of field in each SEQ, as columns
+    SEQ, value and count ( rows without a value aren't counted )
+    """
+    counts = df[[SEQ, field]].value_counts().reset_index()
+    return counts.rename(columns={field: "value", 0: "count"})
+
+
+def last_collection_dates(df: pd.DataFrame, until) -> np.ndarray:
+    # the latest collection date of each patient up to until, sorted
+    collected = df.loc[df[cdf] <= until]
+    return np.sort(collected.groupby("PID")[cdf].max().to_numpy())
+
+
+def form_collection_dates(df: pd.DataFrame, until) -> dict:
+    # FORM -> the collection dates of its rows up to until, sorted
+    collected = df.loc[df[cdf] <= until, ["FORM", cdf]]
+    return {form: np.sort(dates.to_numpy()) for form, dates in collected.groupby("FORM")[cdf]}
+
+
+class CohortAggregates:
+    # aggregates stored before form dates were added have none
+    form_dates = None
+
+    def __init__(self, generated, value_counts, last_dates, scale_group_scores, form_dates=None):
+        self.generated = generated
+        # field -> seq_value_counts of the field
+        self.value_counts = value_counts
+        self.last_dates = last_dates
+        # id of an sgc visualisation config ->
+        # {"groups": its groups, "averages": .., "counts": .. } per SEQ
+        self.scale_group_scores = scale_group_scores
+        self.form_dates = form_dates
+
+    @classmethod
+    def compute(cls, config_model, df: pd.DataFrame):
+        generated = datetime.now()
+        value_counts = {
+            field: seq_value_counts(df, field)
+            for field in config_model.config["fields"]
+            if field in df
+        }
+        return cls(
+            generated,
+            value_counts,
+            last_collection_dates(df, generated),
+            cls._compute_scale_group_scores(config_model, df),
+            form_collection_dates(df, generated),
+        )
+
+    @staticmethod
+    def _compute_scale_group_scores(config_model, df):
+        from dashboards.components.sgc import ScaleGroupComparison
+        from dashboards.models import VisualisationConfig
+
+        scores = {}
+        for vis_config in VisualisationConfig.objects.filter(
+            registry=config_model.registry, code="sgc"
+        ):
+            try:
+                sgc = ScaleGroupComparison(vis_config.title, vis_config, df)
+                averages, counts = sgc.cohort_scores(df)
+            except Exception as ex:
+                logger.error(f"could not aggregate scores of {vis_config.title}: {ex}")
+                continue
+            scores[vis_config.id] = {
+                "groups": vis_config.config["groups"],
+                "averages": averages,
+                "counts": counts,
+            }
+        return scores
+
+    def get_value_counts(self, field):
+        counts = self.value_counts.get(field)
+        return None if counts is None else counts.copy()
+
+    def num_patients_since(self, start_date=None):
+        """
+        The number of patients with a collection date from start_date on
+        ( up to when the aggregates were generated )
+        """
+        if start_date is None:
+            return len(self.last_dates)
+        start = np.datetime64(pd.Timestamp(start_date))
+        return len(self.last_dates) - np.searchsorted(self.last_dates, start, side="left")
+
+    def form_counts_since(self, start_date=None):
+        """
+        The number of rows of each form with a collection date from
+        start_date on, as columns FORM and COUNT, or None if the
+        aggregates have no form dates
+        """
+        if self.form_dates is None:
+            return None
+        start = None if start_date is None else np.datetime64(pd.Timestamp(start_date))
+        counts = pd.DataFrame(
+            [
+                (form, len(dates) - (0 if start is None else np.searchsorted(dates, start, side="left")))
+                for form, dates in self.form_dates.items()
+            ],
+            columns=["FORM", "COUNT"],
+        )
+        counts = counts[counts["COUNT"] > 0]
+        return counts.sort_values("COUNT", ascending=False, kind="stable", ignore_index=True)
+
+    def get_scale_group_scores(self, vis_config):
+        """
+        (average scores, score counts) per SEQ for the groups of an sgc
+        visualisation, if they are as configured when generated
+        """
+        scores = self.scale_group_scores.get(vis_config.id)
+        if scores is None or scores["groups"] != vis_config.config["groups"]:
+            return None
+        return scores["averages"].copy(), scores["counts"].copy()
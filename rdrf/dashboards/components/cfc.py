@@ -26,7 +26,7 @@ class CombinedFieldComparison(BaseGraphic):
 
         combined_name = "/".join(labels)
         colour_map = self.config.get("colour_map", get_sevenscale_colour_map())
-        data = self._get_combined_data(self.data, inputs)
+        data = self._get_combined_data(inputs)
         data = add_seq_name(data)
         data = data.round(1)
         data = self._replace_blanks(data)
@@ -131,7 +131,7 @@ class CombinedFieldComparison(BaseGraphic):
         ht = ht.replace("Percentage=%{y}<br>", "")
         return ht
 
-    def _get_combined_data(self, df: pd.DataFrame, inputs) -> pd.DataFrame:
+    def _get_combined_data(self, inputs) -> pd.DataFrame:
         """
         This is turned out to be hard:)
         Basically we're looking at both Health Status and Quality of life
@@ -169,8 +169,8 @@ class CombinedFieldComparison(BaseGraphic):
         df_counts = []
         num_inputs = len(inputs)
         for index, input in enumerate(inputs):
-            input_df = df[[SEQ, input]].value_counts().reset_index()
-            input_df = input_df.rename(columns={input: "value", 0: f"count_{index}"})
+            input_df = self.get_value_counts(input)
+            input_df = input_df.rename(columns={"count": f"count_{index}"})
 
             df_counts.append(input_df)
 
@@ -2,6 +2,8 @@ from dash import dcc, html
 import dash_bootstrap_components as dbc
 import pandas as pd
 
+from ..aggregates import seq_value_counts
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,6 +37,7 @@ class BaseGraphic:
         patient=None,
         all_patients_data=None,
         static_followups={},
+        cohort=None,
     ):
         self.config_model = config_model
         if self.config_model is not None:
@@ -48,11 +51,21 @@ class BaseGraphic:
         self.patient = patient  # none if all patients
         self.all_patients_data = all_patients_data  # this gets provided for some single patient components which need to compare
         self.static_followups = static_followups
+        # precomputed all patients statistics ( see dashboards.aggregates )
+        self.cohort = cohort
 
     @property
     def needs_global_data(self):
         return False
 
+    def get_value_counts(self, field):
+        # seq_value_counts of the data, precomputed for all patients
+        if self.cohort is not None:
+            counts = self.cohort.get_value_counts(field)
+            if counts is not None:
+                return counts
+        return seq_value_counts(self.data, field)
+
     @property
     def graphic(self):
         return self.get_graphic()
@@ -68,10 +68,11 @@ class ChangesInPatientResponses(BaseGraphic):
         return html.Div(cpr_div, id="cpr")
 
     def _get_percentages_over_followups(self, field, label) -> pd.DataFrame:
-        pof = self.data.groupby([SEQ, field]).agg({field: "count"})
-        pof["Percentage"] = 100 * pof[field] / pof.groupby(SEQ)[field].transform("sum")
-        pof = pof.rename(columns={field: "counts"}).reset_index()
-        pof[label] = pof[field].apply(lambda value: lookup_cde_value(field, value))
+        pof = self.get_value_counts(field).rename(columns={"value": field, "count": "counts"})
+        pof = pof.sort_values([SEQ, field], ignore_index=True)
+        pof["Percentage"] = 100 * pof["counts"] / pof.groupby(SEQ)["counts"].transform("sum")
+        labels = {value: lookup_cde_value(field, value) for value in pof[field].unique()}
+        pof[label] = pof[field].map(labels)
 
         return pof
 
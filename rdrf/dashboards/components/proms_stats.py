@@ -91,17 +91,38 @@ class PatientsWhoCompletedForms(BaseGraphic):
 
     def _get_pie_chart(self, time_period):
         start_date, end_date = self._get_start_end(time_period)
-        df = self.data
-        filtered_df = df[(df[cdf] >= start_date) & (df[cdf] <= end_date)]
+        form_counts = None
+        if self.cohort is not None:
+            form_counts = self.cohort.form_counts_since(None if time_period == "all" else start_date)
+        if form_counts is None:
+            df = self.data
+            form_counts = (
+                df.loc[(df[cdf] >= start_date) & (df[cdf] <= end_date), "FORM"]
+                .value_counts()
+                .rename_axis("FORM")
+                .reset_index(name="COUNT")
+            )
 
-        filtered_df["FORM"] = filtered_df["FORM"].map(get_form_display_name)
+        # forms are counted under their display names
+        display_names = {form_name: get_form_display_name(form_name) for form_name in form_counts["FORM"]}
+        form_counts = (
+            form_counts.assign(FORM=form_counts["FORM"].map(display_names))
+            .groupby("FORM", sort=False, as_index=False)["COUNT"]
+            .sum()
+        )
 
-        tof_graphic = TypesOfFormCompleted("", None, filtered_df).graphic
+        tof_graphic = TypesOfFormCompleted("", None, None, form_counts=form_counts).graphic
 
         return tof_graphic
 
     def _get_num_patients(self, time_period) -> int:
         log(f"getting number of patients for timeperiod {time_period}")
+        if self.cohort is not None:
+            if time_period == "all":
+                return self.cohort.num_patients_since()
+            start_date, _ = self._get_start_end(time_period)
+            return self.cohort.num_patients_since(start_date)
+
         df = self.data
         cdf = "COLLECTIONDATE"
         pid = "PID"
@@ -123,11 +144,12 @@ class PatientsWhoCompletedForms(BaseGraphic):
         links = []
         df = self.data
         df = df[(df[cdf] >= start_date) & (df[cdf] <= end_date)]
+        patients = Patient.objects.in_bulk([int(pid) for pid in df["PID"].unique()])
 
         for index, row in df.iterrows():
             try:
                 pid = row["PID"]
-                patient = Patient.objects.get(id=pid)
+                patient = patients[int(pid)]
                 context_id = row["CONTEXT_ID"]
                 collection_date = row["COLLECTIONDATE"].date()
                 form_name = row["FORM"]
@@ -3,17 +3,18 @@ import plotly.express as px
 from dash import dcc, html
 from rdrf.models.definition.models import CommonDataElement
 from ..components.common import BaseGraphic
-from ..utils import get_range, get_base
+from ..utils import get_numeric_values
 from ..utils import sanity_check
 from ..data import combine_data
 from ..data import has_static_followups
 from ..data import get_static_followups_handler
 
-from ..score_functions import sgc_functional_score
-from ..score_functions import sgc_symptom_score
-from ..score_functions import sgc_hsqol_score
+from ..score_functions import sgc_functional_scores
+from ..score_functions import sgc_symptom_scores
+from ..score_functions import sgc_hsqol_scores
 
 import numpy as np
+import pandas as pd
 
 
 logger = logging.getLogger(__name__)
@@ -33,11 +34,12 @@ class AllPatientsScoreHelper:
         self.fields = fields
         self.score_function = score_function
 
+    @property
+    def score_group(self):
+        return self.score_name, self.fields, self.score_function
+
     def calculate_score(self, data):
-        data = self.sgc.calculate_scores(
-            self.score_name, self.fields, self.score_function, data
-        )
-        return data
+        return self.sgc.calculate_all_scores(data, [self.score_group])
 
 
 class ScaleGroupComparison(BaseGraphic):
@@ -51,51 +53,37 @@ class ScaleGroupComparison(BaseGraphic):
             data = sfu_handler.fix_ordering_of_static_followups(data)
 
         sanity_check("in get_graphic", data)
-        scores_map = {}
-        self.group_info = {}
-        self.rev_group = {}
-        self.all_patients_helpers = []
         self.average_scores = None
-        group_scales = set([])
 
         blurb = self.config.get("blurb", "")
 
-        for index, group in enumerate(self.config["groups"]):
-            group_title = group["title"]
-            group_fields = group["fields"]
-            if len(group_fields) == 0:
-                continue
-
-            group_range = self.get_range_value(group_fields)
-            group_scale = group["scale"]
-            group_scales.add(group_scale)
-            group_score_function = self.get_score_function(group_range, group_scale)
-            score_name = f"score_{index}"
-            self.group_info[score_name] = group_title
-            self.rev_group[group_title] = score_name
-            data = self.calculate_scores(
-                score_name, group_fields, group_score_function, data
-            )
+        score_groups, scores_map, group_scales = self.get_score_groups()
+        score_names = list(scores_map.keys())
 
-            scores_map[score_name] = group_title  # track so we can plot/annotate
-            compare_all = group.get("compare_all", False)
-            if compare_all:
-                helper = AllPatientsScoreHelper(
-                    self, score_name, group_title, group_fields, group_score_function
-                )
-                self.all_patients_helpers.append(helper)
+        # the averages and counts of all the groups' scores over all patients
+        cohort_scores = None
+        if self.cohort is not None:
+            cohort_scores = self.cohort.get_scale_group_scores(self.config_model)
 
-        score_names = list(scores_map.keys())
+        if self.mode != "all" or cohort_scores is None:
+            data = self.calculate_all_scores(data, score_groups)
 
-        if self.all_patients_helpers:
+        if self.all_patients_helpers and cohort_scores is not None:
+            all_patients_score_names = [h.score_name for h in self.all_patients_helpers]
+            average_scores, count_scores = (
+                scores[[SEQ] + all_patients_score_names] for scores in cohort_scores
+            )
+        elif self.all_patients_helpers:
             # if we do need to compare to the average scores
             # with all the patients, we need to append columns
             # to the dataframe showing the average scores
             if self.all_patients_data is None:
                 self.load_all_patients_data()
 
-            for helper in self.all_patients_helpers:
-                self.all_patients_data = helper.calculate_score(self.all_patients_data)
+            self.all_patients_data = self.calculate_all_scores(
+                self.all_patients_data,
+                [helper.score_group for helper in self.all_patients_helpers],
+            )
 
             # now work out the average per SEQ
             all_patients_score_names = [h.score_name for h in self.all_patients_helpers]
@@ -113,8 +101,11 @@ class ScaleGroupComparison(BaseGraphic):
             count_scores = None
 
         if self.mode == "all":
-            # not sure if this is actually required
-            data = self.calculate_average_scores_over_time(data, score_names)
+            if cohort_scores is not None:
+                data = cohort_scores[0][[SEQ] + score_names]
+            else:
+                # not sure if this is actually required
+                data = self.calculate_average_scores_over_time(data, score_names)
             chart_title = "Scale group score over time for all patients"
             sgc_id = "sgc"
         else:
@@ -164,6 +155,60 @@ class ScaleGroupComparison(BaseGraphic):
 
         return html.Div(div, id=sgc_id)
 
+    def get_score_groups(self):
+        """
+        (score name, fields, score function) of each group, the names of
+        the scores and the scales of the groups
+        """
+        scores_map = {}
+        self.group_info = {}
+        self.rev_group = {}
+        self.all_patients_helpers = []
+        group_scales = set([])
+
+        self.load_cde_models(
+            [field for group in self.config["groups"] for field in group["fields"]]
+        )
+        score_groups = []
+
+        for index, group in enumerate(self.config["groups"]):
+            group_title = group["title"]
+            group_fields = group["fields"]
+            if len(group_fields) == 0:
+                continue
+
+            group_range = self.get_range_value(group_fields)
+            group_scale = group["scale"]
+            group_scales.add(group_scale)
+            group_score_function = self.get_score_function(group_range, group_scale)
+            score_name = f"score_{index}"
+            self.group_info[score_name] = group_title
+            self.rev_group[group_title] = score_name
+            score_groups.append((score_name, group_fields, group_score_function))
+
+            scores_map[score_name] = group_title  # track so we can plot/annotate
+            compare_all = group.get("compare_all", False)
+            if compare_all:
+                helper = AllPatientsScoreHelper(
+                    self, score_name, group_title, group_fields, group_score_function
+                )
+                self.all_patients_helpers.append(helper)
+
+        return score_groups, scores_map, group_scales
+
+    def cohort_scores(self, data):
+        """
+        The average scores and score counts per SEQ of every group over
+        data, all patients' data ( see dashboards.aggregates )
+        """
+        score_groups, scores_map, _ = self.get_score_groups()
+        score_names = list(scores_map.keys())
+        data = self.calculate_all_scores(data, score_groups)
+        return (
+            self.calculate_average_scores_over_time(data, score_names),
+            self.calculate_score_counts_over_time(data, score_names),
+        )
+
     def _get_notes(self):
         if self._is_missing_baseline():
             return " Note: Patient is missing a Baseline Form"
@@ -429,8 +474,55 @@ class ScaleGroupComparison(BaseGraphic):
     def get_scale(self):
         return self.config.get("scale", None)
 
-    def calculate_scores(self, score_name, fields, score_function, data):
-        detected_bases = set([get_base(field) for field in fields])
+    def load_cde_models(self, fields):
+        self.cde_models = {
+            cde_model.code: cde_model
+            for cde_model in CommonDataElement.objects.filter(
+                code__in=set(fields)
+            )
+        }
+        # the numeric codes of each field's permitted values, from the
+        # permitted value indexes
+        self.numeric_values = {
+            code: get_numeric_values(cde_model)
+            for code, cde_model in self.cde_models.items()
+        }
+
+    def get_cde_model(self, field):
+        if field not in self.cde_models:
+            raise ScaleGroupError(f"{field} is not CDE")
+        return self.cde_models[field]
+
+    def get_numeric_values(self, field):
+        self.get_cde_model(field)
+        return self.numeric_values[field]
+
+    def get_base(self, field):
+        # i.e min value of the range
+        values = self.get_numeric_values(field)
+        if values is None:
+            raise ValueError("not a numeric range")
+        return min(values)
+
+    def calculate_all_scores(self, data, score_groups):
+        """
+        Adds a column of scores to data for each (score name, fields, score
+        function) in score_groups. The fields are converted to numbers once
+        and each score is computed over all the rows at once.
+        """
+        fields = list(dict.fromkeys(f for _, group_fields, _ in score_groups for f in group_fields))
+        values = pd.DataFrame(
+            {field: pd.to_numeric(data[field].replace("", np.nan)) for field in fields},
+            index=data.index,
+        )
+        scores = {
+            score_name: self.calculate_scores(values, group_fields, score_function)
+            for score_name, group_fields, score_function in score_groups
+        }
+        return data.assign(**scores)
+
+    def calculate_scores(self, values, fields, score_function):
+        detected_bases = set([self.get_base(field) for field in fields])
         half_fields = float(len(fields)) / 2.0
         if len(detected_bases) > 1:
             raise Exception(f"different bases for fields {fields}: {detected_bases}")
@@ -444,48 +536,32 @@ class ScaleGroupComparison(BaseGraphic):
         else:
             raise Exception(f"base of fields {fields} is {detected_base}")
 
-        def filled(value):
-            # non vectorised
-            return value not in [None, ""]
-
-        def rs(row):
-            # non vectorised
-            values = [
-                float(row[field]) + delta for field in fields if filled(row[field])
-            ]
-            n = len(values)
-
-            if n < half_fields:
-                # not enough data for score calc
-                return None
-            else:
-                avg = sum(values) / len(values)
-
-            return avg
-
-        data[score_name] = data.apply(lambda row: score_function(rs(row)), axis=1)
+        group_values = values[fields] + delta
+        # not enough data for score calc if fewer than half the fields are filled
+        enough = group_values.notna().sum(axis=1) >= half_fields
+        raw_scores = group_values.mean(axis=1).where(enough)
 
-        return data
+        return score_function(raw_scores)
 
     def get_score_function(self, range_value, scale):
         if scale == "functional":
 
             def func(rs):
-                return sgc_functional_score(rs, range_value)
+                return sgc_functional_scores(rs, range_value)
 
             return func
 
         elif scale == "symptom":
 
             def func(rs):
-                return sgc_symptom_score(rs, range_value)
+                return sgc_symptom_scores(rs, range_value)
 
             return func
 
         elif scale == "hs/qol":
 
             def func(rs):
-                return sgc_hsqol_score(rs, range_value)
+                return sgc_hsqol_scores(rs, range_value)
 
             return func
         else:
@@ -494,17 +570,13 @@ class ScaleGroupComparison(BaseGraphic):
     def get_range_value(self, fields):
         ranges = set([])
         for field in fields:
-            try:
-                cde_model = CommonDataElement.objects.get(code=field)
-            except CommonDataElement.DoesNotExist:
-                raise ScaleGroupError(f"{field} is not CDE")
-            range_value = get_range(cde_model)
+            values = self.get_numeric_values(field)
 
-            if range_value is None:
+            if values is None:
                 # not an integer range
                 raise ScaleGroupError(f"field {field} not an integer range")
             else:
-                ranges.add(range_value)
+                ranges.add(max(values) - min(values))
 
         if not len(ranges) == 1:
             raise ScaleGroupError(
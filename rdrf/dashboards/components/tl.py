@@ -4,6 +4,7 @@ from ..components.common import BaseGraphic
 import dash_bootstrap_components as dbc
 import pandas as pd
 from rdrf.helpers.utils import get_display_value
+from rdrf.helpers.utils import get_display_values
 
 from ..data import has_static_followups
 from ..data import get_static_followups_handler
@@ -279,7 +280,7 @@ class TrafficLights(BaseGraphic):
 
         for field in cdes:
             display_field = field + "_display"
-            df[display_field] = df[field].map(lambda v: get_display_value(field, v))
+            df[display_field] = get_display_values(field, df[field])
 
         if has_static_followups(self.registry):
             sfuh = get_static_followups_handler(self.registry)
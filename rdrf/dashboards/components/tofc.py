@@ -6,6 +6,11 @@ title = "Types of Form Completed"
 
 
 class TypesOfFormCompleted(BaseGraphic):
+    def __init__(self, *args, form_counts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # FORM and COUNT columns, when the forms have been counted already
+        self.form_counts = form_counts
+
     def bar(self):
         return px.bar(
             self.data,
@@ -30,12 +35,13 @@ class TypesOfFormCompleted(BaseGraphic):
         return "tofc"
 
     def get_graphic(self):
-        self.form_counts = (
-            self.data["FORM"]
-            .value_counts()
-            .rename_axis("FORM")
-            .reset_index(name="COUNT")
-        )
+        if self.form_counts is None:
+            self.form_counts = (
+                self.data["FORM"]
+                .value_counts()
+                .rename_axis("FORM")
+                .reset_index(name="COUNT")
+            )
 
         fig = self.pie()
         div = html.Div([dcc.Graph(figure=fig)], id=self.id)
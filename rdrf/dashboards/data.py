@@ -1,5 +1,14 @@
 from typing import List
+from itertools import groupby
+from operator import attrgetter
+import glob
+import os
+import pickle
+import stat
+import tempfile
 import pandas as pd
+from django.conf import settings
+from django.db.models import Count, Max, Sum
 from rdrf.models.definition.models import ClinicalData
 from rdrf.models.definition.models import RDRFContext
 from rdrf.models.definition.models import CommonDataElement
@@ -7,10 +16,10 @@ from rdrf.models.definition.models import RegistryForm
 
 from registry.patients.models import Patient
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from .models import VisualisationBaseDataConfig
-from .utils import get_seq_name
+from .utils import assign_seq_names
 
 
 import logging
@@ -35,6 +44,135 @@ pid = "PID"  # patient id
 SEQ = "SEQ"
 con = "CON"  # context id
 
+# patients whose data is extracted together
+PATIENT_BATCH_SIZE = 500
+
+# clinical data saved this long before the last run is read again, as a
+# record's updated time is set before its transaction commits
+CHANGED_SINCE_OVERLAP = timedelta(minutes=10)
+
+# the generated base data of each config, as (version, dataframe), so a
+# worker only reads it again when the data is regenerated
+_base_data = {}
+# and its cohort aggregates ( see dashboards.aggregates )
+_cohort_aggregates = {}
+
+
+def base_data_version(config_model):
+    # the config is saved whenever its data is regenerated
+    return config_model.updated.strftime("%Y%m%d%H%M%S%f")
+
+
+def base_data_path(config_model, version, kind="data"):
+    return os.path.join(
+        settings.VISUALISATION_BASE_DATA_DIRECTORY,
+        f"{config_model.pk}_{version}.{kind}.pkl",
+    )
+
+
+def _owned_privately(path, is_dir):
+    """
+    Whether path is ours and nobody else can write to it, as the stored
+    files are unpickled and so must not be planted by another user
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    kind_ok = stat.S_ISDIR(st.st_mode) if is_dir else stat.S_ISREG(st.st_mode)
+    if not kind_ok or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        logger.error(f"ignoring visualisation base data {path}: not owned privately")
+        return False
+    return True
+
+
+def _private_directory():
+    # the cache directory, created 0700, or None if it can't be trusted
+    directory = settings.VISUALISATION_BASE_DATA_DIRECTORY
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError as ex:
+        logger.warning(f"could not create visualisation base data directory {directory}: {ex}")
+        return None
+    return directory if _owned_privately(directory, is_dir=True) else None
+
+
+def _read(path):
+    # the stored value at path, or None if it isn't there or can't be trusted
+    directory = os.path.dirname(path)
+    if not (_owned_privately(directory, is_dir=True) and _owned_privately(path, is_dir=False)):
+        return None
+    return pd.read_pickle(path)
+
+
+def _store(config_model, kind, value):
+    # earlier versions are removed
+    directory = _private_directory()
+    if directory is None:
+        return
+    path = base_data_path(config_model, base_data_version(config_model), kind)
+    try:
+        # mkstemp creates the file 0600
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as ex:
+        logger.warning(f"could not store visualisation base data {path}: {ex}")
+        return
+    for old_path in glob.glob(base_data_path(config_model, "*", kind)):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def save_base_data(config_model, df: pd.DataFrame):
+    """
+    Stores the ordered and sequenced base data of a config as a pickled
+    dataframe, which keeps the column types and loads without parsing.
+    """
+    _store(config_model, "data", df)
+
+
+def save_cohort_aggregates(config_model, aggregates):
+    _store(config_model, "aggregates", aggregates)
+
+
+def load_cohort_aggregates(config_model):
+    """
+    The cohort aggregates stored with the current version of the base
+    data, or None if they haven't been generated.
+    """
+    version = base_data_version(config_model)
+    cached = _cohort_aggregates.get(config_model.pk)
+    if cached is None or cached[0] != version:
+        aggregates = _read(base_data_path(config_model, version, "aggregates"))
+        if aggregates is None:
+            return None
+        cached = _cohort_aggregates[config_model.pk] = (version, aggregates)
+    return cached[1]
+
+
+def load_base_data(config_model, build):
+    """
+    The base data of a config, read once per worker for each version. If it
+    hasn't been stored for the current version, build() provides it and it
+    is stored. Returns a copy as the visualisations add columns to the data.
+    """
+    version = base_data_version(config_model)
+    cached = _base_data.get(config_model.pk)
+    if cached is None or cached[0] != version:
+        df = _read(base_data_path(config_model, version))
+        if df is None:
+            df = build()
+            if df is not None:
+                save_base_data(config_model, df)
+        cached = _base_data[config_model.pk] = (version, df)
+    df = cached[1]
+    return None if df is None else df.copy()
+
 
 class RegistryDataFrame:
     """
@@ -48,10 +186,15 @@ class RegistryDataFrame:
         patient_id=None,
         force_reload=False,
         needs_all=False,
+        changed_since=None,
     ):
         self.registry = registry
         self.has_static_followups = has_static_followups(self.registry)
         self.state = None
+        # whether an incremental reload changed the stored data
+        self.changed = True
+        # see get_source_state
+        self.source_state = None
         self.config_model = config_model
         self.baseline_form = None
         self.followup_form = None
@@ -81,26 +224,39 @@ class RegistryDataFrame:
         self.needs_all = needs_all
 
         a = datetime.now()
-        if self.mode == "all" and force_reload:
+        if self.mode == "all" and force_reload and changed_since is not None:
+            logger.info(f"reloading data changed since {changed_since}..")
+            self._reload_changed(changed_since)
+        elif self.mode == "all" and force_reload:
             logger.info("forcing reload of dataframe..")
+            self.source_state = get_source_state()
             self._reload_dataframe()
+            self._order()
         elif self.mode == "all":
-            logger.info("loading dataframe from base config json")
-            self.df = pd.read_json(self.config_model.data)
-            self.df[cdf] = pd.to_datetime(self.df[cdf], unit="ms")
+            # stored ordered and sequenced
+            self.df = load_base_data(self.config_model, self._load_base_data_json)
         elif self.mode == "single":
             self._reload_dataframe()
+            self._order()
 
         self.no_data = self.df is None
 
-        if not self.no_data:
+        c = datetime.now()
+        logger.info(f"time taken to load/generate df = {(c-a).total_seconds()} seconds")
+
+    def _order(self):
+        if self.df is not None:
             self._order_by_collection_date(self.df)
             if self.has_static_followups:
                 sfu_handler = get_static_followups_handler(self.registry)
                 self.df = sfu_handler.fix_ordering_of_static_followups(self.df)
 
-        c = datetime.now()
-        logger.info(f"time taken to load/generate df = {(c-a).total_seconds()} seconds")
+    def _load_base_data_json(self):
+        logger.info("loading dataframe from base config json")
+        self.df = pd.read_json(self.config_model.data)
+        self.df[cdf] = pd.to_datetime(self.df[cdf], unit="ms")
+        self._order()
+        return self.df
 
     def _parse_config(self, config_dict: dict):
         if "followup_forms" in config_dict:
@@ -125,22 +281,13 @@ class RegistryDataFrame:
         # from 0 ( the first collected survey to the last)
 
         self.df["SEQ"] = self.df.groupby("PID").cumcount()
-        df = self.df
-
-        def update_seq(row):
-            """
-            This is required because there is the possibility
-            of a patient with no baseline
-            """
-            pid = row["PID"]
-            baselines = df[(df["PID"] == pid) & (df["TYPE"] == "baseline")]
-            if len(baselines) == 0:
-                return row["SEQ"] + 1
-            else:
-                return row["SEQ"]
 
         if not self.multiform:
-            self.df["SEQ"] = self.df.apply(update_seq, axis=1)
+            # the followups of a patient with no baseline start at 1
+            has_baseline = (
+                self.df["TYPE"].eq("baseline").groupby(self.df["PID"]).transform("any")
+            )
+            self.df["SEQ"] += (~has_baseline).astype(int)
         else:
             self.df = self._custom_ordering(self.df)
 
@@ -149,33 +296,75 @@ class RegistryDataFrame:
         # self._sanity_check(self.df)
 
     def _sanity_check(self, df):
-        for index, row in df.iterrows():
-            if row["TYPE"] == "baseline":
-                seq = row["SEQ"]
-                if seq != 0:
-                    raise Exception(f"baseline should be seq 0 instead is {seq}")
+        wrong_seqs = df.loc[df["TYPE"].eq("baseline") & df["SEQ"].ne(0), "SEQ"]
+        if len(wrong_seqs) > 0:
+            raise Exception(f"baseline should be seq 0 instead is {wrong_seqs.iloc[0]}")
 
     def _reseq(self, df):
         pass
 
     def _custom_ordering(self, df):
-        def seq_from_form(form):
-            if form == self.baseline_form:
-                return 0
-            else:
-                for fu_dict in self.followup_forms:
-                    if form == fu_dict["name"]:
-                        return fu_dict["seq"]
-                return 99
+        form_seqs = {
+            fu_dict["name"]: fu_dict["seq"] for fu_dict in reversed(self.followup_forms)
+        }
+        form_seqs[self.baseline_form] = 0
 
-        df = df.assign(newseq=df["FORM"].transform(seq_from_form))
+        df = df.assign(newseq=df["FORM"].map(form_seqs).fillna(99))
         df.sort_values(by=["PID", "newseq", cdf], inplace=True, na_position="last")
         df = df.drop("newseq", axis=1)
         return df
 
-    def _reload_dataframe(self):
+    def _reload_changed(self, changed_since):
+        """
+        Merges the rows of the patients whose clinical data changed since
+        the stored base data was generated into it. Patients deactivated,
+        reactivated or deleted and records deleted since aren't seen from
+        the changed records, so those make it regenerate everything.
+        """
+        previous_state = self.config_model.source_state
+        self.source_state = get_source_state()
+        stored = load_base_data(self.config_model, self._load_base_data_json)
+        columns = self.dataframe_columns
+        if stored is None or list(stored.columns[: len(columns)]) != columns:
+            # nothing to merge into or the configured fields changed
+            self._reload_dataframe()
+            self._order()
+            return
+        if previous_state is None or get_source_state(previous_state) != previous_state:
+            logger.info("patients or records removed, regenerating..")
+            self._reload_dataframe()
+            self._order()
+            return
+
+        changed_ids = set(
+            ClinicalData.objects.filter(
+                collection="cdes", updated__gte=changed_since - CHANGED_SINCE_OVERLAP
+            )
+            .values_list("django_id", flat=True)
+            .distinct()
+        )
+        if not changed_ids:
+            self.changed = False
+            self.df = stored
+            return
+
+        removed_ids = changed_ids - set(
+            Patient.objects.filter(id__in=changed_ids).values_list("id", flat=True)
+        )
+        logger.info(
+            f"{len(changed_ids - removed_ids)} patients changed, {len(removed_ids)} removed"
+        )
+        self._reload_dataframe(patient_ids=changed_ids - removed_ids)
+        stored = stored[~stored["PID"].isin(changed_ids)]
+        frames = [stored] if self.df is None else [stored, self.df]
+        self.df = pd.concat(frames, ignore_index=True)
+        if self.df.empty:
+            self.df = None
+        self._order()
+
+    def _reload_dataframe(self, patient_ids=None):
         try:
-            self.df = self._get_dataframe()
+            self.df = self._get_dataframe(patient_ids)
             if self.df is None:
                 self.state = "empty"
             else:
@@ -194,22 +383,7 @@ class RegistryDataFrame:
         self.df = self._assign_seq_names(self.df)
 
     def _assign_seq_names(self, df):
-        def get_aus_date(row):
-            try:
-                d = row["COLLECTIONDATE"].date()
-                aus_date = f"{d.day}-{d.month}-{d.year}"
-                if "nan" in aus_date:
-                    return ""
-                return f" ({aus_date})"
-            except KeyError:
-                return ""
-            except ValueError:
-                return ""
-
-        df["SEQ_NAME"] = df.apply(
-            lambda row: get_seq_name(row["SEQ"]) + get_aus_date(row), axis=1
-        )
-        return df
+        return assign_seq_names(df)
 
     def _assign_correct_seq_numbers(self, df) -> pd.DataFrame:
         """
@@ -256,14 +430,20 @@ class RegistryDataFrame:
     def _sanity_check_cd(self, cd):
         return cd.data and "forms" in cd.data
 
+    def _load_cd_types(self, cds):
+        contexts = RDRFContext.objects.filter(
+            id__in={cd.context_id for cd in cds}
+        ).select_related("context_form_group")
+        self.cd_types = {}
+        for context in contexts:
+            if context.context_form_group:
+                if context.context_form_group.context_type == "F":
+                    self.cd_types[context.id] = "baseline"
+                else:
+                    self.cd_types[context.id] = "followup"
+
     def _get_cd_type(self, cd):
-        context_id = cd.context_id
-        context = RDRFContext.objects.get(id=context_id)
-        if context.context_form_group:
-            if context.context_form_group.context_type == "F":
-                return "baseline"
-            else:
-                return "followup"
+        return self.cd_types.get(cd.context_id)
 
     def _get_cd_data(self, cd, form_name):
         if not self._sanity_check_cd(cd):
@@ -277,10 +457,9 @@ class RegistryDataFrame:
         else:
             return self.followup_form
 
-    def _get_patient_rows(self, patient):
+    def _get_patient_rows(self, pid, cds):
         rows = []
-        pid = patient.id
-        for seq, cd in enumerate(self._get_cds(patient)):
+        for seq, cd in enumerate(cds):
             if self.multiform:
                 multiform_rows = self._get_multiform_rows(cd)
                 for row in multiform_rows:
@@ -365,21 +544,26 @@ class RegistryDataFrame:
         else:
             return []
 
-    def _get_cds(self, patient):
+    def _get_cds(self, patient_ids):
         return ClinicalData.objects.filter(
-            collection="cdes", django_id=patient.id
-        ).order_by("context_id")
+            collection="cdes", django_id__in=patient_ids
+        ).order_by("django_id", "context_id")
 
-    def _get_dataframe(self):
+    def _get_dataframe(self, patient_ids=None):
         rows = []
         if self.mode == "all":
             qry = Patient.objects.all().order_by("id")
+            if patient_ids is not None:
+                qry = qry.filter(id__in=patient_ids)
         else:
             qry = Patient.objects.filter(id=self.patient_id)
 
-        for patient in qry:
-            for row in self._get_patient_rows(patient):
-                rows.append(row)
+        ids = list(qry.values_list("id", flat=True))
+        for start in range(0, len(ids), PATIENT_BATCH_SIZE):
+            cds = list(self._get_cds(ids[start:start + PATIENT_BATCH_SIZE]))
+            self._load_cd_types(cds)
+            for pid, patient_cds in groupby(cds, key=attrgetter("django_id")):
+                rows.extend(self._get_patient_rows(pid, patient_cds))
         if len(rows) == 0:
             return None
         df = pd.DataFrame(rows)
@@ -414,9 +598,33 @@ class RegistryDataFrame:
         return self.df
 
 
+def get_source_state(previous_state=None):
+    """
+    The active patients and the clinical data records, as of previous_state
+    if given ( those created since then aren't counted ). They only differ
+    from previous_state if patients were deactivated, reactivated or
+    deleted or records deleted, which the changed records don't show.
+    """
+    if previous_state is None:
+        patient_pk = Patient.objects.really_all().aggregate(pk=Max("pk"))["pk"] or 0
+        record_pk = ClinicalData.objects.filter(collection="cdes").aggregate(pk=Max("pk"))["pk"] or 0
+    else:
+        patient_pk = previous_state["patient_pk"]
+        record_pk = previous_state["record_pk"]
+    patients = Patient.objects.filter(pk__lte=patient_pk).aggregate(count=Count("pk"), sum=Sum("pk"))
+    records = ClinicalData.objects.filter(collection="cdes", pk__lte=record_pk).count()
+    return {
+        "patient_pk": patient_pk,
+        "patients": [patients["count"], patients["sum"] or 0],
+        "record_pk": record_pk,
+        "records": records,
+    }
+
+
 def get_data(registry, patient=None, needs_all=False):
     try:
-        config = VisualisationBaseDataConfig.objects.get(registry=registry)
+        # the data json is only read if the stored base data is missing
+        config = VisualisationBaseDataConfig.objects.defer("data").get(registry=registry)
     except VisualisationBaseDataConfig.DoesNotExist:
         config = None
 
@@ -427,6 +635,14 @@ def get_data(registry, patient=None, needs_all=False):
     return rdf.data
 
 
+def get_cohort_aggregates(registry):
+    try:
+        config = VisualisationBaseDataConfig.objects.defer("data").get(registry=registry)
+    except VisualisationBaseDataConfig.DoesNotExist:
+        return None
+    return load_cohort_aggregates(config)
+
+
 def lookup_cde_value(cde_code, raw_value):
     cde_model = CommonDataElement.objects.get(code=cde_code)
     if cde_model.pv_group:
@@ -524,7 +740,7 @@ def has_static_followups(registry):
     try:
         from dashboards.models import VisualisationBaseDataConfig
 
-        vbdc = VisualisationBaseDataConfig.objects.get(registry=registry)
+        vbdc = VisualisationBaseDataConfig.objects.defer("data").get(registry=registry)
         return "followup_forms" in vbdc.config
     except VisualisationBaseDataConfig.DoesNotExist:
         return False
@@ -554,22 +770,6 @@ class StaticFollowupsHandler:
         ]
 
     def fix_ordering_of_static_followups(self, df: pd.DataFrame) -> pd.DataFrame:
-        changed = False
-        for index, row in df.iterrows():
-            if row["FORM"] == self.baseline_form:
-                df.at[index, "SEQ"] = 0
-                changed = True
-            elif row["FORM"] in self.static_form_names:
-                self.fixup_static_followup(df, index, row)
-                changed = True
-
-        if changed:
-            from dashboards.utils import assign_seq_names
-
-            df = assign_seq_names(df, self.get_static_form_name).sort_values(by="SEQ")
-        return df
-
-    def fixup_static_followup(self, df: pd.DataFrame, index, row):
         # the metadata looks like
         # self.static_followups is a dict
         # with keys
@@ -579,11 +779,19 @@ class StaticFollowupsHandler:
         # {"seq": "+", "name": "FUpPROMS3_10Years"}]
         # baseline_form : "<baseline> form
         # this mutates the passed in dataframe
-        form = row["FORM"]
-        for static_form_dict in self.static_followups:
-            if static_form_dict["name"] == form:
-                static_seq = static_form_dict["seq"]
-                df.at[index, "SEQ"] = static_seq
+        form_seqs = {
+            d["name"]: d["seq"]
+            for d in reversed(self.static_followups)
+            if d["name"] in self.static_form_names
+        }
+        form_seqs[self.baseline_form] = 0
+        static_seqs = df["FORM"].map(form_seqs)
+        static = static_seqs.notna()
+
+        if static.any():
+            df.loc[static, "SEQ"] = static_seqs[static].astype(df["SEQ"].dtype)
+            df = assign_seq_names(df, self.get_static_form_name).sort_values(by="SEQ")
+        return df
 
     def get_static_form_name(self, seq, form):
         from rdrf.models.definition.models import RegistryForm
@@ -619,7 +827,7 @@ def get_static_followups_handler(registry):
     try:
         from dashboards.models import VisualisationBaseDataConfig
 
-        vbdc = VisualisationBaseDataConfig.objects.get(registry=registry)
+        vbdc = VisualisationBaseDataConfig.objects.defer("data").get(registry=registry)
         if "followup_forms" in vbdc.config:
             sfs = vbdc.config["followup_forms"]
             baseline_form = vbdc.config["baseline_form"]
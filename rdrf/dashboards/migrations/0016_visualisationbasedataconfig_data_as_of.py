@@ -0,0 +1,23 @@
+# Generated by Django 3.2.15 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboards', '0015_alter_visualisationbasedataconfig_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visualisationbasedataconfig',
+            name='data_as_of',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='visualisationbasedataconfig',
+            name='source_state',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -16,6 +16,11 @@ class VisualisationBaseDataConfig(models.Model):
     registry = models.ForeignKey(Registry, on_delete=models.CASCADE)
     config = models.JSONField()
     data = models.JSONField(default="{}")
+    # clinical data changed from this time on isn't in data yet
+    data_as_of = models.DateTimeField(null=True, blank=True)
+    # the patients and records data was generated from ( see
+    # dashboards.data.get_source_state )
+    source_state = models.JSONField(null=True, blank=True)
 
 
 class VisualisationConfig(models.Model):
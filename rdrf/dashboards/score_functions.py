@@ -17,3 +17,18 @@ def sgc_hsqol_score(raw_score, range_value):
         return None
     result = ((raw_score - 1.0) / range_value) * 100.0
     return round(result, 2)
+
+
+# the scores of a column of raw scores, NaN where there is no raw score
+
+
+def sgc_functional_scores(raw_scores, range_value):
+    return ((1.0 - (raw_scores - 1.0) / range_value) * 100.0).round(2)
+
+
+def sgc_symptom_scores(raw_scores, range_value):
+    return (((raw_scores - 1.0) / range_value) * 100.0).round(2)
+
+
+def sgc_hsqol_scores(raw_scores, range_value):
+    return (((raw_scores - 1.0) / range_value) * 100.0).round(2)
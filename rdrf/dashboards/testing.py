@@ -1,5 +1,70 @@
-from django.test import TestCase
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, override_settings, tag
+from dashboards import data
+from dashboards.data import RegistryDataFrame
+from dashboards.models import VisualisationBaseDataConfig
 from dashboards.score_functions import sgc_symptom_score as f
+from dashboards.utils import sanity_check
+from rdrf.models.definition.models import CDEPermittedValue, CDEPermittedValueGroup
+from rdrf.models.definition.models import CommonDataElement, Registry
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FORM = "PROMSBaseline"
+FOLLOWUP_FORM = "PROMSFollowup"
+PROMS_FIELDS = ["EORTCQLQC30_Q%02d" % q for q in range(1, 11)]
+# budget for building the dataframe of 50k responses, which took minutes
+# when sequencing compared each row with the whole frame
+BENCHMARK_SECONDS = 60
+# the smaller build run with every test run, which a per row sequencing
+# would take well over its budget for too
+BOUNDED_RESPONSES = 5000
+BOUNDED_SECONDS = 15
+
+
+def synthetic_proms_responses(num_responses=50000, responses_per_patient=5, seed=0):
+    """
+    PROMS responses in the shape generate_visualisation_dataframe stores
+    them: a baseline and followups for each patient, in no particular order.
+    A tenth of the patients have no baseline and some baselines have no
+    collection date.
+    """
+    rng = np.random.default_rng(seed)
+    num_patients = num_responses // responses_per_patient
+    num_responses = num_patients * responses_per_patient
+    pids = np.repeat(np.arange(1, num_patients + 1), responses_per_patient)
+    seqs = np.tile(np.arange(responses_per_patient), num_patients)
+    no_baseline = np.repeat(rng.random(num_patients) < 0.1, responses_per_patient)
+    types = np.where((seqs == 0) & ~no_baseline, "baseline", "followup")
+    dates = pd.Series(
+        pd.Timestamp("2020-01-01")
+        + pd.to_timedelta(
+            seqs * 182 + rng.integers(0, 30, num_responses) + pids % 365, unit="D"
+        )
+    )
+    dates[(types == "baseline") & (rng.random(num_responses) < 0.05)] = pd.NaT
+
+    df = pd.DataFrame(
+        {
+            "PID": pids,
+            "SEQ": seqs,
+            "TYPE": types,
+            "CONTEXT_ID": pids,
+            "FORM": np.where(types == "baseline", BASELINE_FORM, FOLLOWUP_FORM),
+            "COLLECTIONDATE": dates,
+        }
+    )
+    for field in PROMS_FIELDS:
+        df[field] = rng.integers(1, 5, num_responses).astype(str)
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
 
 
 class VisTestCase(TestCase):
@@ -36,6 +101,212 @@ class VisTestCase(TestCase):
         )
 
 
+def create_scale_cdes():
+    # range cdes with permitted values 1 to 4, returns their codes
+    pv_group = CDEPermittedValueGroup.objects.create(code="SGCTestScale")
+    for position, code in enumerate(["1", "2", "3", "4"]):
+        CDEPermittedValue.objects.create(
+            pv_group=pv_group, code=code, value=code, position=position
+        )
+    fields = ["SGCTestQ1", "SGCTestQ2", "SGCTestQ3"]
+    for field in fields:
+        CommonDataElement.objects.create(
+            code=field, name=field, datatype="range", pv_group=pv_group
+        )
+    return fields
+
+
+class ScaleGroupScoresTestCase(TestCase):
+    def setUp(self):
+        self.fields = create_scale_cdes()
+
+    def test_scores_match_row_scores(self):
+        from dashboards.components.sgc import ScaleGroupComparison
+
+        df = pd.DataFrame(
+            {
+                "SGCTestQ1": ["1", "4", "2", np.nan],
+                "SGCTestQ2": ["2", "", "4", None],
+                "SGCTestQ3": ["3", None, None, None],
+            }
+        )
+        sgc = ScaleGroupComparison("test", None, df)
+        sgc.load_cde_models(self.fields)
+        # the permitted values are only looked up when loading the cdes
+        with self.assertNumQueries(0):
+            range_value = sgc.get_range_value(self.fields)
+            self.assertEqual(range_value, 3.0)
+            score_function = sgc.get_score_function(range_value, "symptom")
+
+            scored = sgc.calculate_all_scores(df, [("score_0", self.fields, score_function)])
+        expected = [f(2.0, range_value), None, f(3.0, range_value), None]
+        for score, expected_score in zip(scored["score_0"], expected):
+            if expected_score is None:
+                self.assertTrue(np.isnan(score))
+            else:
+                self.assertEqual(score, expected_score)
+
+
+class CohortAggregatesTestCase(TestCase):
+    def setUp(self):
+        self.fields = create_scale_cdes()
+
+    def test_cohort_aggregates(self):
+        from dashboards.aggregates import CohortAggregates, seq_value_counts
+        from dashboards.models import VisualisationConfig
+
+        registry = Registry.objects.create(code="sgctest")
+        vis_config = VisualisationConfig.objects.create(
+            registry=registry,
+            dashboard="A",
+            code="sgc",
+            title="test",
+            config={"groups": [{"title": "G", "fields": self.fields, "scale": "symptom"}]},
+        )
+        df = pd.DataFrame(
+            {
+                "PID": [1, 1, 2],
+                "SEQ": [0, 1, 0],
+                "TYPE": ["baseline", "followup", "baseline"],
+                "FORM": ["B", "F", "B"],
+                "COLLECTIONDATE": pd.to_datetime(["2020-01-01", "2020-07-01", None]),
+                "SGCTestQ1": ["1", "2", "4"],
+                "SGCTestQ2": ["2", "2", "4"],
+                "SGCTestQ3": ["3", "2", None],
+            }
+        )
+        config = SimpleNamespace(registry=registry, config={"fields": self.fields})
+        cohort = CohortAggregates.compute(config, df)
+
+        self.assertTrue(
+            cohort.get_value_counts("SGCTestQ3").equals(seq_value_counts(df, "SGCTestQ3"))
+        )
+        self.assertEqual(cohort.num_patients_since(), 1)
+        self.assertEqual(cohort.num_patients_since(datetime(2020, 6, 1)), 1)
+        self.assertEqual(cohort.num_patients_since(datetime(2021, 1, 1)), 0)
+        # rows without a collection date aren't counted
+        self.assertEqual(cohort.form_counts_since().values.tolist(), [["B", 1], ["F", 1]])
+        self.assertEqual(cohort.form_counts_since(datetime(2020, 6, 1)).values.tolist(), [["F", 1]])
+
+        averages, counts = cohort.get_scale_group_scores(vis_config)
+        self.assertEqual(list(averages["score_0"]), [(f(2.0, 3.0) + f(4.0, 3.0)) / 2, f(2.0, 3.0)])
+        self.assertEqual(list(counts["score_0"]), [2, 1])
+
+        vis_config.config["groups"][0]["scale"] = "functional"
+        self.assertIsNone(cohort.get_scale_group_scores(vis_config))
+
+
+class BaseDataCacheTestCase(TestCase):
+    def test_base_data_read_once_per_version(self):
+        df = pd.DataFrame(
+            {
+                "PID": [1, 1],
+                "SEQ": [0, 1],
+                "COLLECTIONDATE": pd.to_datetime(["2022-01-01", "2022-07-01"]),
+            }
+        )
+        builds = []
+
+        def build():
+            builds.append(1)
+            return df
+
+        config = SimpleNamespace(pk=1, updated=datetime(2023, 1, 1))
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(VISUALISATION_BASE_DATA_DIRECTORY=directory):
+                data._base_data.clear()
+                loaded = data.load_base_data(config, build)
+                loaded["SEQ"] = 5
+                self.assertEqual(list(data.load_base_data(config, build)["SEQ"]), [0, 1])
+                self.assertEqual(len(builds), 1)
+
+                # another worker reads the stored data
+                data._base_data.clear()
+                loaded = data.load_base_data(config, build)
+                self.assertEqual(len(builds), 1)
+                self.assertEqual(loaded["COLLECTIONDATE"].dtype, df["COLLECTIONDATE"].dtype)
+
+                old_path = data.base_data_path(config, data.base_data_version(config))
+                config.updated += timedelta(seconds=1)
+                data.load_base_data(config, build)
+                self.assertEqual(len(builds), 2)
+                self.assertFalse(os.path.exists(old_path))
+                self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+                data._base_data.clear()
+
+    def test_files_others_can_write_are_not_loaded(self):
+        df = pd.DataFrame({"PID": [1], "SEQ": [0]})
+        builds = []
+
+        def build():
+            builds.append(1)
+            return df
+
+        config = SimpleNamespace(pk=1, updated=datetime(2023, 1, 1))
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(VISUALISATION_BASE_DATA_DIRECTORY=directory):
+                path = data.base_data_path(config, data.base_data_version(config))
+                pd.to_pickle(df, path)
+
+                os.chmod(directory, 0o777)
+                data._base_data.clear()
+                data.load_base_data(config, build)
+                self.assertEqual(len(builds), 1)
+
+                os.chmod(directory, 0o700)
+                os.chmod(path, 0o666)
+                data._base_data.clear()
+                data.load_base_data(config, build)
+                self.assertEqual(len(builds), 2)
+                # and the rebuilt data replaced it privately
+                self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+                data._base_data.clear()
+
+
+class RegistryDataFrameBenchmark(TestCase):
+    def test_build_from_5k_responses(self):
+        self.check_build(BOUNDED_RESPONSES, BOUNDED_SECONDS)
+
+    # excluded from the runtests entrypoint's full run, run it with the
+    # runbenchmarks entrypoint
+    @tag("benchmark")
+    def test_build_from_50k_responses(self):
+        self.check_build(50000, BENCHMARK_SECONDS)
+
+    def check_build(self, num_responses, seconds):
+        registry = Registry.objects.create(code="bench")
+        responses = synthetic_proms_responses(num_responses)
+        config = VisualisationBaseDataConfig.objects.create(
+            code="bench",
+            registry=registry,
+            state="D",
+            config={
+                "fields": PROMS_FIELDS,
+                "baseline_form": BASELINE_FORM,
+                "followup_form": FOLLOWUP_FORM,
+            },
+            data=responses.to_json(),
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(VISUALISATION_BASE_DATA_DIRECTORY=directory):
+                data._base_data.clear()
+                start = time.perf_counter()
+                df = RegistryDataFrame(registry, config).data
+                elapsed = time.perf_counter() - start
+                data._base_data.clear()
+
+        logger.info(f"built dataframe of {len(df)} responses in {elapsed:.2f} seconds")
+        self.assertLess(elapsed, seconds)
+        self.assertEqual(len(df), len(responses))
+        sanity_check("benchmark", df)
+        first_seqs = df.groupby("PID")["SEQ"].min()
+        baseline_pids = df.loc[df["TYPE"] == "baseline", "PID"].unique()
+        self.assertTrue((first_seqs[first_seqs.index.isin(baseline_pids)] == 0).all())
+        self.assertTrue((first_seqs[~first_seqs.index.isin(baseline_pids)] == 1).all())
+        self.assertTrue(df["SEQ_NAME"].str.startswith("Baseline").eq(df["SEQ"] == 0).all())
+
+
 # class BCTrafficLightTestCase(TestCase):
 #     def test_normal_case(self):
 #         # normal data baseline + followups
@@ -30,46 +30,16 @@ def get_sevenscale_colour_map():
     }
 
 
-def get_range(cde_model):
-    """
-    Return the numeric range
-    of a range cde
-    e.g.
-    if the allowed values are
-    1
-    2
-    3
-    the range is 3 - 1 = 2
-    """
-
-    if not cde_model.pv_group:
-        return None
-
-    d = cde_model.pv_group.as_dict()
-
-    values = set([])
-    for value_dict in d["values"]:
-        try:
-            # The numeric values are stored with the code key
-            i = float(value_dict["code"])
-            values.add(i)
-        except ValueError:
-            return None
-
-    max_value = max(values)
-    min_value = min(values)
-    return max_value - min_value
-
-
 def get_numeric_values(cde_model):
-    if not cde_model.pv_group:
+    pv_index = cde_model.pv_index
+    if pv_index is None:
         return None
 
-    d = cde_model.pv_group.as_dict()
     values = set([])
-    for value_dict in d["values"]:
+    for code in pv_index.entries:
         try:
-            i = float(value_dict["code"])
+            # The numeric values are stored with the code key
+            i = float(code)
             values.add(i)
         except ValueError:
             return None
@@ -77,18 +47,6 @@ def get_numeric_values(cde_model):
     return values
 
 
-def get_base(cde_code):
-    # i.e min value of the range
-    from rdrf.models.definition.models import CommonDataElement
-
-    cde_model = CommonDataElement.objects.get(code=cde_code)
-    values = get_numeric_values(cde_model)
-    if values is None:
-        raise ValueError("not a numeric range")
-
-    return min(values)
-
-
 seq_names = {
     0: "Baseline",
     1: "1st Followup",
@@ -108,17 +66,14 @@ def get_seq_name(seq_num):
     return seq_names.get(seq_num, f"Followup {seq_num}")
 
 
+def seq_name_column(seqs):
+    return seqs.map(get_seq_name)
+
+
 def add_seq_name(df):
-    def colldate(row):
-        if "COLLECTIONDATE" in row:
-            return f" ({row['COLLECTIONDATE']})"
-        else:
-            return ""
-
-    df["SEQ_NAME"] = df.apply(
-        lambda row: get_seq_name(row["SEQ"]) + colldate(row),
-        axis=1,
-    )
+    df["SEQ_NAME"] = seq_name_column(df["SEQ"])
+    if "COLLECTIONDATE" in df:
+        df["SEQ_NAME"] += " (" + df["COLLECTIONDATE"].astype(str) + ")"
     return df
 
 
@@ -133,9 +88,9 @@ def needs_all_patients_data(vis_configs):
 
 
 def handle_value_error(func):
-    def wrapper(vis_config, data, patient, all_patients_data=None, static_followups={}):
+    def wrapper(vis_config, data, patient, all_patients_data=None, static_followups={}, cohort=None):
         try:
-            return func(vis_config, data, patient, all_patients_data, static_followups)
+            return func(vis_config, data, patient, all_patients_data, static_followups, cohort)
         except ValueError as ve:
             logger.error(f"Error in create graphic {vis_config.code}: {ve}")
             return "Not enough data"
@@ -145,13 +100,14 @@ def handle_value_error(func):
 
 @handle_value_error
 def create_graphic(
-    vis_config, data, patient, all_patients_data=None, static_followups={}
+    vis_config, data, patient, all_patients_data=None, static_followups={}, cohort=None
 ):
     # patient is None for all patients graphics
     # contextual single patient components
     # should be supplied with the patient
     # all_patients_data is supplied only to Scale group Comparisons
     # that
+    # cohort is the precomputed all patients statistics, if generated
 
     from .components.proms_stats import PatientsWhoCompletedForms
     from .components.cfc import CombinedFieldComparison
@@ -160,20 +116,27 @@ def create_graphic(
     from .components.tl import TrafficLights
 
     title = vis_config.title
+    # these components show the data they're given, which is only all
+    # patients' data without a patient
+    all_patients_cohort = cohort if patient is None else None
     if vis_config.code == "proms_stats":
         from dash import html
 
         pcf_graphic = PatientsWhoCompletedForms(
-            "Patients Who Completed Forms", vis_config, data
+            "Patients Who Completed Forms", vis_config, data, cohort=all_patients_cohort
         ).graphic
         return html.Div([pcf_graphic], "proms_stats")
     elif vis_config.code == "cfc":
-        return CombinedFieldComparison(title, vis_config, data).graphic
+        return CombinedFieldComparison(
+            title, vis_config, data, cohort=all_patients_cohort
+        ).graphic
     elif vis_config.code == "cpr":
-        return ChangesInPatientResponses(title, vis_config, data).graphic
+        return ChangesInPatientResponses(
+            title, vis_config, data, cohort=all_patients_cohort
+        ).graphic
     elif vis_config.code == "sgc":
         return ScaleGroupComparison(
-            title, vis_config, data, patient, all_patients_data
+            title, vis_config, data, patient, all_patients_data, cohort=cohort
         ).graphic
     elif vis_config.code == "tl":
         return TrafficLights(
@@ -185,12 +148,14 @@ def create_graphic(
 
 
 def get_all_patients_graphics_map(registry, vis_configs):
-    from .data import get_data
+    from .data import get_data, get_cohort_aggregates
 
     data = get_data(registry, None)
+    cohort = get_cohort_aggregates(registry)
 
     graphics_map = {
-        f"tab_{vc.id}": create_graphic(vc, data, None, None) for vc in vis_configs
+        f"tab_{vc.id}": create_graphic(vc, data, None, None, cohort=cohort)
+        for vc in vis_configs
     }
 
     return graphics_map
@@ -199,7 +164,7 @@ def get_all_patients_graphics_map(registry, vis_configs):
 def get_single_patient_graphics_map(registry, vis_configs, patient_id):
     from registry.patients.models import Patient
     from dashboards.models import VisualisationBaseDataConfig
-    from .data import get_data
+    from .data import get_data, get_cohort_aggregates
     from dash import html
 
     no_data = True
@@ -208,7 +173,7 @@ def get_single_patient_graphics_map(registry, vis_configs, patient_id):
 
     needs_all = needs_all_patients_data(vis_configs)
 
-    base_config_model = VisualisationBaseDataConfig.objects.get(registry=registry)
+    base_config_model = VisualisationBaseDataConfig.objects.defer("data").get(registry=registry)
     base_config = base_config_model.config
     static_followups = {}
     static_followup_forms = base_config.get("followup_forms", [])
@@ -227,8 +192,11 @@ def get_single_patient_graphics_map(registry, vis_configs, patient_id):
     if no_data:
         return {f"tab_{vc.id}": html.H3("No data") for vc in vis_configs}
 
+    cohort = get_cohort_aggregates(registry)
     graphics_map = {
-        f"tab_{vc.id}": create_graphic(vc, data, patient, None, static_followups)
+        f"tab_{vc.id}": create_graphic(
+            vc, data, patient, None, static_followups, cohort=cohort
+        )
         for vc in vis_configs
     }
 
@@ -241,29 +209,32 @@ def dump(name, data):
     data.to_csv(filename)
 
 
-def get_aus_date(row):
-    try:
-        d = row["COLLECTIONDATE"].date()
-        aus_date = f"{d.day}-{d.month}-{d.year}"
-        if "nan" in aus_date:
-            return ""
-        return f" ({aus_date})"
-    except KeyError:
-        return ""
-    except ValueError:
+def aus_date_column(df):
+    # " (d-m-yyyy)" for the collection date of each row
+    if "COLLECTIONDATE" not in df:
         return ""
+    dates = df["COLLECTIONDATE"]
+    day, month, year = (
+        part.astype("Int64").astype(str)
+        for part in (dates.dt.day, dates.dt.month, dates.dt.year)
+    )
+    return (" (" + day + "-" + month + "-" + year + ")").where(dates.notna(), "")
 
 
 def assign_seq_names(df, func=None):
     if func is None:
-        df["SEQ_NAME"] = df.apply(
-            lambda row: get_seq_name(row["SEQ"]) + get_aus_date(row), axis=1
-        )
+        seq_names = seq_name_column(df["SEQ"])
     else:
-        df["SEQ_NAME"] = df.apply(
-            lambda row: func(row["SEQ"], row["FORM"]) + get_aus_date(row), axis=1
+        # func is called once for each seq and form
+        keys = df[["SEQ", "FORM"]]
+        names = keys.drop_duplicates()
+        names = names.assign(
+            SEQ_NAME=[func(seq, form) for seq, form in names.itertuples(index=False)]
         )
+        seq_names = keys.merge(names, how="left", on=["SEQ", "FORM"])["SEQ_NAME"]
+        seq_names.index = df.index
 
+    df["SEQ_NAME"] = seq_names + aus_date_column(df)
     return df
 
 
@@ -272,15 +243,17 @@ class DataFrameError(Exception):
 
 
 def sanity_check(where, df):
-    for index, row in df.iterrows():
+    wrong = (df["TYPE"].eq("baseline") & (df["SEQ"] > 0)) | (
+        df["TYPE"].eq("followup") & df["SEQ"].eq(0)
+    )
+    if wrong.any():
+        row = df[wrong].iloc[0]
         seq = row["SEQ"]
-        form_type = row["TYPE"]
         form = row["FORM"]
-        if form_type == "baseline" and seq > 0:
+        if row["TYPE"] == "baseline":
             raise DataFrameError(
                 f"{where} baseline should have seq 0: {form} has seq = {seq}"
             )
-        if form_type == "followup" and seq == 0:
-            raise DataFrameError(
-                f"{where} followup should have seq > 0: {form} has seq = 0"
-            )
+        raise DataFrameError(
+            f"{where} followup should have seq > 0: {form} has seq = 0"
+        )
@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.db import models
+from django.db import transaction
+from django.dispatch import receiver
 from django.urls import reverse
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 from contextlib import suppress
 
+from rdrf.custom_signals import clinical_data_changed
+from rdrf.models.definition.models import ClinicalData
 from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import RegistryForm
 from rdrf.models.definition.models import RDRFContext
@@ -71,7 +76,6 @@ class FieldValue(models.Model):
 
     @classmethod
     def put(cls, registry_model, patient_model, context_model, form_model, section_model, cde_model, index, value):
-        datatype = cde_model.datatype.strip().lower()
         model, _ = cls.objects.get_or_create(
             registry=registry_model,
             patient=patient_model,
@@ -80,61 +84,78 @@ class FieldValue(models.Model):
             section=section_model,
             cde=cde_model,
             index=index)
+        model.set_value(form_model, section_model, cde_model, index, value)
+        model.save()
 
-        model.datatype = model.set_datatype(datatype)
-        model.is_range = True if cde_model.pv_group else False
-        model.column_name = model.get_column_name(form_model,
-                                                  section_model,
-                                                  cde_model,
-                                                  index)
+    @classmethod
+    def build(cls, registry_id, patient_id, context_id, form_model, section_model, cde_model, index, value,
+              display_value=None):
+        # unsaved instance for bulk loading
+        model = cls(registry_id=registry_id,
+                    patient_id=patient_id,
+                    context_id=context_id,
+                    form=form_model,
+                    section=section_model,
+                    cde=cde_model,
+                    index=index)
+        model.set_value(form_model, section_model, cde_model, index, value, display_value)
+        return model
+
+    def set_value(self, form_model, section_model, cde_model, index, value, display_value=None):
+        datatype = cde_model.datatype.strip().lower()
+        self.datatype = self.set_datatype(datatype)
+        self.is_range = True if cde_model.pv_group_id else False
+        self.column_name = self.get_column_name(form_model,
+                                                section_model,
+                                                cde_model,
+                                                index)
         if value is None:
-            model.save()
             return
 
         if datatype == 'string':
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
-        elif cde_model.pv_group:
-            model.display_value = cde_model.get_display_value(value)
+        elif cde_model.pv_group_id:
+            if display_value is None:
+                display_value = cde_model.get_display_value(value)
+            self.display_value = display_value
         elif datatype in ['integer', 'int', 'ineger']:
             try:
-                model.raw_integer = int(value)
+                self.raw_integer = int(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype in ['boolean', 'bool']:
             try:
-                model.raw_boolean = bool(value)
+                self.raw_boolean = bool(value)
             except BaseException:
                 pass
         elif datatype in ['float', 'numeric', 'decimal']:
             try:
-                model.raw_float = float(value)
+                self.raw_float = float(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype == 'date':
             try:
-                model.raw_date = parse_iso_date(value)
+                self.raw_date = parse_iso_date(value)
             except BaseException:
                 pass
         elif datatype == 'file':
             try:
-                model.file_name = value.get("file_name", None)
+                self.file_name = value.get("file_name", None)
             except BaseException:
                 pass
         else:
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
 
-        model.save()
-
     def set_datatype(self, datatype):
         if datatype in ['string', 'striing']:
             return 'string'
@@ -314,3 +335,22 @@ class Query(models.Model):
         except KeyError as ke:
             errors.append("key error: %s" % ke)
         return errors
+
+
+@receiver(clinical_data_changed, sender=ClinicalData)
+def update_field_values(sender, registry_code, django_model, django_id, context_id, changes, **kwargs):
+    from explorer.utils import FieldValueLoader
+
+    if django_model != "Patient" or context_id is None:
+        return
+    if settings.USE_CELERY and settings.FIELD_VALUE_TASKS:
+        from rdrf.services.tasks import update_field_values as update_task
+        # paths go over the wire as lists
+        paths = [list(path) for path in changes]
+        transaction.on_commit(lambda: update_task.delay(registry_code, django_id, context_id, paths))
+        return
+    try:
+        registry_model = Registry.objects.get(code=registry_code)
+        FieldValueLoader(registry_model).apply_changes(django_id, context_id, changes)
+    except Exception as ex:
+        logger.error("error updating field values for patient %s context %s: %s" % (django_id, context_id, ex))
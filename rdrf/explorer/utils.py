@@ -1,13 +1,18 @@
 from collections import OrderedDict
 import json
 import pickle
+from django.contrib.contenttypes.models import ContentType
 from django.db import ProgrammingError
 from django.db import connection
+from django.db import transaction
 
-from rdrf.helpers.utils import get_cached_instance
+from rdrf.db.dynamic_data import cde_paths
+from rdrf.helpers.compiled_registry import get_compiled_registry
 from rdrf.helpers.utils import timed
 from rdrf.models.definition.models import Registry, RegistryForm, Section
 from rdrf.models.definition.models import CommonDataElement
+from rdrf.models.definition.models import ClinicalData, RDRFContext
+from registry.patients.models import Patient
 
 from .models import Query
 from .models import FieldValue
@@ -65,6 +70,20 @@ class MissingDataError(Exception):
 class DatabaseUtils(object):
 
     result = None
+    # sql rows pivoted per round trip when joining field values
+    page_size = 500
+    # field value columns holding the report value for each datatype
+    VALUE_COLUMNS = ("raw_value", "display_value", "raw_integer", "raw_float", "file_name", "raw_boolean", "raw_date")
+    DATATYPE_COLUMNS = {
+        "string": 0,
+        "calculated": 0,
+        "range": 1,
+        "integer": 2,
+        "float": 3,
+        "file": 4,
+        "boolean": 5,
+        "date": 6,
+    }
 
     def __init__(self, form_object=None, verify=False):
         self.error_messages = []
@@ -94,6 +113,18 @@ class DatabaseUtils(object):
                 self.aggregation = self.form_object.aggregation
                 self.mongo_search_type = self.form_object.mongo_search_type
 
+    @property
+    def compiled_registry(self):
+        if getattr(self, "_compiled_registry", None) is None:
+            self._compiled_registry = get_compiled_registry(self.registry_model)
+        return self._compiled_registry
+
+    def _get_definition_models(self, form_name, section_code, cde_code):
+        compiled_form = self.compiled_registry.get_form(form_name)
+        compiled_section = self.compiled_registry.get_section(section_code)
+        cde_model = compiled_section.get_cde(cde_code)
+        return compiled_form.form_model, compiled_section.section_model, cde_model
+
     def run_sql(self):
         try:
             cursor = self.create_cursor()
@@ -182,7 +213,6 @@ class DatabaseUtils(object):
 
     @timed
     def generate_results2(self, reverse_column_map, col_map, max_items, collection=None, history=None, sql_only=False):
-        from registry.patients.models import Patient
         self.reverse_map = reverse_column_map
         self.col_map = col_map
         report_columns = col_map.values()
@@ -210,35 +240,16 @@ class DatabaseUtils(object):
                 yield d
 
         def full_new():
-            registry_id = self.registry_model.id
-            from copy import copy
-            for row in self.cursor:
-                row_dict = copy(blank_dict)
-                d = get_sql_dict(row)
-                row_dict.update(d)
-                patient_id = int(d['id'])
-                patient_model = Patient.objects.get(id=patient_id)
-                q = (FieldValue.objects.filter(registry_id=registry_id)
-                     .prefetch_related("patient")
-                     .prefetch_related("context")
-                     .prefetch_related("form")
-                     .prefetch_related("section")
-                     .prefetch_related("cde"))
-
-                for context_model in patient_model.context_models:
-                    context_id = context_model.pk
-                    row = copy(row_dict)
-                    row["context_id"] = context_id
-
-                    qry = q.filter(registry_id=registry_id,
-                                   patient_id=patient_id,
-                                   context_id=context_id,
-                                   column_name__in=report_columns,
-                                   index__lt=max_items)
-
-                    self._get_fvs_by_datatype(qry, row)
-
-                    yield row
+            # one page of sql rows at a time: the contexts and field values
+            # for the whole page are fetched in a single query each and
+            # pivoted into report rows here
+            while True:
+                sql_rows = self.cursor.fetchmany(self.page_size)
+                if not sql_rows:
+                    return
+                sql_dicts = [get_sql_dict(row) for row in sql_rows]
+                for d in self._pivot_page(sql_dicts, blank_dict, report_columns, max_items):
+                    yield d
 
         if self.mongo_search_type == "C":
             # current data - no longitudinal snapshots
@@ -254,23 +265,41 @@ class DatabaseUtils(object):
                                            max_items):
                 yield d
 
-    def _get_fvs_by_datatype(self, query, row):
-        for fv in query.filter(datatype='string'):
-            row[fv.column_name] = fv.raw_value
-        for fv in query.filter(datatype='range'):
-            row[fv.column_name] = fv.display_value
-        for fv in query.filter(datatype='integer'):
-            row[fv.column_name] = fv.raw_integer
-        for fv in query.filter(datatype='float'):
-            row[fv.column_name] = fv.raw_float
-        for fv in query.filter(datatype='file'):
-            row[fv.column_name] = fv.file_name
-        for fv in query.filter(datatype='boolean'):
-            row[fv.column_name] = fv.raw_boolean
-        for fv in query.filter(datatype='date'):
-            row[fv.column_name] = fv.raw_date
-        for fv in query.filter(datatype='calculated'):
-            row[fv.column_name] = fv.get_calculated_value()
+    def _pivot_page(self, sql_dicts, blank_dict, report_columns, max_items):
+        """
+        Yields a report row per patient context for a page of sql rows
+        """
+        patient_ids = [int(d["id"]) for d in sql_dicts]
+        active_ids = set(Patient.objects.filter(id__in=patient_ids).values_list("id", flat=True))
+        contexts = {}
+        context_rows = (RDRFContext.objects.filter(content_type=ContentType.objects.get_for_model(Patient),
+                                                   object_id__in=active_ids)
+                        .order_by("created_at")
+                        .values_list("object_id", "pk"))
+        for patient_id, context_id in context_rows:
+            contexts.setdefault(patient_id, []).append(context_id)
+
+        values = {}
+        field_values = (FieldValue.objects.filter(registry_id=self.registry_model.id,
+                                                  patient_id__in=active_ids,
+                                                  column_name__in=list(report_columns),
+                                                  index__lt=max_items)
+                        .values_list("patient_id", "context_id", "column_name", "datatype", *self.VALUE_COLUMNS))
+        for patient_id, context_id, column_name, datatype, *typed_values in field_values.iterator():
+            if datatype in self.DATATYPE_COLUMNS:
+                value = typed_values[self.DATATYPE_COLUMNS[datatype]]
+                if datatype == "calculated":
+                    value = FieldValue(raw_value=value).get_calculated_value()
+                values.setdefault((patient_id, context_id), {})[column_name] = value
+
+        for d in sql_dicts:
+            patient_id = int(d["id"])
+            for context_id in contexts.get(patient_id, []):
+                row = dict(blank_dict)
+                row.update(d)
+                row["context_id"] = context_id
+                row.update(values.get((patient_id, context_id), {}))
+                yield row
 
     def sql_only_c(self, reverse_map):
         for row in self.cursor:
@@ -408,9 +437,9 @@ class DatabaseUtils(object):
             return data
 
         for cde_dict in self.projection:
-            form_model = get_form_model(cde_dict["formName"], self.registry_model)
-            section_model = get_section_model(cde_dict["sectionCode"])
-            cde_model = get_cde_model(cde_dict["cdeCode"])
+            form_model, section_model, cde_model = self._get_definition_models(cde_dict["formName"],
+                                                                               cde_dict["sectionCode"],
+                                                                               cde_dict["cdeCode"])
             column_name = self._get_database_column_name(form_model, section_model, cde_model)
             data["multisection_column_map"][(
                 form_model, section_model, cde_model)] = column_name
@@ -423,14 +452,9 @@ class DatabaseUtils(object):
 
     def _get_mongo_fields(self):
         for cde_dict in self.projection:
-            form_model = get_cached_instance(
-                RegistryForm,
-                name=cde_dict["formName"],
-                registry=self.registry_model)
-            section_model = get_cached_instance(Section, code=cde_dict["sectionCode"])
-            cde_model = get_cached_instance(CommonDataElement, code=cde_dict["cdeCode"])
-
-            yield form_model, section_model, cde_model
+            yield self._get_definition_models(cde_dict["formName"],
+                                              cde_dict["sectionCode"],
+                                              cde_dict["cdeCode"])
 
     def run_mongo_one_row(self, sql_column_data, collection, max_items, col_map):
         mongo_query = {
@@ -507,9 +531,15 @@ class DatabaseUtils(object):
         query = {"django_id": sql_column_data["id"],
                  "django_model": "Patient",
                  "record_type": "snapshot"}
-        for snapshot in history.find(**query).data():
+        for snapshot in history.find(**query).snapshots():
             yield self._get_result_map(snapshot, is_snapshot=True, max_items=max_items, col_map=col_map)
 
+    def _get_cde_model(self, cde_code):
+        cde_model = self.compiled_registry.cdes.get(cde_code)
+        if cde_model is None:
+            cde_model = get_cde_model(cde_code)
+        return cde_model
+
     def _build_dictionary(self, clinical_data):
         d = {}
         for form_dict in clinical_data["forms"]:
@@ -521,7 +551,7 @@ class DatabaseUtils(object):
                         cde_code = cde_dict["code"]
                         cde_value = cde_dict["value"]
                         t = (form_name, section_code, cde_code)
-                        cde_model = get_cde_model(cde_code)
+                        cde_model = self._get_cde_model(cde_code)
                         d[t] = _get_sensible_value_from_cde(cde_model, cde_value)
                 else:
                     items = section_dict["cdes"]
@@ -535,7 +565,7 @@ class DatabaseUtils(object):
                             else:
                                 cde_data[cde_code] = [cde_value]
                     for cde_code in cde_data:
-                        cde_model = get_cde_model(cde_code)
+                        cde_model = self._get_cde_model(cde_code)
                         t = (form_name, section_code, cde_code)
                         d[t] = [_get_sensible_value_from_cde(cde_model, value) for value in cde_data[cde_code]]
         return d
@@ -648,3 +678,169 @@ def create_field_values(registry_model, patient_model, context_model, remove_exi
                                            cde_model,
                                            index,
                                            cde_dict["value"])
+
+
+class FieldValueLoader:
+    """
+    Set based rebuild of the FieldValue rows of one registry.
+
+    The clinical data are streamed in chunks, definition models are resolved
+    from the compiled registry and the rows are written with bulk_create,
+    so the cost no longer grows with one round trip per cde value.
+    """
+
+    def __init__(self, registry_model, chunk_size=500, batch_size=5000, progress=None):
+        self.registry_model = registry_model
+        self.compiled_registry = get_compiled_registry(registry_model)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        # called as progress(records, rows) after each chunk
+        self.progress = progress
+        self._sections = {code: cs.section_model for code, cs in self.compiled_registry.sections.items()}
+        self._cdes = dict(self.compiled_registry.cdes)
+        self._display_values = {}
+
+    def _get_section_model(self, section_code):
+        # data can refer to sections which are no longer on a form
+        if section_code not in self._sections:
+            self._sections[section_code] = Section.objects.filter(code=section_code).first()
+        return self._sections[section_code]
+
+    def _get_cde_model(self, cde_code):
+        if cde_code not in self._cdes:
+            self._cdes[cde_code] = CommonDataElement.objects.filter(code=cde_code).first()
+        return self._cdes[cde_code]
+
+    def _get_display_value(self, cde_model, value):
+        if not cde_model.pv_group_id or value is None:
+            return None
+        key_value = tuple(value) if isinstance(value, list) else value
+        try:
+            key = (cde_model.code, key_value)
+            hash(key)
+        except TypeError:
+            return cde_model.get_display_value(value)
+        if key not in self._display_values:
+            self._display_values[key] = cde_model.get_display_value(value)
+        return self._display_values[key]
+
+    def get_contexts(self, id_range=None):
+        """
+        context id -> patient id for the registry's patients
+        """
+        patients = Patient.objects.filter(rdrf_registry=self.registry_model)
+        if id_range is not None:
+            patients = patients.filter(pk__gte=id_range[0], pk__lte=id_range[1])
+        contexts = RDRFContext.objects.filter(registry=self.registry_model,
+                                              content_type=ContentType.objects.get_for_model(Patient),
+                                              object_id__in=patients.values("pk"))
+        return dict(contexts.values_list("pk", "object_id"))
+
+    def get_records(self, id_range=None):
+        records = ClinicalData.objects.collection(self.registry_model.code, "cdes").filter(django_model="Patient")
+        if id_range is not None:
+            records = records.filter(django_id__gte=id_range[0], django_id__lte=id_range[1])
+        return records.values_list("django_id", "context_id", "data").iterator(chunk_size=self.chunk_size)
+
+    def _build(self, patient_id, context_id, path, value):
+        # returns None for paths the definition no longer knows about
+        form_name, section_code, index, cde_code = path
+        compiled_form = self.compiled_registry.forms_by_name.get(form_name)
+        section_model = self._get_section_model(section_code)
+        cde_model = self._get_cde_model(cde_code)
+        if compiled_form is None or section_model is None or cde_model is None:
+            return None
+        return FieldValue.build(self.registry_model.pk,
+                                patient_id,
+                                context_id,
+                                compiled_form.form_model,
+                                section_model,
+                                cde_model,
+                                index,
+                                value,
+                                self._get_display_value(cde_model, value))
+
+    def field_values(self, patient_id, context_id, data):
+        """
+        Unsaved FieldValue instances for one clinical data record
+        """
+        field_values = (self._build(patient_id, context_id, path, value) for path, value in cde_paths(data).items())
+        return [field_value for field_value in field_values if field_value is not None]
+
+    def load(self, id_range=None):
+        """
+        Writes the rows for the registry ( or the patients with ids in id_range. )
+        Returns the number of clinical data records read and rows written.
+        """
+        contexts = self.get_contexts(id_range)
+        seen = set()
+        batch = []
+        records = rows = 0
+        for patient_id, context_id, data in self.get_records(id_range):
+            # only the first record of a context is used, as in get_dynamic_data
+            if contexts.get(context_id) != patient_id or context_id in seen:
+                continue
+            seen.add(context_id)
+            records += 1
+            batch.extend(self.field_values(patient_id, context_id, data or {}))
+            if len(batch) >= self.batch_size:
+                FieldValue.objects.bulk_create(batch, batch_size=self.batch_size)
+                rows += len(batch)
+                batch = []
+            if self.progress and records % self.chunk_size == 0:
+                self.progress(records, rows)
+        if batch:
+            FieldValue.objects.bulk_create(batch, batch_size=self.batch_size)
+            rows += len(batch)
+        if self.progress:
+            self.progress(records, rows)
+        return records, rows
+
+    def delete(self, id_range=None):
+        field_values = FieldValue.objects.filter(registry=self.registry_model)
+        if id_range is not None:
+            field_values = field_values.filter(patient_id__gte=id_range[0], patient_id__lte=id_range[1])
+        field_values.delete()
+
+    def delete_others(self):
+        # the rows of patients who are no longer in the registry
+        patients = Patient.objects.filter(rdrf_registry=self.registry_model)
+        FieldValue.objects.filter(registry=self.registry_model).exclude(patient__in=patients.values("pk")).delete()
+
+    def rebuild(self, id_range=None):
+        with transaction.atomic():
+            self.delete(id_range)
+            return self.load(id_range)
+
+    def apply_changes(self, patient_id, context_id, changes):
+        """
+        Brings the rows for the changed (form name, section code, index, cde code)
+        paths of one record up to date, leaving the rest of the record alone.
+        """
+        record = (ClinicalData.objects.collection(self.registry_model.code, "cdes")
+                  .filter(django_model="Patient", django_id=patient_id, context_id=context_id)
+                  .data().first())
+        paths = cde_paths(record or {})
+        changes = set(tuple(path) for path in changes)
+        form_names = set(path[0] for path in changes)
+
+        new_rows = []
+        for path in changes:
+            if path in paths:
+                field_value = self._build(patient_id, context_id, path, paths[path])
+                if field_value is not None:
+                    new_rows.append(field_value)
+
+        def path_of(field_value):
+            return (field_value.form.name, field_value.section.code, field_value.index, field_value.cde_id)
+
+        existing = (FieldValue.objects.filter(registry=self.registry_model,
+                                              patient_id=patient_id,
+                                              context_id=context_id,
+                                              form__name__in=form_names)
+                    .select_related("form", "section"))
+        stale = [field_value.pk for field_value in existing if path_of(field_value) in changes]
+        with transaction.atomic():
+            FieldValue.objects.filter(pk__in=stale).delete()
+            FieldValue.objects.bulk_create(new_rows, batch_size=self.batch_size)
+        return len(stale), len(new_rows)
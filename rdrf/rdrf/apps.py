@@ -16,3 +16,5 @@ class RDRFConfig(AppConfig):
         import rdrf.models.definition.review_models
         import rdrf.models.definition.verification_models
         import rdrf.models.task_models
+        import rdrf.models.progress_models
+        import rdrf.models.history_models
@@ -1,2 +1,4 @@
 from django.dispatch import Signal
 clinical_data_saved_ok = Signal()
+# sent with the (form name, section code, index, cde code) paths changed by a save
+clinical_data_changed = Signal()
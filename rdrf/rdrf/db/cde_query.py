@@ -0,0 +1,97 @@
+"""
+Queries on the cde values of ClinicalData records which run in the database.
+
+cde_filter compiles "cde X matches predicate P" to a jsonpath over the
+nested cdes document ( data @? '...' ), which the gin index on
+ClinicalData.data serves, so finding the records or patients with a value
+doesn't mean loading every record and scanning it in Python.
+"""
+import datetime
+import json
+
+from django.db.models import Q
+
+from rdrf.helpers.compiled_registry import get_compiled_registry
+from rdrf.models.definition.models import ClinicalData
+
+OPERATORS = {
+    "exact": "==",
+    "ne": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+}
+
+# compared as numbers whether stored as numbers or numeric strings
+NUMERIC_DATATYPES = ("integer", "float")
+
+
+def jsonpath_literal(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return json.dumps(value)
+
+
+def value_condition(cde_model, lookup, value):
+    """
+    The jsonpath condition on a cde dict ( @ ) for a lookup on its value
+    """
+    if lookup == "isnull":
+        return "@.value %s null" % ("==" if value else "!=")
+
+    operand = "@.value"
+    if cde_model.datatype.strip().lower() in NUMERIC_DATATYPES:
+        operand = "@.value.double()"
+        value = [float(v) for v in value] if lookup == "in" else float(value)
+
+    if lookup == "in":
+        return "(%s)" % " || ".join("%s == %s" % (operand, jsonpath_literal(v)) for v in value)
+    if lookup not in OPERATORS:
+        raise ValueError("Unsupported cde lookup: %s" % lookup)
+    return "%s %s %s" % (operand, OPERATORS[lookup], jsonpath_literal(value))
+
+
+def cde_path(form_name, section_model, cde_code, condition):
+    items = "cdes[*][*]" if section_model.allow_multiple else "cdes[*]"
+    return "$.forms[*] ? (@.name == %s).sections[*] ? (@.code == %s).%s ? (@.code == %s && %s)" % (
+        jsonpath_literal(form_name),
+        jsonpath_literal(section_model.code),
+        items,
+        jsonpath_literal(cde_code),
+        condition)
+
+
+def cde_filter(registry_model, cde_code, lookup="exact", value=None, form_name=None, section_code=None):
+    """
+    Q for the cdes records of registry_model in which a value of cde_code
+    satisfies the lookup ( exact, ne, gt, gte, lt, lte, in or isnull. )
+    The cde is looked for wherever it is used in the registry's forms unless
+    form_name / section_code restrict it. In a multisection any item may match.
+    """
+    compiled_registry = get_compiled_registry(registry_model)
+    cde_model = compiled_registry.get_cde(cde_code)
+    if lookup == "in" and not value:
+        return Q(pk__in=[])
+    condition = value_condition(cde_model, lookup, value)
+
+    q = None
+    for form_model, section_model, location_cde in compiled_registry.cde_triples():
+        if location_cde.code != cde_code:
+            continue
+        if form_name is not None and form_model.name != form_name:
+            continue
+        if section_code is not None and section_model.code != section_code:
+            continue
+        location_q = Q(data__path_exists=cde_path(form_model.name, section_model, cde_code, condition))
+        q = location_q if q is None else q | location_q
+    return q if q is not None else Q(pk__in=[])
+
+
+def patients_where(registry_model, cde_code, lookup="exact", value=None, form_name=None, section_code=None):
+    """
+    Ids of the patients with a cdes record matching cde_filter
+    """
+    q = cde_filter(registry_model, cde_code, lookup, value, form_name=form_name, section_code=section_code)
+    records = ClinicalData.objects.collection(registry_model.code, "cdes").filter(django_model="Patient").filter(q)
+    return records.order_by("django_id").values_list("django_id", flat=True).distinct()
@@ -17,6 +17,7 @@ class RegistryRouter:
         ("rdrf", "formprogress"),
         ("rdrf", "modjgo"),
         ("rdrf", "clinicaldata"),
+        ("rdrf", "cdehistory"),
     )
 
     @classmethod
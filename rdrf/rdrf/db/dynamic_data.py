@@ -1,13 +1,16 @@
+import copy
 import datetime
-from operator import itemgetter
 from itertools import zip_longest
 import logging
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.conf import settings
+from django.db import router, transaction
 
 from rdrf.helpers.utils import BadKeyError
+from rdrf.custom_signals import clinical_data_changed
 
 from rdrf.db import filestorage
+from rdrf.db.history import encode_snapshot, latest_snapshot
 from rdrf.forms.file_upload import FileUpload, wrap_fs_data_for_form
 from rdrf.models.definition.models import Registry, ClinicalData
 from rdrf.helpers.utils import get_code, models_from_mongo_key, is_delimited_key, mongo_key, is_multisection
@@ -24,60 +27,6 @@ class KeyValueMissing(Exception):
     pass
 
 
-def find_sections(doc, form_name=None, section_code=None, formp=None, sectionp=None, multisection=False):
-    """
-    Iterates through form sections of a mongo doc.
-      form_name: Filter by form
-      section_code: Filter by code
-      formp: predicate function(form_dict, index)
-      sectionp: predicate function(section_dict, index | (index, index))
-      multisection: whether to find multisections or single sections
-    """
-    formp = formp or (lambda f, i: True)
-    sectionp = sectionp or (lambda s, i: True)
-
-    for f, form in enumerate(doc.get("forms") or []):
-        if (form_name is None or (form.get("name") == form_name and formp(form, f))):
-            for s, section in enumerate(form.get("sections") or []):
-                if (section_code is None or section.get("code") == section_code) and bool(multisection) == bool(section.get("allow_multiple")):
-                    if multisection:
-                        for s2, section2 in enumerate(section.get("cdes") or []):
-                            product = dict(section)
-                            product["cdes"] = section2
-                            if sectionp(product, (s, s2)):
-                                yield product
-                    elif sectionp(section, s):
-                        yield section
-
-
-def find_cdes(doc,
-              form_name=None,
-              section_code=None,
-              cde_code=None,
-              formp=None,
-              sectionp=None,
-              cdep=None,
-              multisection=False):
-    """
-    Iterates through CDEs stored in a mongo doc.
-    """
-    cdep = cdep or (lambda c, i: True)
-
-    sections = find_sections(doc, form_name, section_code, formp, sectionp, multisection=multisection)
-    for section in sections:
-        for c, cde in enumerate(section.get("cdes") or []):
-            if (cde_code is None or (cde.get("code") == cde_code and cdep(cde, c))):
-                yield cde
-
-
-def section_allow_multiple(s, i):
-    return bool(s.get("allow_multiple"))
-
-
-def section_not_allow_multiple(s, i):
-    return not s.get("allow_multiple")
-
-
 def get_mongo_value(registry_code, nested_data, delimited_key, multisection_index=None):
     """
     Grabs a CDE value out of the mongo document.
@@ -87,23 +36,12 @@ def get_mongo_value(registry_code, nested_data, delimited_key, multisection_inde
     registry_model = Registry.objects.get(code=registry_code)
     form_model, section_model, cde_model = models_from_mongo_key(registry_model, delimited_key)
 
-    if multisection_index is None:
-        sectionp = None
-    else:
-
-        def sectionp(s, ij):
-            return ij[1] == multisection_index
-
-    cdes = find_cdes(
-        nested_data,
-        form_model.name,
-        section_model.code,
-        cde_model.code,
-        sectionp=sectionp,
-        multisection=multisection_index is not None)
-    for cde in cdes:
-        return cde["value"]
-    return None
+    cde_index = CdeIndex(nested_data)
+    if multisection_index is not None:
+        return cde_index.get_item(form_model.name, section_model.code, cde_model.code, multisection_index)
+    if cde_index.is_multisection(form_model.name, section_model.code):
+        return None
+    return cde_index.get(form_model.name, section_model.code, cde_model.code)
 
 
 def update_multisection_file_cdes(registry_code, multisection_code, form_section_items, form_model,
@@ -166,6 +104,128 @@ def build_form_data(data):
     return flattened
 
 
+def cde_paths(data):
+    """
+    Maps (form name, section code, index, cde code) -> value for the cdes
+    in a clinical data record. Values in single sections have index 0.
+    """
+    paths = {}
+    for form_dict in data.get("forms") or []:
+        for section_dict in form_dict.get("sections") or []:
+            if section_dict.get("allow_multiple"):
+                items = enumerate(section_dict.get("cdes") or [])
+            else:
+                items = [(0, section_dict.get("cdes") or [])]
+            for index, cde_dicts in items:
+                for cde_dict in cde_dicts:
+                    path = (form_dict.get("name"), section_dict.get("code"), index, cde_dict.get("code"))
+                    paths[path] = cde_dict.get("value")
+    return paths
+
+
+def diff_cde_paths(old_paths, new_paths):
+    """
+    The paths added, removed or given a different value between two cde_paths results
+    """
+    changed = set(old_paths) ^ set(new_paths)
+    changed.update(path for path in set(old_paths) & set(new_paths) if old_paths[path] != new_paths[path])
+    return sorted(changed, key=str)
+
+
+class CdeIndex(object):
+    """
+    Index of a nested cdes document built in one pass, so that reading or
+    setting a value doesn't walk the forms and sections each time.
+    (form name, section code, cde code) -> the cde dicts of the cde: one for
+    a section, one per item for a multisection ( None where an item lacks it. )
+    Values set through the index are written to the document, other changes
+    to the document's structure need a new index.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.cde_dicts = {}
+        self.item_counts = {}
+        # cde code -> the first cde dict with the code in a section of any form
+        self.section_cdes = {}
+        self._filled_codes = None
+        for form_dict in (data or {}).get("forms") or []:
+            form_name = form_dict["name"]
+            for section_dict in form_dict["sections"]:
+                section_code = section_dict["code"]
+                if section_dict["allow_multiple"]:
+                    items = section_dict["cdes"]
+                    self.item_counts[(form_name, section_code)] = len(items)
+                    for index, cde_dicts in enumerate(items):
+                        for cde_dict in cde_dicts:
+                            item_dicts = self.cde_dicts.setdefault((form_name, section_code, cde_dict["code"]), [])
+                            item_dicts.extend([None] * (index + 1 - len(item_dicts)))
+                            item_dicts[index] = cde_dict
+                else:
+                    for cde_dict in section_dict["cdes"]:
+                        self.cde_dicts.setdefault((form_name, section_code, cde_dict["code"]), []).append(cde_dict)
+                        self.section_cdes.setdefault(cde_dict["code"], cde_dict)
+
+    def get(self, form_name, section_code, cde_code, default=None):
+        # the value, or first value in a multisection
+        values = self.get_all(form_name, section_code, cde_code)
+        return values[0] if values else default
+
+    def get_all(self, form_name, section_code, cde_code):
+        cde_dicts = self.cde_dicts.get((form_name, section_code, cde_code), [])
+        return [cde_dict["value"] for cde_dict in cde_dicts if cde_dict is not None]
+
+    def get_item(self, form_name, section_code, cde_code, index, default=None):
+        # the value in one item of a multisection
+        cde_dicts = self.cde_dicts.get((form_name, section_code, cde_code), [])
+        if index < len(cde_dicts) and cde_dicts[index] is not None:
+            return cde_dicts[index]["value"]
+        return default
+
+    def value(self, form_name, section_code, cde_code):
+        # as get_cde_value: the list of item values for a multisection
+        if self.is_multisection(form_name, section_code):
+            return self.get_all(form_name, section_code, cde_code)
+        return self.get(form_name, section_code, cde_code)
+
+    def first_value(self, cde_code, default=None):
+        # the value of cde_code in the first ( non multi ) section holding it
+        cde_dict = self.section_cdes.get(cde_code)
+        return cde_dict["value"] if cde_dict is not None else default
+
+    def set(self, form_name, section_code, cde_code, value, index=0):
+        """
+        Writes the value ( of item index in a multisection ) to the document.
+        Raises KeyError if the cde isn't in the document.
+        """
+        cde_dicts = self.cde_dicts.get((form_name, section_code, cde_code), [])
+        if index >= len(cde_dicts) or cde_dicts[index] is None:
+            raise KeyError("%s/%s/%s[%s] is not in the document" % (form_name, section_code, cde_code, index))
+        cde_dicts[index]["value"] = value
+        self._filled_codes = None
+
+    def is_multisection(self, form_name, section_code):
+        return (form_name, section_code) in self.item_counts
+
+    def num_items(self, form_name, section_code):
+        return self.item_counts.get((form_name, section_code), 0)
+
+    @property
+    def filled_codes(self):
+        # form name -> codes of the cdes with a value
+        if self._filled_codes is None:
+            filled_codes = {}
+            for (form_name, section_code, cde_code), cde_dicts in self.cde_dicts.items():
+                if any(cde_dict is not None and cde_dict["value"] for cde_dict in cde_dicts):
+                    filled_codes.setdefault(form_name, set()).add(cde_code)
+            self._filled_codes = filled_codes
+        return self._filled_codes
+
+    @property
+    def forms_with_data(self):
+        return set(self.filled_codes)
+
+
 def parse_form_data(registry,
                     form,
                     data,
@@ -516,36 +576,24 @@ class DynamicDataWrapper(object):
             return None
 
     def get_cde_history(self, registry_code, form_name, section_code, cde_code):
-        from rdrf.helpers.utils import get_cde_value
-        from rdrf.models.definition.models import Registry, RegistryForm, Section, CommonDataElement
-        registry_model = Registry.objects.get(code=registry_code)
-        form_model = RegistryForm.objects.get(registry=registry_model, name=form_name)
-        section_model = Section.objects.get(code=section_code)
-        cde_model = CommonDataElement.objects.get(code=cde_code)
-
-        def fmt(snapshot, snapshot_number):
-            return {
-                "timestamp": datetime.datetime.strptime(snapshot["timestamp"][:19], "%Y-%m-%d %H:%M:%S"),
-                "value": get_cde_value(form_model, section_model, cde_model, snapshot["record"]),
-                "user": snapshot.get("username", ""),
-                "id": str(snapshot_number),
-            }
-
-        def collapse_same(snapshots):
-            # This should be changed to use sets I think
-            prev = {"": None}  # nonlocal works in python3
-
-            def is_different(snap):
-                diff = prev[""] is None or snap["value"] != prev[""]["value"]
-                prev[""] = snap
-                return diff
-
-            return list(filter(is_different, snapshots))
-
-        record_query = self._get_record(registry_code, "history", filter_by_context=False)
-        record_query = record_query.find(record_type="snapshot")
-        data = [fmt(snapshot, i) for i, snapshot in enumerate(record_query.data())]
-        return collapse_same(sorted(data, key=itemgetter("timestamp")))
+        # the changes to a cde's value in this context, from the history index
+        from rdrf.models.history_models import CdeHistory
+        entries = CdeHistory.objects.filter(registry_code=registry_code,
+                                            django_model=self.obj.__class__.__name__,
+                                            django_id=self.obj.pk,
+                                            context_id=self.rdrf_context_id,
+                                            form_name=form_name,
+                                            section_code=section_code,
+                                            cde_code=cde_code).order_by("timestamp", "snapshot_id")
+        # id numbers the entries, as the snapshots did before
+        return [{
+            "timestamp": timestamp,
+            "value": value,
+            "user": username,
+            "id": str(i),
+            "snapshot_id": snapshot_id,
+        } for i, (timestamp, value, username, snapshot_id) in enumerate(
+            entries.values_list("timestamp", "value", "username", "snapshot_id"))]
 
     def load_registry_specific_data(self, registry_model=None):
         data = {}
@@ -582,6 +630,9 @@ class DynamicDataWrapper(object):
 
     @staticmethod
     def handle_file_upload(registry_code, key, value, current_value):
+        # the file changes are made once the record is committed, so a
+        # save which is rolled back leaves the files alone
+        commit_db = router.db_for_write(ClinicalData)
         to_delete = False
         ret_value = value
         if value is False and current_value:
@@ -598,10 +649,10 @@ class DynamicDataWrapper(object):
             # A file was uploaded.
             # Store file and convert value into a file wrapper
             to_delete = False
-            ret_value = filestorage.store_file_by_key(registry_code, None, key, value)
+            ret_value = filestorage.store_file_by_key(registry_code, None, key, value, commit_db=commit_db)
 
         if to_delete:
-            filestorage.delete_file_wrapper(file_ref)
+            transaction.on_commit(lambda: filestorage.delete_file_wrapper(file_ref), using=commit_db)
 
         return ret_value
 
@@ -647,18 +698,22 @@ class DynamicDataWrapper(object):
                 data__django_model=self.obj.__class__.__name__,
                 data__context_id=context_id)
 
+            old_paths = self._get_cde_paths(cdes_modjgo)
             cdes_modjgo.data.update(cdes_record)
             # ensure context id created
             cdes_modjgo.context_id = context_id
 
         except ClinicalData.DoesNotExist:
+            old_paths = {}
             cdes_modjgo = ClinicalData.create(
-                self.obj, registry_code=registry_model.code, collection="cdes", data=cdes_record)
+                self.obj, registry_code=registry_model.code, collection="cdes", data=cdes_record,
+                context_id=context_id)
 
         from rdrf.jsonb import _convert_datetime_to_str
         # Not sure why I have to do this explicitly
         _convert_datetime_to_str(cdes_modjgo.data)
         cdes_modjgo.save()
+        self._send_changes(registry_model.code, cdes_modjgo, old_paths)
 
     def _create_context_model_on_fly(self):
         assert self.CREATE_MODE, "Must be in CREATE MODE"
@@ -694,12 +749,65 @@ class DynamicDataWrapper(object):
                           index_map=None,
                           additional_data=None,
                           skip_bad_key=False):
-        self._convert_date_to_datetime(form_data)
-
+        record = self._get_record_for_save(registry, collection_name)
+        old_paths = self._get_cde_paths(record) if collection_name == "cdes" else None
+
+        self._merge_form_data(record,
+                              Registry.objects.get(code=registry),
+                              form_data,
+                              multisection=multisection,
+                              parse_all_forms=parse_all_forms,
+                              index_map=index_map,
+                              additional_data=additional_data,
+                              skip_bad_key=skip_bad_key)
+        self._save_record(record)
+        if old_paths is not None:
+            self._send_changes(registry, record, old_paths)
+
+    def save_form_data(self, registry, section_data):
+        """
+        Saves all the sections of a form to the cdes record with one write.
+        section_data is a list of (form_data, options) pairs, options being
+        the keyword arguments save_dynamic_data takes for the section.
+        The saved record is kept in patient_record so that progress and the
+        snapshot can use it without loading it again.
+        """
+        registry_model = Registry.objects.get(code=registry)
+        with transaction.atomic(using=router.db_for_write(ClinicalData)):
+            record = self._get_record_for_save(registry, "cdes", for_update=True)
+            old_paths = self._get_cde_paths(record)
+            for form_data, options in section_data:
+                self._merge_form_data(record, registry_model, form_data, **options)
+            self._save_record(record)
+        self.patient_record = record
+        self._send_changes(registry, record, old_paths)
+        return record
+
+    def _get_record_for_save(self, registry, collection_name, for_update=False):
         if self.CREATE_MODE:
             record = None
         else:
-            record = self._get_record(registry, collection_name).first()
+            records = self._get_record(registry, collection_name)
+            if for_update:
+                records = records.select_for_update()
+            record = records.first()
+
+        if not record:
+            record = self._make_record(registry, collection_name)
+            record.data["forms"] = []
+        return record
+
+    def _merge_form_data(self,
+                         record,
+                         registry_model,
+                         form_data,
+                         multisection=False,
+                         parse_all_forms=False,
+                         index_map=None,
+                         additional_data=None,
+                         skip_bad_key=False):
+        # parses form_data into the record's document ( in place )
+        self._convert_date_to_datetime(form_data)
 
         form_data["timestamp"] = datetime.datetime.now()
 
@@ -707,14 +815,10 @@ class DynamicDataWrapper(object):
             form_timestamp_key = "%s_timestamp" % self.current_form_model.name
             form_data[form_timestamp_key] = form_data["timestamp"]
 
-        if not record:
-            record = self._make_record(registry, collection_name)
-            record.data["forms"] = []
-
-        self._update_files_in_fs(record.data, registry, form_data, index_map)
+        self._update_files_in_fs(record.data, registry_model.code, form_data, index_map)
 
         nested_data = parse_form_data(
-            Registry.objects.get(code=registry),
+            registry_model,
             self.current_form_model,
             form_data,
             existing_record=record.data,
@@ -726,6 +830,9 @@ class DynamicDataWrapper(object):
         if additional_data is not None:
             nested_data.update(additional_data)
 
+        record.data.update(nested_data)
+
+    def _save_record(self, record):
         if record.id is None and self.CREATE_MODE:
             # create context_model NOW  to get context_id
             # CREATE MODE is used ONLY by multiple context form groups to enable
@@ -734,15 +841,36 @@ class DynamicDataWrapper(object):
             # we've refactored the ClinicalData object so that context_id is now on the model:
             record.context_id = context_id
             # keeping this line for backward compatibility for now
-            nested_data["context_id"] = context_id
+            record.data["context_id"] = context_id
             # not any subsequent calls won't try to create new context models
             self.CREATE_MODE = False
             self.rdrf_context_id = context_id
 
-        record.data.update(nested_data)
         record.save()
 
+    def _get_cde_paths(self, record):
+        # copied as parsing updates the record in place
+        if not clinical_data_changed.has_listeners(ClinicalData):
+            return {}
+        return copy.deepcopy(cde_paths(record.data))
+
+    def _send_changes(self, registry_code, record, old_paths):
+        """
+        Tells listeners which cde paths a save has added, removed or changed
+        """
+        if not clinical_data_changed.has_listeners(ClinicalData):
+            return
+        changes = diff_cde_paths(old_paths, cde_paths(record.data))
+        if changes:
+            clinical_data_changed.send(sender=ClinicalData,
+                                       registry_code=registry_code,
+                                       django_model=record.django_model,
+                                       django_id=record.django_id,
+                                       context_id=record.context_id,
+                                       changes=changes)
+
     def _save_longitudinal_snapshot(self, registry_code, record, form_name=None, form_user=None):
+        from rdrf.models.history_models import CdeHistory
         try:
             timestamp = str(datetime.datetime.now())
             patient_id = record.data['django_id']
@@ -759,23 +887,39 @@ class DynamicDataWrapper(object):
             }
 
             history = self._make_record(registry_code, "history", data=snapshot)
-            history.save()
+            latest = latest_snapshot(history)
+            encode_snapshot(history, latest)
+        except Exception as ex:
+            self._log_history_error(patient_id, ex)
+            return
+        # the snapshot and its index rows are written together, and a
+        # failure to write them doesn't fail the save
+        try:
+            with transaction.atomic(using=router.db_for_write(CdeHistory)):
+                history.save()
+                CdeHistory.objects.bulk_create(CdeHistory.entries(history, snapshot, latest[2] if latest else None))
         except Exception as ex:
-            from registry.patients.models import Patient
-            patient_model = Patient.objects.get(id=patient_id)
-            logger.error("Couldn't add to history for patient %s: %s" % (getattr(patient_model, settings.LOG_PATIENT_FIELDNAME), ex))
+            self._log_history_error(patient_id, ex)
 
-    def save_snapshot(self, registry_code, collection_name, form_name=None, form_user=None):
-        record = self._get_record(registry_code, collection_name).first()
+    def _log_history_error(self, patient_id, ex):
+        from registry.patients.models import Patient
+        patient_model = Patient.objects.get(id=patient_id)
+        logger.error("Couldn't add to history for patient %s: %s" % (getattr(patient_model, settings.LOG_PATIENT_FIELDNAME), ex))
+
+    def save_snapshot(self, registry_code, collection_name, form_name=None, form_user=None, record=None):
+        # record can be passed in when it has just been saved
+        if record is None:
+            record = self._get_record(registry_code, collection_name).first()
         if record is not None:
             self._save_longitudinal_snapshot(registry_code, record, form_name=form_name, form_user=form_user)
 
-    def save_form_progress(self, registry_code, context_model=None):
+    def save_form_progress(self, registry_code, context_model=None, dynamic_data=None, form_names=None):
         from rdrf.forms.progress.form_progress import FormProgress
         registry_model = Registry.objects.get(code=registry_code)
         form_progress = FormProgress(registry_model)
-        dynamic_data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
-        return form_progress.save_progress(self.obj, dynamic_data, context_model)
+        if dynamic_data is None:
+            dynamic_data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
+        return form_progress.save_progress(self.obj, dynamic_data, context_model, form_names=form_names)
 
     def _convert_date_to_datetime(self, data):
         if isinstance(data, list):
@@ -790,19 +934,10 @@ class DynamicDataWrapper(object):
                     self._convert_date_to_datetime(value)
 
     def get_nested_cde(self, registry_code, form_name, section_code, cde_code):
-        # fixme: clean this up
-        for form_dict, section_dict, item in self.iter_cdes(registry_code):
-            if form_dict["name"] == form_name:
-                if section_dict["code"] == section_code:
-                    if not section_dict["allow_multiple"]:
-                        if item["code"] == cde_code:
-                            return item["value"]
-                    else:
-                        results = []
-                        for cde in item:
-                            if cde["code"] == cde_code:
-                                results.append(cde["value"])
-                        return results
+        data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
+        if data is None:
+            return None
+        return CdeIndex(data).value(form_name, section_code, cde_code)
 
     def iter_cdes(self, registry_code):
         data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
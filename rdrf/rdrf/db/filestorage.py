@@ -1,5 +1,6 @@
 import logging
 import re
+from django.db import transaction
 from rdrf.models.definition.models import Registry, CDEFile
 from rdrf.helpers.utils import models_from_mongo_key
 
@@ -29,14 +30,20 @@ def delete_file_wrapper(file_ref):
     return None
 
 
-def store_file(registry_code, cde_code, file_obj, form_name=None, section_code=None):
+def store_file(registry_code, cde_code, file_obj, form_name=None, section_code=None, commit_db=None):
+    # with commit_db the file is written once the transaction open on that
+    # database commits, the id for the record is there straight away
     cde_file = CDEFile(registry_code=registry_code,
                        form_name=form_name,
                        section_code=section_code,
                        cde_code=cde_code,
-                       item=file_obj,
                        filename=file_obj.name)
-    cde_file.save()
+    if commit_db is None:
+        cde_file.item = file_obj
+        cde_file.save()
+    else:
+        cde_file.save()
+        transaction.on_commit(lambda: cde_file.item.save(file_obj.name, file_obj), using=commit_db)
 
     return {
         "django_file_id": cde_file.id,
@@ -44,14 +51,15 @@ def store_file(registry_code, cde_code, file_obj, form_name=None, section_code=N
     }
 
 
-def store_file_by_key(registry_code, patient_record, key, file_obj):
+def store_file_by_key(registry_code, patient_record, key, file_obj, commit_db=None):
     registry = Registry.objects.get(code=registry_code)
     form, section, cde = models_from_mongo_key(registry, key)
     return store_file(registry_code,
                       cde.code,
                       file_obj,
                       form.name,
-                      section.code)
+                      section.code,
+                      commit_db=commit_db)
 
 
 oid_pat = re.compile(r"[0-9A-F]{24}", re.I)
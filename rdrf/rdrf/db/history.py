@@ -0,0 +1,221 @@
+"""
+Delta encoding of the history collection.
+
+A snapshot of a patient's cdes record is stored either as a keyframe, a
+full copy of the record, or as a delta holding only the changes against
+the snapshot it was based on. Snapshots of one patient context form a
+chain and a keyframe starts the chain again every
+HISTORY_KEYFRAME_INTERVAL snapshots, so any snapshot is rebuilt from at
+most that many rows. Rows without an encoding are keyframes, which is
+how all history was stored before, so old rows read as they are.
+"""
+from collections import OrderedDict
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DELTA = "delta"
+# keys of a delta row which aren't part of the snapshot it stands for
+DELTA_KEYS = ("encoding", "base", "depth", "changes")
+
+
+def keyframe_interval():
+    return getattr(settings, "HISTORY_KEYFRAME_INTERVAL", 20)
+
+
+def is_delta(data):
+    return data.get("encoding") == DELTA
+
+
+def diff_record(old, new):
+    """
+    The changes turning old into new, as a list of
+    ["set", path, value], ["del", path] and ["trunc", path, length]
+    where path is a list of dict keys and list indexes.
+    """
+    changes = []
+    _diff(old, new, [], changes)
+    return changes
+
+
+def _diff(old, new, path, changes):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                changes.append(["del", path + [key]])
+        for key, value in new.items():
+            if key in old:
+                _diff(old[key], value, path + [key], changes)
+            else:
+                changes.append(["set", path + [key], value])
+    elif isinstance(old, list) and isinstance(new, list):
+        for index, value in enumerate(new[:len(old)]):
+            _diff(old[index], value, path + [index], changes)
+        if len(new) < len(old):
+            changes.append(["trunc", path, len(new)])
+        for index in range(len(old), len(new)):
+            changes.append(["set", path + [index], new[index]])
+    elif type(old) is not type(new) or old != new:
+        changes.append(["set", path, new])
+
+
+def apply_changes(record, changes):
+    """
+    The record diff_record's changes turn record into.
+    record isn't modified: only the containers along each changed path are
+    copied and the rest is shared with the result, so decoded records
+    must be treated as read only.
+    """
+    for change in changes:
+        record = _apply(record, change[0], change[1], change[2:])
+    return record
+
+
+def _apply(node, op, path, args):
+    if not path:
+        if op == "set":
+            return args[0]
+        if op == "trunc":
+            return node[:args[0]]
+        raise ValueError("Can't apply %s to the whole record" % op)
+
+    key = path[0]
+    node = node.copy()
+    if len(path) > 1 or op == "trunc":
+        node[key] = _apply(node[key], op, path[1:], args)
+    elif op == "del":
+        del node[key]
+    elif isinstance(node, list) and key == len(node):
+        node.append(args[0])
+    else:
+        node[key] = args[0]
+    return node
+
+
+class SnapshotDecoder:
+    """
+    Rebuilds full snapshots from stored history rows.
+
+    Rows are expected in pk order, so a delta's base has normally just been
+    decoded; the last decoded record of recently seen chains is kept and a
+    base that isn't kept is loaded from the database.
+    """
+
+    def __init__(self, max_records=1000):
+        self.max_records = max_records
+        # pk -> (record, depth)
+        self.records = OrderedDict()
+
+    def decode(self, pk, data):
+        """
+        The snapshot data as it would have been stored in full
+        """
+        if not is_delta(data):
+            self._keep(pk, data.get("record"), 0)
+            return data
+
+        base_record = self.record(data["base"])
+        record = apply_changes(base_record, data["changes"])
+        self._keep(pk, record, data["depth"])
+        snapshot = {key: value for key, value in data.items() if key not in DELTA_KEYS}
+        snapshot["record"] = record
+        return snapshot
+
+    def latest(self, rows):
+        """
+        (pk, depth, record) of the last of rows, the latest snapshots of a
+        chain in pk order, decoding from the last keyframe among them.
+        """
+        if not rows:
+            return None
+        start = 0
+        for index, (pk, data) in enumerate(rows):
+            if not is_delta(data):
+                start = index
+        for pk, data in rows[start:]:
+            self.decode(pk, data)
+        pk = rows[-1][0]
+        record, depth = self.records[pk]
+        return pk, depth, record
+
+    def _keep(self, pk, record, depth):
+        self.records[pk] = (record, depth)
+        self.records.move_to_end(pk)
+        while len(self.records) > self.max_records:
+            self.records.popitem(last=False)
+
+    def record(self, pk):
+        # the decoded record of the snapshot row pk
+        if pk not in self.records:
+            from rdrf.models.definition.models import ClinicalData
+            logger.debug("loading history base %s" % pk)
+            self.decode(pk, ClinicalData.objects.values_list("data", flat=True).get(pk=pk))
+        return self.records[pk][0]
+
+
+def chain_query(history_model):
+    # the earlier snapshots in the chain of a new history row
+    from rdrf.models.definition.models import ClinicalData
+    return ClinicalData.objects.collection(history_model.registry_code, "history").filter(
+        django_model=history_model.django_model,
+        django_id=history_model.django_id,
+        context_id=history_model.context_id,
+        data__record_type="snapshot")
+
+
+def latest_snapshot(history_model):
+    """
+    (pk, depth, record) of the latest snapshot in the chain of a new
+    history row, or None if it is the first
+    """
+    rows = list(chain_query(history_model).order_by("-pk").values_list("pk", "data")[:keyframe_interval()])
+    return SnapshotDecoder().latest(rows[::-1])
+
+
+def encode_snapshot(history_model, latest):
+    """
+    Turns the full snapshot of a new ( unsaved ) history row into a delta
+    against latest ( see latest_snapshot ), unless a keyframe is due.
+    """
+    interval = keyframe_interval()
+    if latest is None or interval <= 1:
+        return
+    base_pk, base_depth, base_record = latest
+    if base_depth + 1 >= interval:
+        return
+    history_model.data = delta_data(history_model.data, base_pk, base_depth + 1, base_record)
+
+
+def delta_data(snapshot, base_pk, depth, base_record):
+    data = {key: value for key, value in snapshot.items() if key != "record"}
+    data["encoding"] = DELTA
+    data["base"] = base_pk
+    data["depth"] = depth
+    data["changes"] = diff_record(base_record, snapshot["record"])
+    return data
+
+
+def encode_chain(rows, expand=False):
+    """
+    Re-encodes the stored snapshots of one chain, given as (pk, data) in pk
+    order, as keyframes every keyframe_interval() rows and deltas against
+    the previous snapshot in between ( or all keyframes if expand. )
+    Yields (pk, data) for the rows whose stored data changes.
+    """
+    interval = keyframe_interval()
+    decoder = SnapshotDecoder()
+    previous = None
+    depth = 0
+    for pk, data in rows:
+        snapshot = decoder.decode(pk, data)
+        if expand or previous is None or depth + 1 >= interval:
+            encoded = snapshot
+            depth = 0
+        else:
+            depth += 1
+            encoded = delta_data(snapshot, previous, depth, decoder.record(previous))
+        previous = pk
+        if encoded != data:
+            yield pk, encoded
@@ -609,11 +609,9 @@ class FormGroupButton(RDRFComponent):
         if self.context_form_group is None:
             return "Modules"
         else:
-            if self.context_form_group.supports_direct_linking:
-                # we know there is one form
-                return self.context_form_group.forms[0].nice_name
-            else:
-                return self.context_form_group.name
+            # the listing hands in groups with their forms prefetched, so
+            # this doesn't query per row
+            return self.context_form_group.direct_name
 
 
 class FamilyLinkagePanel(RDRFComponent):
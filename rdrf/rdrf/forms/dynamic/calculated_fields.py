@@ -53,7 +53,7 @@ class CalculatedFieldScriptCreator(object):
         patient_model = Patient.objects.get(id=self.injected_model_id)
         registry_model = self.registry
         patient_date_of_birth = patient_model.date_of_birth.__format__("%Y-%m-%d")
-        wsurl = reverse("v1:calculatedcde-list")
+        wsurl = reverse("v1:calculatedcdebatch-list")
         javascript = """
             <script type="text/javascript" nonce="%s">
             $(document).ready(function(){
@@ -63,6 +63,7 @@ class CalculatedFieldScriptCreator(object):
                     cde_inputs: %s,
                     patient_id: %s,
                     registry_code: '%s',
+                    form_name: "%s",
                     patient_sex: %s,
                     patient_date_of_birth: '%s',
                     observer: "%s",
@@ -77,6 +78,7 @@ class CalculatedFieldScriptCreator(object):
             cde_inputs,
             patient_model.id,
             registry_model.code,
+            self.registry_form.name,
             patient_model.sex,
             patient_date_of_birth,
             observer_code,
@@ -1,5 +1,5 @@
 import datetime
-from django.db.models import JSONField
+from django.db.models import JSONField, Lookup
 
 
 __all__ = ["DataField"]
@@ -37,3 +37,18 @@ def _convert_datetime_to_str(data):
             else:
                 # recurse on multisection data
                 _convert_datetime_to_str(value)
+
+
+@DataField.register_lookup
+class PathExists(Lookup):
+    """
+    field__path_exists="<jsonpath>" compiles to field @? '<jsonpath>', which
+    a jsonb_path_ops gin index on the field can serve
+    """
+    lookup_name = "path_exists"
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return "%s @? %s::jsonpath" % (lhs, rhs), lhs_params + rhs_params
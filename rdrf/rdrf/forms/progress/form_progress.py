@@ -1,7 +1,9 @@
 from django.urls import reverse
 from django.templatetags.static import static
+from rdrf.helpers.compiled_registry import get_compiled_registry
 from rdrf.helpers.utils import de_camelcase, parse_iso_datetime
 from rdrf.models.definition.models import ClinicalData
+from rdrf.db.dynamic_data import CdeIndex
 
 import math
 import logging
@@ -47,6 +49,7 @@ class FormProgress(object):
 
     def __init__(self, registry_model):
         self.registry_model = registry_model
+        self.compiled_registry = get_compiled_registry(registry_model)
         self.progress_data = {}
         self.progress_collection = self._get_progress_collection()
         self.progress_cdes_map = self._build_progress_map()
@@ -55,17 +58,17 @@ class FormProgress(object):
         self.context_model = None
         # if the following is true, the "type" of patient affects what forms
         # are applicable/presented/counted:
-        self.uses_patient_types = self.registry_model.has_feature("patient_types")
+        self.uses_patient_types = self.compiled_registry.has_feature("patient_types")
         if self.uses_patient_types:
-            self.patient_type_form_map = self.registry_model.metadata["patient_types"]
+            self.patient_type_form_map = self.compiled_registry.metadata["patient_types"]
         else:
             self.patient_type_form_map = None
 
     def _get_forms(self):
         if self.context_model is None:
-            return self.registry_model.forms
+            return list(self.compiled_registry.form_models)
         elif self.context_model.context_form_group is None:
-            return self.registry_model.forms
+            return list(self.compiled_registry.form_models)
         else:
             return self.context_form_group.forms
 
@@ -83,39 +86,22 @@ class FormProgress(object):
 
     def _build_progress_map(self):
         # maps form names to sets of required cde codes
-        result = {}
-        for form_model in self.registry_model.forms:
-            if not form_model.is_questionnaire:
-                result[form_model.name] = set([cde_model.code for cde_model in
-                                               form_model.complete_form_cdes.all()])
-        return result
+        return {compiled_form.name: compiled_form.completion_cde_codes
+                for compiled_form in self.compiled_registry.compiled_forms
+                if not compiled_form.is_questionnaire}
 
-    def _calculate_form_progress(self, form_model, dynamic_data):
+    def _calculate_form_progress(self, form_model, cde_index):
         result = {"required": 0, "filled": 0, "percentage": 0}
 
         for section_model, cde_model in self._get_progress_cdes(form_model):
             if not section_model.allow_multiple:
                 result["required"] += 1
+                if test_value(cde_index.get(form_model.name, section_model.code, cde_model.code)):
+                    result["filled"] += 1
             else:
-                num_items = self._get_num_items(form_model, section_model, dynamic_data)
-                result["required"] += num_items
-
-            try:
-                if not section_model.allow_multiple:
-                    value = self._get_value_from_dynamic_data(
-                        form_model, section_model, cde_model, dynamic_data)
-                    if test_value(value):
-                        result["filled"] += 1
-                else:
-                    values = self._get_values_from_multisection(
-                        form_model, section_model, cde_model, dynamic_data)
-                    filled_in_values = [value for value in values if test_value(value)]
-                    result["filled"] += len(filled_in_values)
-
-            except Exception as ex:
-                logger.error(
-                    "Error getting value for %s %s: %s" %
-                    (section_model.code, cde_model.code, ex))
+                result["required"] += cde_index.num_items(form_model.name, section_model.code)
+                values = cde_index.get_all(form_model.name, section_model.code, cde_model.code)
+                result["filled"] += len([value for value in values if test_value(value)])
 
         if result["required"] > 0:
             result["percentage"] = int(
@@ -125,41 +111,6 @@ class FormProgress(object):
 
         return result
 
-    def _get_values_from_multisection(self, form_model, section_model, cde_model, dynamic_data):
-        if dynamic_data is None:
-            return []
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if section_dict["code"] == section_model.code:
-                        values = []
-                        items = section_dict["cdes"]
-                        for item in items:
-                            for cde_dict in item:
-                                if cde_dict["code"] == cde_model.code:
-                                    values.append(cde_dict["value"])
-                        return values
-        return []
-
-    def _get_num_items(self, form_model, section_model, dynamic_data):
-        if not section_model.allow_multiple:
-            return 1
-        else:
-            if dynamic_data is None:
-                return 0
-            if "forms" not in dynamic_data:
-                return 0
-            for form_dict in dynamic_data["forms"]:
-                if form_dict["name"] == form_model.name:
-                    for section_dict in form_dict["sections"]:
-                        if section_dict["code"] == section_model.code:
-                            # for multisections the cdes field contains a list
-                            # of items, each of which is a list of cde dicts
-                            # containing the values for each item
-                            items = section_dict["cdes"]
-                            return len(items)
-        return 0
-
     def _calculate_form_currency(self, form_model, dynamic_data):
         from datetime import timedelta, datetime
         form_timestamp_key = "%s_timestamp" % form_model.name
@@ -175,43 +126,23 @@ class FormProgress(object):
 
         return False
 
-    def _get_value_from_dynamic_data(self, form_model, section_model, cde_model, dynamic_data):
-        # gets value or first value in a multisection
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if section_dict["code"] == section_model.code:
-                        if not section_dict["allow_multiple"]:
-                            for cde_dict in section_dict["cdes"]:
-                                if cde_dict["code"] == cde_model.code:
-                                    return cde_dict["value"]
-                        else:
-                            for section_item in section_dict["cdes"]:
-                                for cde_dict in section_item:
-                                    if cde_dict["code"] == cde_model.code:
-                                        return cde_dict["value"]
-
     def _get_progress_cdes(self, form_model_required):
-        cdes_required = self.progress_cdes_map[form_model_required.name]
-        for form_model in self.registry_model.forms:
-            if not form_model.is_questionnaire:
-                if form_model.name == form_model_required.name:
-                    for section_model in form_model.section_models:
-                        for cde_model in section_model.cde_models:
-                            if cde_model.code in cdes_required:
-                                yield section_model, cde_model
+        compiled_form = self.compiled_registry.forms_by_name.get(form_model_required.name)
+        if compiled_form is None or compiled_form.is_questionnaire:
+            return
+        yield from compiled_form.progress_cdes()
 
     def _get_progress_metadata(self):
         pm = {}
 
         try:
-            metadata = self.registry_model.metadata
+            metadata = self.compiled_registry.metadata
             if "progress" in metadata:
                 pm = metadata["progress"]
             else:
                 # default behaviour - this is the old behaviour
                 groups_dict = {"diagnosis": [], "genetic": []}
-                for form_model in self.registry_model.forms:
+                for form_model in self.compiled_registry.form_models:
                     if "genetic" in form_model.name.lower():
                         groups_dict["genetic"].append(form_model.name)
                     else:
@@ -239,53 +170,18 @@ class FormProgress(object):
             if not patient_type:
                 patient_type = "default"
 
-            applicable_forms = self.registry_model.metadata["patient_types"][patient_type]["forms"]
+            applicable_forms = self.compiled_registry.metadata["patient_types"][patient_type]["forms"]
             for group_name in unfiltered_dict:
                 filtered_dict[group_name] = [form_name for form_name in unfiltered_dict[group_name]
                                              if form_name in applicable_forms]
             return filtered_dict
 
-    def _calculate_form_has_data(self, form_model, dynamic_data):
-        if dynamic_data is None:
-            return False
-        for form_dict in dynamic_data['forms']:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if not section_dict["allow_multiple"]:
-                        for cde_dict in section_dict["cdes"]:
-                            if test_value(cde_dict["value"]):
-                                return True
-                    else:
-                        for item in section_dict["cdes"]:
-                            for cde_dict in item:
-                                if test_value(cde_dict["value"]):
-                                    return True
-
-    def _calculate_form_cdes_status(self, form_model, dynamic_data):
-        if dynamic_data is None:
-            return {}
+    def _calculate_form_has_data(self, form_model, cde_index):
+        return form_model.name in cde_index.forms_with_data
 
-        cdes_status = {}
-        required_cdes = self.progress_cdes_map[form_model.name]
-        cdes_status = {code: False for code in required_cdes}
-
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if not section_dict["allow_multiple"]:
-                        for cde_dict in section_dict["cdes"]:
-                            if cde_dict["code"] in required_cdes:
-                                if cde_dict["value"]:
-                                    code = cde_dict["code"]
-                                    cdes_status[code] = True
-                    else:
-                        for item in section_dict["cdes"]:
-                            for cde_dict in item:
-                                if cde_dict["code"] in required_cdes:
-                                    if cde_dict["value"]:
-                                        code = cde_dict["code"]
-                                        cdes_status[code] = True
-        return cdes_status
+    def _calculate_form_cdes_status(self, form_model, cde_index):
+        filled_codes = cde_index.filled_codes.get(form_model.name, set())
+        return {code: code in filled_codes for code in self.progress_cdes_map[form_model.name]}
 
     def _applicable(self, form_model):
         if self.patient_type_form_map:
@@ -297,7 +193,22 @@ class FormProgress(object):
                 return form_model.name in applicable_forms
         return True
 
-    def _calculate(self, dynamic_data, patient_model=None):
+    def _previous_form_metrics(self, form_name, previous):
+        # the stored metrics of a form, or None if they aren't all there or
+        # were worked out from another version of the form's definition
+        keys = [form_name + suffix for suffix in ("_form_progress", "_form_has_data", "_form_cdes_status")]
+        if previous is None or not all(key in previous for key in keys):
+            return None
+        if previous.get(form_name + "_form_definition") != self.compiled_registry.forms_by_name[form_name].progress_key:
+            return None
+        return [previous[key] for key in keys]
+
+    def _calculate(self, dynamic_data, patient_model=None, form_names=None, previous=None):
+        """
+        form_names limits the document walking to the forms given ( the ones
+        saved ); the other forms reuse their metrics from the previous
+        progress data. Currency is always worked out as it depends on the date.
+        """
         if patient_model is not None:
             self.current_patient = patient_model
 
@@ -305,17 +216,23 @@ class FormProgress(object):
         if not progress_metadata:
             return
 
-        self._build_progress_map()
-
         groups_progress = {}
         forms_progress = {}
+        cde_index = None
 
-        for form_model in self.registry_model.forms:
+        for form_model in self.compiled_registry.form_models:
             if not form_model.is_questionnaire and self._applicable(form_model):
-                form_progress_dict = self._calculate_form_progress(form_model, dynamic_data)
+                metrics = None
+                if form_names is not None and form_model.name not in form_names:
+                    metrics = self._previous_form_metrics(form_model.name, previous)
+                if metrics is None:
+                    if cde_index is None:
+                        cde_index = CdeIndex(dynamic_data)
+                    metrics = [self._calculate_form_progress(form_model, cde_index),
+                               self._calculate_form_has_data(form_model, cde_index),
+                               self._calculate_form_cdes_status(form_model, cde_index)]
+                form_progress_dict, form_has_data, form_cdes_status = metrics
                 form_currency = self._calculate_form_currency(form_model, dynamic_data)
-                form_has_data = self._calculate_form_has_data(form_model, dynamic_data)
-                form_cdes_status = self._calculate_form_cdes_status(form_model, dynamic_data)
                 forms_progress[form_model.name] = {"progress": form_progress_dict,
                                                    "current": form_currency,
                                                    "has_data": form_has_data,
@@ -349,6 +266,7 @@ class FormProgress(object):
             result[form_name + "_form_current"] = forms_progress[form_name]["current"]
             result[form_name + "_form_has_data"] = forms_progress[form_name]["has_data"]
             result[form_name + "_form_cdes_status"] = forms_progress[form_name]["cdes_status"]
+            result[form_name + "_form_definition"] = self.compiled_registry.forms_by_name[form_name].progress_key
 
         for groups_name in groups_progress:
             result[groups_name + "_group_progress"] = groups_progress[groups_name]["percentage"]
@@ -389,8 +307,9 @@ class FormProgress(object):
             elif tag == "current":
                 return self.loaded_data.get(form_model.name + "_form_current", False)
             elif tag == "cdes_status":
-                initial_completion_status_cdes = {cde_model.name: False for cde_model
-                                                  in form_model.complete_form_cdes.all()}
+                initial_completion_status_cdes = {self.compiled_registry.cdes[code].name: False
+                                                  for code in self.progress_cdes_map.get(form_model.name, [])
+                                                  if code in self.compiled_registry.cdes}
                 return self.loaded_data.get(
                     form_model.name + "_form_cdes_status",
                     initial_completion_status_cdes)
@@ -417,6 +336,23 @@ class FormProgress(object):
     def reset(self):
         self.loaded_data = None
 
+    def load_for_patients(self, patient_ids):
+        """
+        Maps patient id -> progress data for several patients with one query.
+        Each patient gets the record _load finds without a context ( their first. )
+        """
+        loaded = {}
+        records = self.progress_collection.filter(django_model="Patient", django_id__in=patient_ids).order_by("pk")
+        for django_id, data in records.values_list("django_id", "data"):
+            loaded.setdefault(django_id, data)
+        return loaded
+
+    def use_loaded(self, patient_model, data):
+        # progress data from load_for_patients, used instead of loading it
+        self._set_current(patient_model)
+        self.context_model = None
+        self.loaded_data = data or {}
+
     def get_form_progress_dict(self, form_model, patient_model, context_model=None):
         # returns a dict of required filled percentage numbers
         return self._get_metric((form_model, "progress"), patient_model, context_model)
@@ -479,11 +415,25 @@ class FormProgress(object):
 
     #########################################################################################
     # save progress
-    def save_progress(self, patient_model, dynamic_data, context_model=None):
+    def calculate_progress(self, patient_model, dynamic_data, context_model=None, form_names=None):
+        # the progress of dynamic_data, without storing it
+        if dynamic_data:
+            previous = None
+            if form_names is not None:
+                previous = self._get_query(patient_model, context_model).data().first()
+            self._calculate(dynamic_data, patient_model, form_names=form_names, previous=previous)
+        return self.progress_data
+
+    def save_progress(self, patient_model, dynamic_data, context_model=None, form_names=None):
+        """
+        Saves the progress of dynamic_data. If form_names is given only those
+        forms have changed, the others keep their stored metrics.
+        """
         if not dynamic_data:
             return self.progress_data
-        self._calculate(dynamic_data, patient_model)
         record = self._get_query(patient_model, context_model).first()
+        previous = record.data if record is not None and form_names is not None else None
+        self._calculate(dynamic_data, patient_model, form_names=form_names, previous=previous)
         if not record:
             ctx = dict(context_id=context_model.id if context_model else None)
             context_id = context_model.id if context_model else None
@@ -493,10 +443,19 @@ class FormProgress(object):
                                          data=ctx)
         record.data.update(self.progress_data)
         record.save()
+        self._save_summary(patient_model)
         return self.progress_data
 
+    def _save_summary(self, patient_model):
+        # the patient listing sorts on the group metrics, which it only
+        # shows for registries without contexts
+        if self.compiled_registry.has_feature("contexts"):
+            return
+        from rdrf.models.progress_models import ProgressSummary
+        ProgressSummary.update(patient_model, self.registry_model, self.progress_data)
+
     # a convenience method
-    def save_for_patient(self, patient_model, context_model=None):
+    def save_for_patient(self, patient_model, context_model=None, form_names=None):
         self.reset()
         from rdrf.db.dynamic_data import DynamicDataWrapper
         if context_model is None:
@@ -505,4 +464,4 @@ class FormProgress(object):
             wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_model.pk)
         dynamic_data = wrapper.load_dynamic_data(
             self.registry_model.code, "cdes", flattened=False)
-        return self.save_progress(patient_model, dynamic_data, context_model)
+        return self.save_progress(patient_model, dynamic_data, context_model, form_names=form_names)
@@ -0,0 +1,368 @@
+"""
+In-process cache of compiled registry definitions.
+
+A CompiledRegistry is an immutable snapshot of a registry's definition
+( forms -> sections -> cdes -> permitted values, plus parsed metadata )
+built with a fixed number of queries. Compiled registries are held per
+process and dropped whenever any definition model is saved or deleted:
+the local copy is cleared immediately and a generation counter in the
+shared query cache is bumped so other processes rebuild too.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from ccg_django_utils.conf import EnvConfig
+
+logger = logging.getLogger(__name__)
+env = EnvConfig()
+
+GENERATION_KEY = "rdrf_definition_generation"
+
+
+def caching_enabled():
+    return not (settings.CACHE_DISABLED or env.get("CACHE_DISABLED", False))
+
+
+class CompiledSection:
+    def __init__(self, section_model, cde_models):
+        self.code = section_model.code
+        # the source text lets us detect in memory ( unsaved ) edits
+        self.elements = section_model.elements
+        self.section_model = section_model
+        self.cde_models = tuple(cde_models)
+        self.cde_map = {cde_model.code: cde_model for cde_model in self.cde_models}
+
+    @property
+    def allow_multiple(self):
+        return self.section_model.allow_multiple
+
+    def get_cde(self, code):
+        try:
+            return self.cde_map[code]
+        except KeyError:
+            raise KeyError("cde %s is not in section %s" % (code, self.code))
+
+
+class CompiledForm:
+    def __init__(self, form_model, compiled_sections, completion_cde_codes):
+        self.name = form_model.name
+        self.pk = form_model.pk
+        self.sections_text = form_model.sections
+        self.form_model = form_model
+        self.compiled_sections = tuple(compiled_sections)
+        self.section_models = tuple(cs.section_model for cs in self.compiled_sections)
+        self.completion_cde_codes = frozenset(completion_cde_codes)
+        # digest of the definition the form's progress metrics depend on, kept
+        # with stored metrics so they're recalculated once it changes
+        progress_definition = [self.sections_text, sorted(self.completion_cde_codes)] + [
+            [cs.code, cs.allow_multiple, [(cde.code, cde.name, cde.datatype) for cde in cs.cde_models]]
+            for cs in self.compiled_sections
+        ]
+        self.progress_key = hashlib.sha1(json.dumps(progress_definition).encode()).hexdigest()
+
+    @property
+    def is_questionnaire(self):
+        return self.form_model.is_questionnaire
+
+    def cde_triples(self):
+        for compiled_section in self.compiled_sections:
+            for cde_model in compiled_section.cde_models:
+                yield compiled_section.section_model, cde_model
+
+    def progress_cdes(self):
+        # (section_model, cde_model) pairs for the completion cdes, in form order
+        for section_model, cde_model in self.cde_triples():
+            if cde_model.code in self.completion_cde_codes:
+                yield section_model, cde_model
+
+
+class CompiledRegistry:
+    def __init__(self, registry_model, compiled_forms, compiled_sections, permitted_values):
+        self.code = registry_model.code
+        self.pk = registry_model.pk
+        self.version = registry_model.version
+        self.registry_model = registry_model
+        self.metadata = registry_model.metadata
+        self.compiled_forms = tuple(compiled_forms)
+        self.form_models = tuple(cf.form_model for cf in self.compiled_forms)
+        self.forms_by_name = {cf.name: cf for cf in self.compiled_forms}
+        self.forms_by_pk = {cf.pk: cf for cf in self.compiled_forms}
+        self.sections = dict(compiled_sections)
+        self.sections_by_pk = {cs.section_model.pk: cs for cs in self.sections.values()}
+        self.cdes = {}
+        for compiled_section in self.sections.values():
+            self.cdes.update(compiled_section.cde_map)
+        # pv group code -> tuple of CDEPermittedValue ordered by position
+        self.permitted_values = permitted_values
+
+    def has_feature(self, feature):
+        return feature in self.metadata.get("features", [])
+
+    # the lookups raise the model's DoesNotExist, as the queries they replace did
+
+    def get_form(self, form_name):
+        from rdrf.models.definition.models import RegistryForm
+        try:
+            return self.forms_by_name[form_name]
+        except KeyError:
+            raise RegistryForm.DoesNotExist("form %s is not in registry %s" % (form_name, self.code))
+
+    def get_section(self, section_code):
+        from rdrf.models.definition.models import Section
+        try:
+            return self.sections[section_code]
+        except KeyError:
+            raise Section.DoesNotExist("section %s is not in registry %s" % (section_code, self.code))
+
+    def get_cde(self, cde_code):
+        from rdrf.models.definition.models import CommonDataElement
+        try:
+            return self.cdes[cde_code]
+        except KeyError:
+            raise CommonDataElement.DoesNotExist("cde %s is not in registry %s" % (cde_code, self.code))
+
+    def cde_triples(self, include_questionnaires=True):
+        for compiled_form in self.compiled_forms:
+            if compiled_form.is_questionnaire and not include_questionnaires:
+                continue
+            for section_model, cde_model in compiled_form.cde_triples():
+                yield compiled_form.form_model, section_model, cde_model
+
+    @classmethod
+    def build(cls, registry_model):
+        from rdrf.models.definition.models import CDEPermittedValue
+        from rdrf.models.definition.models import RegistryForm
+
+        form_models = list(
+            RegistryForm.objects.filter(registry=registry_model)
+            .order_by("position")
+            .select_related("registry")
+            .prefetch_related("complete_form_cdes")
+        )
+        section_codes = set()
+        for form_model in form_models:
+            section_codes.update(form_model.get_sections())
+        if registry_model.patient_data_section_id:
+            section_codes.add(registry_model.patient_data_section.code)
+
+        compiled_sections = compile_sections(section_codes)
+
+        compiled_forms = []
+        for form_model in form_models:
+            form_sections = [
+                compiled_sections[code]
+                for code in form_model.get_sections()
+                if code in compiled_sections
+            ]
+            completion_codes = [cde.code for cde in form_model.complete_form_cdes.all()]
+            compiled_forms.append(CompiledForm(form_model, form_sections, completion_codes))
+
+        pv_group_codes = set(
+            cde_model.pv_group_id
+            for compiled_section in compiled_sections.values()
+            for cde_model in compiled_section.cde_models
+            if cde_model.pv_group_id
+        )
+        permitted_values = {code: [] for code in pv_group_codes}
+        for pv in CDEPermittedValue.objects.filter(pv_group__in=pv_group_codes).order_by("position", "pk"):
+            permitted_values[pv.pv_group_id].append(pv)
+        permitted_values = {code: tuple(values) for code, values in permitted_values.items()}
+
+        return cls(registry_model, compiled_forms, compiled_sections, permitted_values)
+
+
+class PermittedValueIndex:
+    """
+    Hash map of code -> (display value, position) for one permitted value group.
+    """
+
+    def __init__(self, group_code, permitted_values):
+        self.group_code = group_code
+        self.entries = {pv.code: (pv.value, pv.position) for pv in permitted_values}
+
+    def __contains__(self, code):
+        return code in self.entries
+
+    def display(self, code, default=None):
+        entry = self.entries.get(code)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def position(self, code):
+        entry = self.entries.get(code)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def display_many(self, codes, default=None):
+        # maps a whole column of codes in one call
+        entries = self.entries
+        return [entries[code][0] if code in entries else default for code in codes]
+
+    @classmethod
+    def build(cls, group_code):
+        from rdrf.models.definition.models import CDEPermittedValue
+        return cls(group_code, CDEPermittedValue.objects.filter(pv_group_id=group_code))
+
+
+def compile_sections(section_codes):
+    """
+    Returns a dict of section code -> CompiledSection using two queries.
+    Sections referring to missing cdes are left out: DefinitionCache.get_section
+    returns None for them so its callers fall back to the model ( which
+    reports the problem ), CompiledRegistry.get_section raises Section.DoesNotExist.
+    """
+    from rdrf.models.definition.models import CommonDataElement
+    from rdrf.models.definition.models import Section
+
+    section_models = list(Section.objects.filter(code__in=section_codes))
+    cde_codes = set()
+    for section_model in section_models:
+        cde_codes.update(section_model.get_elements())
+    cde_map = {
+        cde_model.code: cde_model
+        for cde_model in CommonDataElement.objects.filter(code__in=cde_codes).select_related("pv_group")
+    }
+    compiled = {}
+    for section_model in section_models:
+        codes = section_model.get_elements()
+        if all(code in cde_map for code in codes):
+            compiled[section_model.code] = CompiledSection(
+                section_model, [cde_map[code] for code in codes]
+            )
+    return compiled
+
+
+class DefinitionCache:
+    """
+    Process level store of compiled registries and sections.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generation = None
+        self._checked_at = 0.0
+        self._registries = {}
+        self._sections = {}
+        self._forms = {}
+        self._pv_indexes = {}
+
+    @property
+    def check_interval(self):
+        return getattr(settings, "DEFINITION_CACHE_CHECK_INTERVAL", 1)
+
+    def _shared_generation(self):
+        return caches["queries"].get(GENERATION_KEY)
+
+    def _clear(self):
+        self._registries = {}
+        self._sections = {}
+        self._forms = {}
+        self._pv_indexes = {}
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        generation = self._shared_generation()
+        if generation != self._generation:
+            self._clear()
+            self._generation = generation
+
+    def _bump_generation(self):
+        with self._lock:
+            self._clear()
+            self._checked_at = 0.0
+        query_cache = caches["queries"]
+        try:
+            query_cache.incr(GENERATION_KEY)
+        except ValueError:
+            query_cache.set(GENERATION_KEY, 1, None)
+
+    def invalidate(self):
+        # drop our own copy straight away, but only tell other processes
+        # once the definition change is committed, otherwise they could
+        # rebuild from the old rows
+        with self._lock:
+            self._clear()
+            self._checked_at = 0.0
+        if caching_enabled():
+            transaction.on_commit(self._bump_generation)
+
+    def get_registry(self, registry_model):
+        if not caching_enabled():
+            return CompiledRegistry.build(registry_model)
+        with self._lock:
+            self._check_generation()
+            compiled = self._registries.get(registry_model.pk)
+            if compiled is None or compiled.version != registry_model.version:
+                compiled = CompiledRegistry.build(registry_model)
+                self._registries[registry_model.pk] = compiled
+                self._sections.update(compiled.sections)
+                for compiled_form in compiled.compiled_forms:
+                    self._forms[compiled_form.pk] = compiled_form
+                for group_code, permitted_values in compiled.permitted_values.items():
+                    self._pv_indexes[group_code] = PermittedValueIndex(group_code, permitted_values)
+                logger.debug("compiled registry definition %s" % compiled.code)
+            return compiled
+
+    def get_form(self, form_model):
+        # returns None if caching is off or the model has unsaved changes
+        if not caching_enabled() or form_model.pk is None:
+            return None
+        with self._lock:
+            self._check_generation()
+            compiled_form = self._forms.get(form_model.pk)
+            if compiled_form is None:
+                from rdrf.models.definition.models import Registry
+                registry_model = Registry.objects.get(pk=form_model.registry_id)
+                compiled_form = self.get_registry(registry_model).forms_by_pk.get(form_model.pk)
+        if compiled_form is None or compiled_form.sections_text != form_model.sections:
+            return None
+        return compiled_form
+
+    def get_section(self, section_model):
+        # returns None if caching is off or the model has unsaved changes
+        if not caching_enabled() or section_model.pk is None:
+            return None
+        with self._lock:
+            self._check_generation()
+            compiled_section = self._sections.get(section_model.code)
+            if compiled_section is None:
+                compiled_section = compile_sections([section_model.code]).get(section_model.code)
+                if compiled_section is None:
+                    return None
+                self._sections[section_model.code] = compiled_section
+        if compiled_section.elements != section_model.elements:
+            return None
+        return compiled_section
+
+    def get_pv_index(self, group_code):
+        if not caching_enabled():
+            return PermittedValueIndex.build(group_code)
+        with self._lock:
+            self._check_generation()
+            pv_index = self._pv_indexes.get(group_code)
+            if pv_index is None:
+                pv_index = PermittedValueIndex.build(group_code)
+                self._pv_indexes[group_code] = pv_index
+            return pv_index
+
+
+definition_cache = DefinitionCache()
+
+
+def get_compiled_registry(registry_model):
+    return definition_cache.get_registry(registry_model)
+
+
+def invalidate_definition_cache():
+    definition_cache.invalidate()
@@ -0,0 +1,154 @@
+"""
+Deferred work after a clinical form save.
+
+With settings.USE_CELERY and settings.FORM_SAVE_TASKS set, the work derived
+from a form save ( the clinical_data_saved_ok receivers and storing the
+form progress ) runs in a celery task rather than in the request.
+Jobs are keyed by (patient, context): sections saved while a job is
+waiting are merged into it and only the last task scheduled for a key
+does the work, so a burst of saves is processed once. The pending work of
+a key is read and written under a redis lock, so concurrent saves and tasks
+can't lose each other's updates.
+"""
+import contextlib
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+# how long unprocessed work is kept if the worker is down
+PENDING_TIMEOUT = 3600
+# how long the pending work of a key may be held ( and waited for )
+LOCK_TIMEOUT = 10
+
+
+def deferred_enabled():
+    return settings.USE_CELERY and settings.FORM_SAVE_TASKS
+
+
+def _pending_key(patient_id, context_id):
+    return "form_save_pending_%s_%s" % (patient_id, context_id)
+
+
+def _locked(cache, key):
+    # django_redis caches have lock(); the local memory cache used in
+    # development is per process anyway
+    if not hasattr(cache, "lock"):
+        return contextlib.nullcontext()
+    return cache.lock("%s_lock" % key, timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_TIMEOUT)
+
+
+def schedule(registry_code, patient_id, context_id, form_id, section_codes, user_id=None):
+    """
+    Queues the work for a form save. Returns False, queueing nothing, if the
+    pending work can't be locked in time; the caller then does the work.
+    """
+    from rdrf.services.tasks import process_form_saves
+
+    cache = caches["redis"]
+    key = _pending_key(patient_id, context_id)
+    token = uuid.uuid4().hex
+    try:
+        with _locked(cache, key):
+            pending = cache.get(key) or {"registry_code": registry_code, "sections": {}}
+            # json task args ( and cached values ) want string keys
+            saved_sections = pending["sections"].setdefault(str(form_id), [])
+            for section_code in section_codes:
+                if section_code not in saved_sections:
+                    saved_sections.append(section_code)
+            # the snapshot of a form is credited to its last editor
+            pending.setdefault("snapshot_users", {})[str(form_id)] = user_id
+            pending["token"] = token
+            cache.set(key, pending, PENDING_TIMEOUT)
+    except LockError as ex:
+        logger.warning("form save work for patient %s context %s done in the request: %s"
+                       % (patient_id, context_id, ex))
+        return False
+    transaction.on_commit(lambda: process_form_saves.apply_async(args=[patient_id, context_id, token],
+                                                                 countdown=settings.FORM_SAVE_TASK_DELAY))
+    return True
+
+
+def take(patient_id, context_id, token):
+    """
+    Returns ( and removes ) the work pending for the patient context, or None
+    if a later save has scheduled another task to do it.
+    """
+    cache = caches["redis"]
+    key = _pending_key(patient_id, context_id)
+    with _locked(cache, key):
+        pending = cache.get(key)
+        if pending is None or pending["token"] != token:
+            return None
+        cache.delete(key)
+    return pending
+
+
+def run(registry_code, patient_id, context_id, sections, snapshot_users=None):
+    """
+    Does the derived work for a patient context.
+    sections maps form id -> codes of the sections saved on that form and
+    snapshot_users form id -> id of the user whose save is snapshotted.
+    """
+    from rdrf.custom_signals import clinical_data_saved_ok
+    from rdrf.db.dynamic_data import DynamicDataWrapper
+    from rdrf.forms.progress.form_progress import FormProgress
+    from rdrf.helpers.compiled_registry import get_compiled_registry
+    from rdrf.models.definition.models import ClinicalData, RDRFContext, Registry
+    from rdrf.views.form_view import SectionInfo
+    from registry.groups.models import CustomUser
+    from registry.patients.models import Patient
+
+    patient_model = Patient.objects.filter(pk=patient_id).first()
+    context_model = RDRFContext.objects.filter(pk=context_id).first()
+    if patient_model is None or context_model is None:
+        logger.info("form save work for patient %s context %s dropped as it no longer exists" % (patient_id,
+                                                                                                 context_id))
+        return
+    registry_model = Registry.objects.get(code=registry_code)
+    compiled_registry = get_compiled_registry(registry_model)
+
+    def compiled_form_of(form_id):
+        compiled_form = compiled_registry.forms_by_pk.get(int(form_id))
+        if compiled_form is None:
+            logger.info("form save work for form %s dropped as it no longer exists" % form_id)
+        return compiled_form
+
+    form_names = []
+    for form_id, section_codes in sections.items():
+        compiled_form = compiled_form_of(form_id)
+        if compiled_form is None:
+            continue
+        form_names.append(compiled_form.name)
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+        wrapper.current_form_model = compiled_form.form_model
+        compiled_sections = {cs.code: cs for cs in compiled_form.compiled_sections}
+        section_infos = [SectionInfo(section_code,
+                                     wrapper,
+                                     compiled_sections[section_code].allow_multiple,
+                                     registry_code,
+                                     "cdes",
+                                     {},
+                                     form_name=compiled_form.name)
+                         for section_code in section_codes if section_code in compiled_sections]
+        if section_infos:
+            clinical_data_saved_ok.send(sender=ClinicalData, patient=patient_model, saved_sections=section_infos)
+
+    # the snapshots are taken once the record has been recalculated
+    snapshot_users = snapshot_users or {}
+    users = CustomUser.objects.in_bulk([user_id for user_id in snapshot_users.values() if user_id is not None])
+    for form_id, user_id in snapshot_users.items():
+        compiled_form = compiled_form_of(form_id)
+        if compiled_form is None:
+            continue
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+        wrapper.user = users.get(user_id)
+        wrapper.save_snapshot(registry_code, "cdes", form_name=compiled_form.name,
+                              form_user=wrapper.user.username if wrapper.user else None)
+
+    FormProgress(registry_model).save_for_patient(patient_model, context_model, form_names=form_names)
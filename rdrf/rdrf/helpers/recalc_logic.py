@@ -1,17 +1,103 @@
 from registry.patients.models import Patient
 from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import RegistryForm
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.views.form_view import SectionInfo
 from rdrf.services.tasks import recalculate_cde
-from rdrf.helpers.utils import get_location
-from rdrf.helpers.utils import is_calculated_cde_in_registry as in_registry
+from rdrf.helpers.compiled_registry import get_compiled_registry
 from rdrf.forms.fields import calculated_functions as cf
 import logging
+import weakref
 
 logger = logging.getLogger(__name__)
 
 
+class CalculationGraph:
+    """
+    Dependency graph of a registry's calculated fields.
+    Edges run from each input cde to the calculated cdes ( outputs ) using it,
+    as declared by the <output>_inputs functions in calculated_functions.
+    """
+
+    def __init__(self, compiled_registry):
+        self.reverse_map = {}
+        self.locations = {}
+        for form_model, section_model, cde_model in compiled_registry.cde_triples():
+            if cde_model.datatype == "calculated":
+                self.locations.setdefault(cde_model.code, (form_model, section_model))
+
+        for name, thing in cf.__dict__.items():
+            if callable(thing) and name.endswith("_inputs"):
+                output_cde_code = name.replace("_inputs", "")
+                if output_cde_code not in self.locations:
+                    continue
+                for input_cde_code in thing():
+                    self.reverse_map.setdefault(input_cde_code, []).append(output_cde_code)
+
+        self.levels = self._compute_levels()
+
+    def _compute_levels(self):
+        # level 0 outputs depend on no other output, level n on outputs below n
+        inputs_of = {output_cde_code: set() for output_cde_code in self.locations}
+        for input_cde_code, output_cde_codes in self.reverse_map.items():
+            if input_cde_code in inputs_of:
+                for output_cde_code in output_cde_codes:
+                    inputs_of[output_cde_code].add(input_cde_code)
+
+        levels = {}
+        remaining = dict(inputs_of)
+        level = 0
+        while remaining:
+            ready = [code for code, inputs in remaining.items() if not (inputs & set(remaining))]
+            if not ready:
+                logger.warning("calculated fields depend on each other in a cycle: %s" % sorted(remaining))
+                ready = list(remaining)
+            for code in ready:
+                levels[code] = level
+                del remaining[code]
+            level += 1
+        return levels
+
+    def affected_outputs(self, input_cde_codes):
+        """
+        The outputs depending directly or transitively on the given cdes,
+        in an order where every output comes after the outputs it uses.
+        """
+        affected = set()
+        pending = list(input_cde_codes)
+        while pending:
+            for output_cde_code in self.reverse_map.get(pending.pop(), []):
+                if output_cde_code not in affected:
+                    affected.add(output_cde_code)
+                    pending.append(output_cde_code)
+        return sorted(affected, key=lambda code: (self.levels[code], code))
+
+    def level(self, output_cde_code):
+        return self.levels.get(output_cde_code, 0)
+
+    def form_outputs(self, form_name):
+        """
+        The outputs on the given form, in an order where every output comes
+        after the outputs it uses.
+        """
+        outputs = [code for code, (form_model, section_model) in self.locations.items()
+                   if form_model.name == form_name]
+        return sorted(outputs, key=lambda code: (self.levels[code], code))
+
+
+_graphs = weakref.WeakKeyDictionary()
+
+
+def get_calculation_graph(registry: Registry) -> CalculationGraph:
+    # one graph per compiled definition, so it is rebuilt whenever the
+    # definition changes
+    compiled_registry = get_compiled_registry(registry)
+    graph = _graphs.get(compiled_registry)
+    if graph is None:
+        graph = CalculationGraph(compiled_registry)
+        _graphs[compiled_registry] = graph
+    return graph
+
+
 def get_calcs_reverse_map(registry: Registry) -> dict:
     """
     Discover relevant calculations and work out
@@ -19,48 +105,24 @@ def get_calcs_reverse_map(registry: Registry) -> dict:
     map so we can quickly workout which calculated
     fields (outputs) need to be recalculated.
     """
-    reverse_map = {}
-    for name, thing in cf.__dict__.items():
-        if callable(thing) and name.endswith("_inputs"):
-            output_cde_code = name.replace("_inputs", "")
-            try:
-                output_cde_model = CommonDataElement.objects.get(code=output_cde_code)
-            except CommonDataElement.DoesNotExist:
-                continue
-            except CommonDataElement.MultipleObjectsReturned:
-                continue
-            if output_cde_model.datatype != "calculated":
-                continue
-            if not in_registry(output_cde_model, registry):
-                continue
-
-            inputs_func = thing
-            input_cde_codes = inputs_func()
-            for input_cde_code in input_cde_codes:
-                if input_cde_code in reverse_map:
-                    reverse_map[input_cde_code].append(output_cde_code)
-                else:
-                    reverse_map[input_cde_code] = [output_cde_code]
-    return reverse_map
+    return get_calculation_graph(registry).reverse_map
 
 
 class Recalculator:
     def __init__(self, registry: Registry, patient: Patient):
         self.registry = registry
         self.patient = patient
-        self.inputs_map: dict = get_calcs_reverse_map(self.registry)
+        self.graph = get_calculation_graph(self.registry)
+        self.inputs_map: dict = self.graph.reverse_map
 
     def check_recalc(self, section_info: SectionInfo):
         section_form: RegistryForm = section_info.patient_wrapper.current_form_model
-        recalc_needed = set([])
-        for cde_model in section_info.cde_models:
-            if cde_model.code in self.inputs_map:
-                for output_cde_code in self.inputs_map[cde_model.code]:
-                    if self._on_different_form(output_cde_code, section_form):
-                        recalc_needed.add(output_cde_code)
-
-        for output_cde_code in recalc_needed:
-            self._recalc(output_cde_code, section_info)
+        input_cde_codes = [cde_model.code for cde_model in section_info.cde_models]
+        # outputs on the saved form are calculated in the browser; the rest
+        # are recalculated here, each after any output it depends on
+        for output_cde_code in self.graph.affected_outputs(input_cde_codes):
+            if self._on_different_form(output_cde_code, section_form):
+                self._recalc(output_cde_code, section_info)
 
     def _on_different_form(self, cde_code, section_form: RegistryForm):
         for section_model in section_form.section_models:
@@ -70,8 +132,7 @@ class Recalculator:
         return True
 
     def _recalc(self, output_cde_code, section_info: SectionInfo):
-        calc_cde: CommonDataElement = CommonDataElement.objects.get(code=output_cde_code)
-        form_model, section_model = get_location(self.registry, calc_cde)
+        form_model, section_model = self.graph.locations[output_cde_code]
         context_id = section_info.patient_wrapper.rdrf_context_id
         section_index = 0
 
@@ -87,4 +148,4 @@ class Recalculator:
              form_model.name,
              section_model.code,
              section_index,
-             calc_cde.code)
+             output_cde_code)
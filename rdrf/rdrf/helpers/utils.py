@@ -8,6 +8,7 @@ from django.urls import reverse
 from django.db import IntegrityError
 from django.db import transaction
 from django.utils.html import strip_tags
+from copy import deepcopy
 from functools import total_ordering
 
 from django.core.management import call_command
@@ -220,6 +221,15 @@ def get_cached_instance(klass, *args, **kwargs):
     return klass.objects.get(*args, **kwargs)
 
 
+def id_ranges(ids, parts):
+    """
+    Splits sorted ids into at most parts contiguous (first id, last id) ranges
+    of roughly equal size, for handing out to worker processes.
+    """
+    size = max(1, -(-len(ids) // parts))
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+
 def is_multisection(code):
     try:
         from rdrf.models.definition.models import Section
@@ -383,12 +393,11 @@ def timed(func):
 
 
 def get_cde_value2(form_name, section_code, cde_code, patient_record):
-    from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
-
-    form_model = RegistryForm.objects.get(name=form_name)
-    section_model = Section.objects.get(code=section_code)
-    cde_model = CommonDataElement.objects.get(code=cde_code)
-    return get_cde_value(form_model, section_model, cde_model, patient_record)
+    # as get_cde_value, by name and codes
+    from rdrf.db.dynamic_data import CdeIndex
+    if patient_record is None:
+        return None
+    return CdeIndex(patient_record).value(form_name, section_code, cde_code)
 
 
 def get_cde_value(form_model, section_model, cde_model, patient_record):
@@ -627,9 +636,41 @@ class TimeStripper(object):
 
 
 class HistoryTimeStripper(TimeStripper):
+    """
+    History embeds the full forms dictionary in the record key.
+    Delta encoded snapshots are decoded, munged and encoded again against
+    their base.
+    """
+
+    def __init__(self, dataset):
+        from rdrf.db.history import SnapshotDecoder
+        super().__init__(dataset)
+        # decodes the rows as they were stored, before any munging
+        self.decoder = SnapshotDecoder()
+        self.pk = None
+
+    def update(self, m):
+        self.pk = m.pk
+        super().update(m)
+
     def munge_data(self, data):
-        # History embeds the full forms dictionary in the record key
-        return super().munge_data(data["record"])
+        from rdrf.db.history import delta_data, is_delta
+
+        snapshot = self.decoder.decode(self.pk, deepcopy(data))
+        if not is_delta(data):
+            if "record" not in data:
+                return False
+            return super().munge_data(data["record"])
+
+        # decoded records share their containers with their base
+        record = deepcopy(snapshot["record"])
+        if not super().munge_data(record):
+            return False
+        snapshot["record"] = record
+        encoded = delta_data(snapshot, data["base"], data["depth"], self.decoder.record(data["base"]))
+        data.clear()
+        data.update(encoded)
+        return True
 
 
 # Python 3.5 doesn't raises run time error when lists which contain None values are sorted
@@ -755,6 +796,41 @@ def consent_check(registry_model, user_model, patient_model, capability):
     return True
 
 
+def consent_checked_patients(registry_model, user_model, patient_models, capability):
+    """
+    The ids of the patients passing consent_check, found with a fixed number
+    of queries however many patients there are.
+    """
+    from rdrf.models.definition.models import ConsentRule
+    from registry.patients.models import ConsentValue
+
+    patient_ids = {patient_model.pk for patient_model in patient_models}
+    if user_model.is_superuser:
+        return patient_ids
+    consent_rules = list(ConsentRule.objects.filter(registry=registry_model,
+                                                    capability=capability,
+                                                    user_group__in=user_model.groups.all(),
+                                                    enabled=True).select_related("consent_question__section"))
+    if not consent_rules:
+        return patient_ids
+
+    answers = {}
+    consent_values = ConsentValue.objects.filter(patient__in=patient_ids,
+                                                 consent_question__in=[rule.consent_question_id for rule in consent_rules])
+    for patient_id, question_id, answer in consent_values.values_list("patient_id", "consent_question_id", "answer"):
+        answers[(patient_id, question_id)] = answer
+
+    passed = set()
+    for patient_model in patient_models:
+        # as get_consent, questions of registries the patient isn't in aren't answered
+        registry_ids = {r.pk for r in patient_model.rdrf_registry.all()}
+        if all(rule.consent_question.section.registry_id in registry_ids
+               and answers.get((patient_model.pk, rule.consent_question_id), False)
+               for rule in consent_rules):
+            passed.add(patient_model.pk)
+    return passed
+
+
 def get_full_path(registry_model, cde_code):
     """
     Return triple of form name, section code and cde code for a unique code
@@ -1200,6 +1276,14 @@ def get_display_value(cde_code, raw_value):
     return cde_model.get_display_value(raw_value)
 
 
+def get_display_values(cde_code, raw_values):
+    # maps a column of raw values to display values in one call
+    from rdrf.models.definition.models import CommonDataElement
+
+    cde_model = CommonDataElement.objects.get(code=cde_code)
+    return cde_model.get_display_values(raw_values)
+
+
 def custom_text(registry_model, key, default):
     metadata = registry_model.metadata
     if "custom_text" in metadata:
@@ -0,0 +1,32 @@
+import sys
+import time
+
+from django.core.management import BaseCommand
+from rdrf.models.definition.models import Registry
+from rdrf.reports.generator import Generator
+
+
+class Command(BaseCommand):
+    """
+    (re)-build the reporting database tables for a registry
+    """
+    help = "Builds the reporting database tables for a registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("registry_code")
+        parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="Number of processes extracting clinical data")
+        parser.add_argument("--db", default="reporting", choices=["reporting", "clinical", "default"],
+                            help="Database the tables are built in")
+
+    def handle(self, registry_code, **options):
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            self.stderr.write("Error: Unknown registry code: %s" % registry_code)
+            sys.exit(1)
+
+        started = time.monotonic()
+        generator = Generator(registry_model, db=options["db"])
+        generator.create_tables(workers=options["workers"])
+        self.stdout.write("Reporting tables for %s built in %.1fs" % (registry_code, time.monotonic() - started))
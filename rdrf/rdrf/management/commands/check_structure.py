@@ -2,6 +2,7 @@ import sys
 from django.core.management import BaseCommand
 from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import ClinicalData
+from rdrf.db.history import SnapshotDecoder
 import yaml
 import jsonschema
 import errno
@@ -49,9 +50,13 @@ class Command(BaseCommand):
         if collection == "registry_specific":
             collection = "registry_specific_patient_data"
 
+        # delta encoded history is checked as the snapshots it rebuilds
+        decoder = SnapshotDecoder()
         for modjgo_model in ClinicalData.objects.filter(registry_code=registry_code,
-                                                        collection=collection):
+                                                        collection=collection).order_by("pk"):
             data = modjgo_model.data
+            if collection == "history":
+                data = decoder.decode(modjgo_model.pk, data)
             problem = self._check_for_problem(collection, data)
             if problem is not None:
                 problem_count += 1
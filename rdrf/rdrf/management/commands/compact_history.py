@@ -0,0 +1,59 @@
+import sys
+from itertools import groupby
+from operator import itemgetter
+
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from rdrf.db.history import encode_chain
+from rdrf.models.definition.models import ClinicalData, Registry
+
+
+class Command(BaseCommand):
+    """
+    Converts stored history snapshots to delta encoding ( see rdrf.db.history )
+    """
+    help = "Delta encodes the history collection, or expands it back to full snapshots"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--registry-code', action='append', dest='registry_codes', default=[],
+                            help='Registry code ( may be repeated, defaults to all registries )')
+        parser.add_argument('--expand', action='store_true', default=False,
+                            help='Store every snapshot in full again')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Patients converted per transaction')
+
+    def handle(self, *args, **options):
+        registries = Registry.objects.all()
+        if options['registry_codes']:
+            registries = registries.filter(code__in=options['registry_codes'])
+            missing = set(options['registry_codes']) - set(registries.values_list('code', flat=True))
+            if missing:
+                self.stderr.write("Registry not found: %s" % ", ".join(sorted(missing)))
+                sys.exit(1)
+
+        for registry_model in registries:
+            history = ClinicalData.objects.collection(registry_model.code, "history").filter(
+                data__record_type="snapshot")
+            ids = sorted(set(history.values_list('django_id', flat=True)))
+            rows = updated = 0
+            for start in range(0, len(ids), options['batch_size']):
+                batch_rows, batch_updated = self.convert(history.filter(django_id__in=ids[start:start + options['batch_size']]),
+                                                         options['expand'])
+                rows += batch_rows
+                updated += batch_updated
+            self.stdout.write("%s: %s snapshots, %s rewritten" % (registry_model.code, rows, updated))
+
+    def convert(self, history, expand):
+        chain_key = itemgetter(0, 1, 2)
+        rows = updated = 0
+        with transaction.atomic(using=router.db_for_write(ClinicalData)):
+            stored = (history.select_for_update()
+                      .order_by('django_model', 'django_id', 'context_id', 'pk')
+                      .values_list('django_model', 'django_id', 'context_id', 'pk', 'data'))
+            for _, chain in groupby(stored, key=chain_key):
+                chain = [(pk, data) for _, _, _, pk, data in chain]
+                rows += len(chain)
+                changed = [ClinicalData(pk=pk, data=data) for pk, data in encode_chain(chain, expand=expand)]
+                ClinicalData.objects.bulk_update(changed, ['data'])
+                updated += len(changed)
+        return rows, updated
@@ -1,8 +1,23 @@
+import sys
+import time
+from multiprocessing import Pool
+
 from django.core.management import BaseCommand
+from django.db import connections
+from rdrf.helpers.utils import id_ranges
 from rdrf.models.definition.models import Registry
 from registry.patients.models import Patient
-from explorer.models import FieldValue
-from explorer.utils import create_field_values
+from explorer.utils import FieldValueLoader
+
+
+def load_partition(args):
+    # runs in a worker process
+    registry_code, id_range, chunk_size, batch_size = args
+    registry_model = Registry.objects.get(code=registry_code)
+    loader = FieldValueLoader(registry_model, chunk_size=chunk_size, batch_size=batch_size)
+    # each partition is replaced in its own transaction, so the other
+    # partitions keep their rows until they're rebuilt
+    return loader.rebuild(id_range)
 
 
 class Command(BaseCommand):
@@ -11,12 +26,66 @@ class Command(BaseCommand):
     """
     help = "Creates field values for reporting"
 
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--registry-code', action='append', dest='registry_codes', default=[],
+                            help='Registry code ( may be repeated, defaults to all registries )')
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='Number of worker processes per registry')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Clinical data records fetched per round trip')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Field value rows per insert')
+
     def handle(self, *args, **options):
-        for registry_model in Registry.objects.all():
-            FieldValue.objects.filter(registry=registry_model).delete()
-            for patient_model in Patient.objects.filter(rdrf_registry__in=[registry_model]):
-                for context_model in patient_model.context_models:
-                    if context_model.registry.code == registry_model.code:
-                        create_field_values(registry_model,
-                                            patient_model,
-                                            context_model)
+        registries = Registry.objects.all()
+        if options['registry_codes']:
+            registries = registries.filter(code__in=options['registry_codes'])
+            missing = set(options['registry_codes']) - set(registries.values_list('code', flat=True))
+            if missing:
+                self.stderr.write("Registry not found: %s" % ", ".join(sorted(missing)))
+                sys.exit(1)
+
+        for registry_model in registries:
+            self.started = time.monotonic()
+            if options['workers'] > 1:
+                records, rows = self.rebuild_parallel(registry_model, options)
+            else:
+                loader = FieldValueLoader(registry_model,
+                                          chunk_size=options['chunk_size'],
+                                          batch_size=options['batch_size'],
+                                          progress=self.progress_writer(registry_model))
+                records, rows = loader.rebuild()
+            self.report(registry_model, records, rows, done=True)
+
+    def rebuild_parallel(self, registry_model, options):
+        patient_ids = list(Patient.objects.filter(rdrf_registry=registry_model)
+                           .order_by('pk').values_list('pk', flat=True))
+        # more partitions than workers so a slow range doesn't hold up the rest
+        tasks = [(registry_model.code, id_range, options['chunk_size'], options['batch_size'])
+                 for id_range in id_ranges(patient_ids, options['workers'] * 4)]
+
+        # forked workers must not share the parent's connections
+        connections.close_all()
+        records = rows = 0
+        with Pool(options['workers']) as pool:
+            for partition_records, partition_rows in pool.imap_unordered(load_partition, tasks):
+                records += partition_records
+                rows += partition_rows
+                self.report(registry_model, records, rows)
+        FieldValueLoader(registry_model).delete_others()
+        return records, rows
+
+    def progress_writer(self, registry_model):
+        def progress(records, rows):
+            self.report(registry_model, records, rows)
+        return progress
+
+    def report(self, registry_model, records, rows, done=False):
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        self.stdout.write("%s %s: %s records, %s rows in %.1fs ( %d rows/s )" % (
+            registry_model.code,
+            "done" if done else "progress",
+            records,
+            rows,
+            elapsed,
+            rows / elapsed))
@@ -140,12 +140,10 @@ class Command(BaseCommand):
             )
 
         # Retrieve bad codes from ClinicalData.
-        clinicaldatas = ClinicalData.objects.all()
-        for clinicaldata in clinicaldatas:
-            if clinicaldata.collection == "history":
-                bad_codes = self.get_bad_codes_from_collection(
-                    clinicaldata.data, form_names, section_codes, cde_codes, bad_codes
-                )
+        for snapshot in ClinicalData.objects.filter(collection="history").snapshots():
+            bad_codes = self.get_bad_codes_from_collection(
+                snapshot, form_names, section_codes, cde_codes, bad_codes
+            )
 
         return bad_codes
 
@@ -1,25 +1,59 @@
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 from dashboards.models import VisualisationBaseDataConfig
-from dashboards.data import RegistryDataFrame
+from dashboards.aggregates import CohortAggregates
+from dashboards.data import RegistryDataFrame, save_base_data, save_cohort_aggregates
 from datetime import datetime
 
 
 class Command(BaseCommand):
     help = "Generate Visualisation Dataframe JSON"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            default=False,
+            help="Regenerate from all patients instead of those whose data changed",
+        )
+
     def print(self, msg):
         t = datetime.now()
         self.stdout.write(f"{t} visualisation base data config: {msg}" + "\n")
 
     def handle(self, *args, **options):
         for config in VisualisationBaseDataConfig.objects.all():
-            self.print(f"generating json data for {config.registry.code}")
-            rdf = RegistryDataFrame(config.registry, config, None, force_reload=True)
-            if rdf.data is not None:
+            # data saved while generating is picked up by the next run
+            started = timezone.now()
+            changed_since = None
+            if config.state == "D" and not options["full"]:
+                changed_since = config.data_as_of
+
+            if changed_since is None:
+                self.print(f"generating json data for {config.registry.code}")
+            else:
+                self.print(f"updating json data for {config.registry.code}")
+            rdf = RegistryDataFrame(
+                config.registry,
+                config,
+                None,
+                force_reload=True,
+                changed_since=changed_since,
+            )
+            if not rdf.changed:
+                config.data_as_of = started
+                config.source_state = rdf.source_state
+                config.save(update_fields=["data_as_of", "source_state"])
+                self.print("no changes")
+            elif rdf.data is not None:
                 json_data = rdf.data.to_json()
                 config.data = json_data
                 config.state = "D"
+                config.data_as_of = started
+                config.source_state = rdf.source_state
                 config.save()
+                save_base_data(config, rdf.data)
+                save_cohort_aggregates(config, CohortAggregates.compute(config, rdf.data))
                 self.print("saved OK")
             else:
                 self.print("no data to load")
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from rdrf.helpers.compiled_registry import invalidate_definition_cache
 from rdrf.services.io.defs.importer import Importer
 
 
@@ -35,3 +36,4 @@ class Command(BaseCommand):
 
             with transaction.atomic():
                 importer.create_registry()
+            invalidate_definition_cache()
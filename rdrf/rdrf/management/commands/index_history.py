@@ -0,0 +1,68 @@
+import sys
+from itertools import groupby
+from operator import itemgetter
+
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from rdrf.db.history import SnapshotDecoder
+from rdrf.models.definition.models import ClinicalData, Registry
+from rdrf.models.history_models import CdeHistory
+
+
+class Command(BaseCommand):
+    """
+    (re)-builds the cde history index from the history collection
+    """
+    help = "Rebuilds the cde history index used by the form field history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--registry-code', action='append', dest='registry_codes', default=[],
+                            help='Registry code ( may be repeated, defaults to all registries )')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Patients indexed per transaction')
+
+    def handle(self, *args, **options):
+        registries = Registry.objects.all()
+        if options['registry_codes']:
+            registries = registries.filter(code__in=options['registry_codes'])
+            missing = set(options['registry_codes']) - set(registries.values_list('code', flat=True))
+            if missing:
+                self.stderr.write("Registry not found: %s" % ", ".join(sorted(missing)))
+                sys.exit(1)
+
+        for registry_model in registries:
+            history = ClinicalData.objects.collection(registry_model.code, "history").filter(
+                data__record_type="snapshot")
+            ids = sorted(set(history.values_list('django_id', flat=True)))
+            snapshots = entries = 0
+            for start in range(0, len(ids), options['batch_size']):
+                batch_ids = ids[start:start + options['batch_size']]
+                batch_snapshots, batch_entries = self.index(registry_model, history.filter(django_id__in=batch_ids), batch_ids)
+                snapshots += batch_snapshots
+                entries += batch_entries
+            self.stdout.write("%s: %s snapshots, %s index entries" % (registry_model.code, snapshots, entries))
+
+    def index(self, registry_model, history, ids):
+        chain_key = itemgetter(0, 1, 2)
+        snapshots = entries = 0
+        with transaction.atomic(using=router.db_for_write(CdeHistory)):
+            CdeHistory.objects.filter(registry_code=registry_model.code, django_id__in=ids).delete()
+            stored = (history.order_by('django_model', 'django_id', 'context_id', 'pk')
+                      .values_list('django_model', 'django_id', 'context_id', 'pk', 'data'))
+            for _, chain in groupby(stored, key=chain_key):
+                decoder = SnapshotDecoder()
+                previous_record = None
+                new_entries = []
+                for django_model, django_id, context_id, pk, data in chain:
+                    snapshot = decoder.decode(pk, data)
+                    history_model = ClinicalData(pk=pk,
+                                                 registry_code=registry_model.code,
+                                                 django_model=django_model,
+                                                 django_id=django_id,
+                                                 context_id=context_id)
+                    new_entries.extend(CdeHistory.entries(history_model, snapshot, previous_record))
+                    previous_record = snapshot["record"]
+                    snapshots += 1
+                CdeHistory.objects.bulk_create(new_entries, batch_size=2000)
+                entries += len(new_entries)
+        return snapshots, entries
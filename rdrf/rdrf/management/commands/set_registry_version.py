@@ -1,5 +1,6 @@
 import sys
 from django.core.management import BaseCommand
+from rdrf.helpers.compiled_registry import invalidate_definition_cache
 from rdrf.models.definition.models import Registry
 
 
@@ -34,3 +35,4 @@ class Command(BaseCommand):
         if registry is not None:
             registry.version = version
             registry.save()
+            invalidate_definition_cache()
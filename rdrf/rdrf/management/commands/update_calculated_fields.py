@@ -1,9 +1,16 @@
 import time
+from itertools import groupby
 from datetime import datetime
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from rdrf.models.definition.models import ClinicalData, CommonDataElement, RegistryForm, Section, RDRFContext, ContextFormGroupItem
+from django.db import connections
+from multiprocessing import Pool
+from rdrf.helpers.compiled_registry import get_compiled_registry
+from rdrf.helpers.recalc_logic import get_calculation_graph
+from rdrf.models.definition.models import ClinicalData, CommonDataElement, Registry, RDRFContext, ContextFormGroupItem
 from registry.patients.models import Patient, DynamicDataWrapper
+from rdrf.db.dynamic_data import build_form_data
+from rdrf.forms.progress.form_progress import FormProgress
 from rdrf.helpers.utils import catch_and_log_exceptions
 
 # do not display debug information for the node js call.
@@ -34,6 +41,9 @@ class Command(BaseCommand):
         parser.add_argument('--cde_code', action='append', type=str,
                             help='Only calculate the fields for a specific CDE')
 
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to spread the patients over')
+
         # Test command line example
         # django-admin update_calculated_fields --patient_id=2 --registry_code=fh --form_name=ClinicalData --section_code=SEC0007 --context_id=2 --cde_code=CDEfhDutchLipidClinicNetwork
 
@@ -77,72 +87,172 @@ class Command(BaseCommand):
             # For all patient.
             patient_models = Patient.objects.all()
 
-        for patient_model in patient_models:
-
-            # For all registry for this patient.
-            for registry_model in patient_model.rdrf_registry.all():
-                # If the registry has at least one calculated field.
-                if registry_model.code in cde_models_tree:
-                    # For each form having at least one calculated field.
-                    for form_name in cde_models_tree[registry_model.code]:
-                        # For each context ids related to the patient / registry / form.
-                        # We keep this call when the context id is passed as command argument for sanity check purpose
-                        context_ids = context_ids_for_patient_and_form(patient_model, form_name, registry_model)
-                        for context_id in context_ids:
-                            if not options['context_id'] or context_id in options['context_id']:
-                                changed_calculated_cdes = {}
-                                # Get the existing cde values from the currently processed form.
-                                form_cde_values = get_form_cde_values(patient_model, context_id, registry_model, form_name,
-                                                                      cde_models_tree)
-                                # If the form does not exist, then no need to process this form.
-                                if form_cde_values:
-                                    # context_var - it is the context variable of the js code (not to be confused with the RDRF context model).
-                                    context_var = build_context_var(patient_model, context_id, registry_model, form_name,
-                                                                    cde_models_tree, calculated_cde_models)
-
-                                    # For each section of the form (we only do that because we need to know the section_code when calling set_form_value)
-                                    for section_code in cde_models_tree[registry_model.code][form_name].keys():
-                                        # For each calculated cdes in this section, do a WS call to the node server evaluation the js code.
-                                        for calculated_cde_model in calculated_cde_models:
-                                            if calculated_cde_model.code in context_var.keys() and calculated_cde_model.code in \
-                                                    cde_models_tree[registry_model.code][form_name][section_code].keys():
-
-                                                new_calculated_cde_value = calculate_cde(patient_model, registry_model.code, form_cde_values, calculated_cde_model)
-
-                                                # if the result is a new value, then store in a temp var so we can update the form at its context level.
-                                                if context_var[calculated_cde_model.code] != new_calculated_cde_value:
-                                                    if patient_model.id not in modified_patients:
-                                                        modified_patients.append(patient_model.id)
-                                                    changed_calculated_cdes[calculated_cde_model.code] = \
-                                                        {"old_value": context_var[calculated_cde_model.code],
-                                                         "new_value": new_calculated_cde_value,
-                                                         "section_code": section_code}
-
-                                    save_new_calculation(changed_calculated_cdes, context_id, form_name, patient_model,
-                                                         registry_model)
+        if options['workers'] > 1:
+            patient_ids = list(patient_models.order_by('pk').values_list('pk', flat=True))
+            # more chunks than workers so a slow chunk doesn't hold up the rest
+            size = max(1, -(-len(patient_ids) // (options['workers'] * 4)))
+            worker_options = {key: options[key] for key in FILTER_OPTIONS}
+            calculated_cde_codes = [calculated_cde_model.code for calculated_cde_model in calculated_cde_models]
+            tasks = [(patient_ids[i:i + size], worker_options, calculated_cde_codes)
+                     for i in range(0, len(patient_ids), size)]
+            # forked workers must not share the parent's connections
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                for modified_patient_ids in pool.imap_unordered(update_patients, tasks):
+                    modified_patients.extend(modified_patient_ids)
+        else:
+            for patient_model in patient_models:
+                if update_patient(patient_model, options, cde_models_tree, calculated_cde_models):
+                    modified_patients.append(patient_model.id)
 
         end = time.time()
-        self.stdout.write(self.style.SUCCESS(f"Script ended in {end - start} seconds."))
-
-        # Rerun the calculation when a patient value that were changed.
-        for modified_patient_id in modified_patients:
-            patient_option = options.copy()
-            # little security to avoid unexpected buggy loop.
-            # Do not run additional recalculation if ever we have been doing more than 10 times for the same patient.
-            modified_patient_model = Patient.objects.get(id=modified_patient_id)
-            if 'recalculate_step' not in patient_option.keys() or patient_option['recalculate_step'] < 10:
-                patient_option['patient_id'] = [modified_patient_id]
-                # calculate new step value
-                if 'recalculate_step' not in patient_option.keys():
-                    step = 1
-                else:
-                    step = patient_option['recalculate_step'] + 1
-                patient_option['recalculate_step'] = step
-                logger.info(f"[RECALCULATING] we are recalculating the patient {getattr(modified_patient_model, settings.LOG_PATIENT_FIELDNAME)} - recalculation number: {step} ")
-                self.handle(**patient_option)
-            else:
-                logger.error(f"[LIKELY A BUG] We tried to recalculate the patient {getattr(modified_patient_model, settings.LOG_PATIENT_FIELDNAME)} more the 10 times. "
-                             f"We stopped this patient calculated field update.")
+        self.stdout.write(self.style.SUCCESS(f"Script ended in {end - start} seconds. "
+                                             f"{len(modified_patients)} patients updated."))
+
+
+# the options which select what is recalculated
+FILTER_OPTIONS = ('patient_id', 'registry_code', 'context_id', 'form_name', 'section_code', 'cde_code')
+
+
+def update_patients(args):
+    # runs in a worker process
+    patient_ids, options, calculated_cde_codes = args
+    calculated_cde_models = list(CommonDataElement.objects.filter(code__in=calculated_cde_codes))
+    # the options have already been checked so no command is needed for errors
+    cde_models_tree = build_cde_models_tree(calculated_cde_models, options, None)
+    return [patient_model.id for patient_model in Patient.objects.filter(id__in=patient_ids)
+            if update_patient(patient_model, options, cde_models_tree, calculated_cde_models)]
+
+
+def update_patient(patient_model, options, cde_models_tree, calculated_cde_models):
+    modified = False
+    # For all registry for this patient.
+    for registry_model in patient_model.rdrf_registry.all():
+        # If the registry has at least one calculated field.
+        if registry_model.code in cde_models_tree:
+            graph = get_calculation_graph(registry_model)
+            # The calculated cdes to evaluate in each context of the patient,
+            # as (form_name, section_code, calculated_cde_model)
+            context_calculations = {}
+            # For each form having at least one calculated field.
+            for form_name in cde_models_tree[registry_model.code]:
+                # For each context ids related to the patient / registry / form.
+                # We keep this call when the context id is passed as command argument for sanity check purpose
+                context_ids = context_ids_for_patient_and_form(patient_model, form_name, registry_model)
+                for context_id in context_ids:
+                    if not options['context_id'] or context_id in options['context_id']:
+                        # For each section of the form (we only do that because we need to know the section_code when saving)
+                        for section_code in cde_models_tree[registry_model.code][form_name].keys():
+                            for calculated_cde_model in calculated_cde_models:
+                                if calculated_cde_model.code in cde_models_tree[registry_model.code][form_name][section_code].keys():
+                                    context_calculations.setdefault(context_id, []).append(
+                                        (form_name, section_code, calculated_cde_model))
+
+            for context_id, calculations in context_calculations.items():
+                if update_context(patient_model, context_id, registry_model, calculations, graph,
+                                  cde_models_tree, calculated_cde_models):
+                    modified = True
+    return modified
+
+
+def update_context(patient_model, context_id, registry_model, calculations, graph, cde_models_tree, calculated_cde_models):
+    """
+    Evaluates the calculated cdes of one patient context in dependency order
+    against the context's cdes document, which is loaded once.
+    The new values of a level of the graph are written back before the next
+    level is evaluated, as calculations across forms read the stored document.
+    Most registries have a single level so that is a single save, followed
+    by one snapshot and one form progress update.
+    Returns True if any value changed.
+    """
+    collection = ClinicalData.objects.collection(registry_model.code, "cdes")
+    record = collection.find(patient_model, context_id).data().first()
+    if not record:
+        return False
+    flattened_data = build_form_data(record)
+    forms = {form_dict["name"]: form_dict for form_dict in record.get("forms", [])}
+    compiled_sections = get_compiled_registry(registry_model).sections
+    context_vars = {}
+    changed_forms = []
+
+    calculations = sorted(calculations, key=lambda calculation: graph.level(calculation[2].code))
+    for level, level_calculations in groupby(calculations, key=lambda calculation: graph.level(calculation[2].code)):
+        level_changes = {}
+        for form_name, section_code, calculated_cde_model in level_calculations:
+            form_cde_values = forms.get(form_name)
+            # If the form does not exist, then no need to process this form.
+            if not form_cde_values:
+                continue
+            if form_name not in context_vars:
+                # context_var - it is the context variable of the js code (not to be confused with the RDRF context model).
+                context_vars[form_name] = build_context_var(patient_model, context_id, registry_model, form_name,
+                                                            cde_models_tree, calculated_cde_models, flattened_data)
+            context_var = context_vars[form_name]
+            if calculated_cde_model.code not in context_var.keys():
+                continue
+
+            new_calculated_cde_value = calculate_cde(patient_model, registry_model.code, form_cde_values,
+                                                     calculated_cde_model)
+
+            if context_var[calculated_cde_model.code] != new_calculated_cde_value:
+                # later levels on this form see the new value
+                compiled_section = compiled_sections.get(section_code)
+                allow_multiple = compiled_section is not None and compiled_section.allow_multiple
+                if not set_form_cde_value(form_cde_values, section_code, calculated_cde_model.code,
+                                          new_calculated_cde_value, allow_multiple):
+                    continue
+                level_changes[calculated_cde_model.code] = {"old_value": context_var[calculated_cde_model.code],
+                                                            "new_value": new_calculated_cde_value,
+                                                            "form_name": form_name}
+                if form_name not in changed_forms:
+                    changed_forms.append(form_name)
+
+        if level_changes:
+            logger.info(f"UPDATING DB: These are the new values of the context {level_changes} - registry: {registry_model.code} - patient: {getattr(patient_model, settings.LOG_PATIENT_FIELDNAME)} - context: {context_id}")
+            save_record(patient_model, context_id, registry_model, record, changed_forms)
+
+    if changed_forms:
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+        wrapper.user = ScriptUser()
+        wrapper.save_snapshot(registry_model.code, "cdes", form_name=changed_forms[-1], form_user=ScriptUser.username)
+        FormProgress(registry_model).save_for_patient(patient_model, RDRFContext.objects.get(id=context_id),
+                                                      form_names=changed_forms)
+    return bool(changed_forms)
+
+
+def save_record(patient_model, context_id, registry_model, record, changed_forms):
+    # write the whole document back in one save
+    now = datetime.now()
+    record["timestamp"] = now
+    for form_name in changed_forms:
+        record["%s_timestamp" % form_name] = now
+    record.setdefault("context_id", context_id)
+    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+    wrapper.user = ScriptUser()
+    wrapper.update_dynamic_data(registry_model, record)
+
+
+def set_form_cde_value(form_cde_values, section_code, cde_code, value, allow_multiple=False):
+    """
+    Sets a cde value in a form of the cdes document.
+    Returns False, leaving the form alone, for a multisection: calculated
+    values aren't saved in multisections, as set_form_value skipped them.
+    """
+    sections = [section for section in form_cde_values["sections"] if section["code"] == section_code]
+    if allow_multiple or any(section.get("allow_multiple") for section in sections):
+        logger.info(f"Calculated field {cde_code} in multisection {section_code} not updated")
+        return False
+    if not sections:
+        form_cde_values["sections"].append({"code": section_code,
+                                            "allow_multiple": False,
+                                            "cdes": [{"code": cde_code, "value": value}]})
+        return True
+    for cde in sections[0]["cdes"]:
+        if cde["code"] == cde_code:
+            cde["value"] = value
+            return True
+    sections[0]["cdes"].append({"code": cde_code, "value": value})
+    return True
 
 
 def calculate_cde(patient_model, registry_code, form_cde_values, calculated_cde_model):
@@ -165,28 +275,9 @@ def calculate_cde(patient_model, registry_code, form_cde_values, calculated_cde_
         raise Exception(f"Trying to call unknown calculated function {calculated_cde_model.code}()")
 
 
-def save_new_calculation(changed_calculated_cdes, context_id, form_name, patient_model, registry_model):
-    # save the new form values in the ClinicalData model only when we have one values
-    context_model = RDRFContext.objects.get(id=context_id)
-    if changed_calculated_cdes:
-        logger.info(f"UPDATING DB: These are the new value of the form/context {changed_calculated_cdes} - registry: {registry_model.code} - patient: {getattr(patient_model, settings.LOG_PATIENT_FIELDNAME)} - form: {form_name} - context: {context_id}")
-        for changed_calculated_cde_code in changed_calculated_cdes.keys():
-            patient_model.set_form_value(registry_code=registry_model.code,
-                                         form_name=form_name,
-                                         section_code=changed_calculated_cdes[changed_calculated_cde_code][
-                                             'section_code'],
-                                         data_element_code=changed_calculated_cde_code,
-                                         value=changed_calculated_cdes[changed_calculated_cde_code]['new_value'],
-                                         save_snapshot=list(changed_calculated_cdes.keys())[
-                                             -1] == changed_calculated_cde_code,
-                                         user=ScriptUser(),
-                                         context_model=context_model,
-                                         skip_bad_key=True)
-
-
 def context_ids_for_patient_and_form(patient_model, form_name, registry_model):
     # Retrieve the context ids related to the patient / registry / form.
-    form_model = RegistryForm.objects.get(name=form_name, registry=registry_model)
+    form_model = get_compiled_registry(registry_model).get_form(form_name).form_model
     form_group_items_models = ContextFormGroupItem.objects.filter(registry_form=form_model)
     context_models = RDRFContext.objects.filter(registry=registry_model,
                                                 object_id=patient_model.id,
@@ -202,23 +293,14 @@ def context_ids_for_patient_and_form(patient_model, form_name, registry_model):
     return context_ids
 
 
-def get_form_cde_values(patient_model, context_id, registry_model, form_name, cde_models_tree):
-    collection = ClinicalData.objects.collection(registry_model.code, "cdes")
-    data = collection.find(patient_model, context_id).data()
-    if data:
-        forms = data.first()
-        for form in forms["forms"]:
-            if form["name"] == form_name:
-                return form
-    return None
-
-
-def build_context_var(patient_model, context_id, registry_model, form_name, cde_models_tree, calculated_cde_models):
+def build_context_var(patient_model, context_id, registry_model, form_name, cde_models_tree, calculated_cde_models,
+                      data=None):
     context_var = {}
     calculated_cde_codes = [calculated_cde_model.code for calculated_cde_model in calculated_cde_models]
-    # Retrieve the clinical_data for this registry / patient / context.
-    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
-    data = wrapper.load_dynamic_data(registry_model.code, "cdes")
+    if data is None:
+        # Retrieve the clinical_data for this registry / patient / context.
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+        data = wrapper.load_dynamic_data(registry_model.code, "cdes")
     # For each section of the form
     for section_model in cde_models_tree[registry_model.code][form_name]:
         # For each cdes in a form section
@@ -250,66 +332,35 @@ def build_context_var(patient_model, context_id, registry_model, form_name, cde_
 def build_cde_models_tree(calculated_cde_models, options, command):
     # The cde models in a tree format for easy access
     # Format: {..., registry.code:{..., form.name:{..., section.code:{..., cde.code:cde.model}}}}
+    # The definitions come from the compiled registries so no per cde queries are needed.
     cde_models_tree = {}
-
-    # Cache the cde models we are retrieving so we load them from the DB only one time.
-    cde_models_caching = {}
-
-    if options['form_name']:
-        if not options['registry_code']:
-            command.stdout.write(
-                command.style.ERROR("You must provide a registry_code when providing a form_name"))
-            exit(1)
-        form_models = RegistryForm.objects.filter(name__in=options['form_name'])
-    else:
-        form_models = RegistryForm.objects.all()
-    for form_model in form_models:
-        # if a registry_code argument was passed, only reference form that are in this registry.
-        if not options['registry_code'] or form_model.registry.code in options['registry_code']:
-
-            section_models = Section.objects.filter(code__in=form_model.get_sections())
+    calculated_cde_codes = set(calculated_cde_model.code for calculated_cde_model in calculated_cde_models)
+
+    if options['form_name'] and not options['registry_code']:
+        command.stdout.write(
+            command.style.ERROR("You must provide a registry_code when providing a form_name"))
+        exit(1)
+
+    registry_models = Registry.objects.all()
+    # if a registry_code argument was passed, only reference forms that are in this registry.
+    if options['registry_code']:
+        registry_models = registry_models.filter(code__in=options['registry_code'])
+
+    for registry_model in registry_models:
+        compiled_registry = get_compiled_registry(registry_model)
+        for compiled_form in compiled_registry.compiled_forms:
+            if options['form_name'] and compiled_form.name not in options['form_name']:
+                continue
+            compiled_sections = compiled_form.compiled_sections
             # Retrieve the form cde models only if at least one section has a calculated field.
             # and if a section_code argument was passed, only reference cdes from the form containing this section.
-            if any(calculated_cde_model.code in section.get_elements() for calculated_cde_model in calculated_cde_models
-                   for section in section_models) and (not options['section_code'] or any(section.code in options['section_code']
-                                                                                          for section in section_models)):
-
-                for section_model in section_models:
-                    for cde_code in section_model.get_elements():
-                        # Check if we already retrieved some cde models for this section.
-                        if cde_models_tree \
-                                and form_model.registry.code in cde_models_tree \
-                                and form_model.name in cde_models_tree[form_model.registry.code] \
-                                and section_model.code in cde_models_tree[form_model.registry.code][
-                                    form_model.name]:
-                            built_cdes = cde_models_tree[form_model.registry.code][form_model.name][
-                                section_model.code]
-                        else:
-                            built_cdes = {}
-                        # Check if we already retrieved some cde models for this form.
-                        if cde_models_tree \
-                                and form_model.registry.code in cde_models_tree \
-                                and form_model.name in cde_models_tree[form_model.registry.code]:
-                            built_sections = cde_models_tree[form_model.registry.code][form_model.name]
-                        else:
-                            built_sections = {}
-                        # Check if we already retrieved some cde models for this registry.
-                        if cde_models_tree \
-                                and form_model.registry.code in cde_models_tree:
-                            built_forms = cde_models_tree[form_model.registry.code]
-                        else:
-                            built_forms = {}
-                        # Cache the cde models so we don't retrieve twice the same cde model from the DB.
-                        if cde_code in cde_models_caching.keys():
-                            cde_model = cde_models_caching[cde_code]
-                        else:
-                            cde_model = CommonDataElement.objects.get(code=cde_code)
-                            cde_models_caching[cde_code] = cde_model
-                        # Add the cde model to the dictionary.
-                        cde_models_tree = {**cde_models_tree,
-                                           form_model.registry.code: {**built_forms,
-                                                                      form_model.name: {**built_sections,
-                                                                                        section_model.code: {
-                                                                                            **built_cdes,
-                                                                                            cde_code: cde_model}}}}
+            has_calculated_cde = any(cde_code in calculated_cde_codes
+                                     for compiled_section in compiled_sections
+                                     for cde_code in compiled_section.cde_map)
+            has_section = not options['section_code'] or any(
+                compiled_section.code in options['section_code'] for compiled_section in compiled_sections)
+            if has_calculated_cde and has_section:
+                registry_tree = cde_models_tree.setdefault(registry_model.code, {})
+                registry_tree[compiled_form.name] = {compiled_section.code: dict(compiled_section.cde_map)
+                                                     for compiled_section in compiled_sections}
     return cde_models_tree
@@ -0,0 +1,90 @@
+# Generated by Django 3.2.15 on 2026-10-18 10:00
+
+import json
+
+from django.db import connections, migrations, models
+import django.db.models.deletion
+
+METRICS = (("_group_progress", "progress"),
+           ("_group_current", "current"),
+           ("_group_has_data", "has_data"))
+
+
+def backfill_progress_summaries(apps, schema_editor):
+    # copies the group metrics of the existing progress records, as
+    # ProgressSummary.update does when progress is saved
+    if "clinical" not in connections or \
+            "rdrf_clinicaldata" not in connections["clinical"].introspection.table_names():
+        return
+    Registry = apps.get_model("rdrf", "Registry")
+    ClinicalData = apps.get_model("rdrf", "ClinicalData")
+    ProgressSummary = apps.get_model("rdrf", "ProgressSummary")
+    Patient = apps.get_model("patients", "Patient")
+    for registry in Registry.objects.all():
+        try:
+            features = json.loads(registry.metadata_json or "{}").get("features", [])
+        except ValueError:
+            features = []
+        if "contexts" in features:
+            continue
+        records = ClinicalData.objects.using("clinical").filter(collection="progress",
+                                                                registry_code=registry.code,
+                                                                django_model="Patient")
+        summaries = {}
+        for django_id, data in records.order_by("pk").values_list("django_id", "data").iterator():
+            if django_id in summaries:
+                # the listing shows the first record of a patient
+                continue
+            groups = {}
+            for key, value in (data or {}).items():
+                for suffix, field in METRICS:
+                    if key.endswith(suffix):
+                        groups.setdefault(key[:-len(suffix)], {})[field] = value
+            summaries[django_id] = groups
+        # progress can outlive its patient
+        patient_ids = set(Patient.objects.filter(pk__in=list(summaries)).values_list("pk", flat=True))
+        ProgressSummary.objects.bulk_create([
+            ProgressSummary(patient_id=patient_id, registry=registry, group=group, **values)
+            for patient_id, groups in summaries.items() if patient_id in patient_ids
+            for group, values in groups.items()
+        ], batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0040_auto_20211108_1429'),
+        ('rdrf', '0145_auto_20220914_1523'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProgressSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=80)),
+                ('progress', models.IntegerField(null=True)),
+                ('current', models.BooleanField(null=True)),
+                ('has_data', models.BooleanField(null=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='progress_summaries', to='patients.patient')),
+                ('registry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rdrf.registry')),
+            ],
+            options={
+                'unique_together': {('patient', 'registry', 'group')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='progresssummary',
+            index=models.Index(fields=['registry', 'group', 'progress'], name='rdrf_progsum_progress_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='progresssummary',
+            index=models.Index(fields=['registry', 'group', 'current'], name='rdrf_progsum_current_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='progresssummary',
+            index=models.Index(fields=['registry', 'group', 'has_data'], name='rdrf_progsum_has_data_idx'),
+        ),
+        migrations.RunPython(backfill_progress_summaries, migrations.RunPython.noop,
+                             hints={'model_name': 'progresssummary'}),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.15 on 2026-10-18 12:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0146_progresssummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CdeHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('django_model', models.CharField(default='Patient', max_length=80)),
+                ('django_id', models.IntegerField()),
+                ('context_id', models.IntegerField(null=True)),
+                ('form_name', models.CharField(max_length=80)),
+                ('section_code', models.CharField(max_length=100)),
+                ('cde_code', models.CharField(max_length=30)),
+                ('timestamp', models.DateTimeField()),
+                ('value', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('username', models.CharField(max_length=254, null=True)),
+                ('snapshot_id', models.IntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cdehistory',
+            index=models.Index(fields=['django_model', 'django_id', 'context_id', 'registry_code', 'form_name', 'section_code', 'cde_code', 'timestamp'], name='rdrf_cdehistory_field_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the clinical data table is large, so build the indexes without locking it
+    atomic = False
+
+    dependencies = [
+        ('rdrf', '0147_cdehistory'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='clinicaldata',
+            index=models.Index(fields=['registry_code', 'collection', 'django_model', 'django_id', 'context_id'], name='rdrf_clinicaldata_record_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='clinicaldata',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['data'], name='rdrf_clinicaldata_data_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.15 on 2026-10-18 16:00
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the clinical data table is large, so build the index without locking it
+    atomic = False
+
+    dependencies = [
+        ('rdrf', '0148_clinicaldata_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinicaldata',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='clinicaldata',
+            index=models.Index(fields=['collection', 'updated'], name='rdrf_clinicaldata_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:00
+
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import migrations
+
+FIELDS = ("registry_code", "django_model", "django_id", "context_id", "form_name", "section_code",
+          "cde_code", "timestamp", "value", "username", "snapshot_id")
+
+
+def backfill_cde_history(apps, schema_editor):
+    # indexes the history saved before the index existed, as the
+    # index_history command does
+    from rdrf.db.history import SnapshotDecoder
+    from rdrf.models.history_models import CdeHistory as IndexedCdeHistory
+
+    db_alias = schema_editor.connection.alias
+    ClinicalData = apps.get_model("rdrf", "ClinicalData")
+    CdeHistory = apps.get_model("rdrf", "CdeHistory")
+    CdeHistory.objects.using(db_alias).all().delete()
+    stored = (ClinicalData.objects.using(db_alias)
+              .filter(collection="history", data__record_type="snapshot")
+              .order_by("registry_code", "django_model", "django_id", "context_id", "pk")
+              .values_list("registry_code", "django_model", "django_id", "context_id", "pk", "data"))
+    for _, chain in groupby(stored.iterator(), key=itemgetter(0, 1, 2, 3)):
+        decoder = SnapshotDecoder()
+        previous_record = None
+        new_entries = []
+        for registry_code, django_model, django_id, context_id, pk, data in chain:
+            snapshot = decoder.decode(pk, data)
+            history_model = ClinicalData(pk=pk,
+                                         registry_code=registry_code,
+                                         django_model=django_model,
+                                         django_id=django_id,
+                                         context_id=context_id)
+            new_entries.extend(CdeHistory(**{field: getattr(entry, field) for field in FIELDS})
+                               for entry in IndexedCdeHistory.entries(history_model, snapshot, previous_record))
+            previous_record = snapshot["record"]
+        CdeHistory.objects.using(db_alias).bulk_create(new_entries, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0149_clinicaldata_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_cde_history, migrations.RunPython.noop,
+                             hints={'model_name': 'cdehistory'}),
+    ]
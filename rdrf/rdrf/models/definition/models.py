@@ -22,14 +22,16 @@ from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.urls import reverse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch.dispatcher import receiver
 from django.forms.models import model_to_dict
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.core.exceptions import PermissionDenied
 
-from rdrf.helpers.cache_utils import use_query_cache
+from rdrf.helpers.compiled_registry import caching_enabled, definition_cache
 from rdrf.helpers.utils import (
     format_date,
     parse_iso_datetime,
@@ -94,8 +96,10 @@ class Section(models.Model):
         return [code.strip() for code in self.elements.split(",")]
 
     @property
-    @use_query_cache
     def cde_models(self):
+        compiled_section = definition_cache.get_section(self)
+        if compiled_section is not None:
+            return list(compiled_section.cde_models)
         codes = self.get_elements()
         qs = CommonDataElement.objects.filter(code__in=codes)
         cdes = {cde.code: cde for cde in qs}
@@ -534,8 +538,9 @@ class Registry(models.Model):
         return dict(obj_id=self.id, name=self.name, code=self.code)
 
     @property
-    @use_query_cache
     def forms(self):
+        if caching_enabled() and self.pk is not None:
+            return list(definition_cache.get_registry(self).form_models)
         return [
             f for f in RegistryForm.objects.filter(registry=self).order_by("position")
         ]
@@ -602,6 +607,7 @@ class Registry(models.Model):
             for cfg in ContextFormGroup.objects.filter(registry=self, context_type="F")
             .order_by("is_default")
             .order_by("name")
+            .prefetch_related("items__registry_form")
         ]
 
     @property
@@ -610,7 +616,9 @@ class Registry(models.Model):
             cfg
             for cfg in ContextFormGroup.objects.filter(
                 registry=self, context_type="M"
-            ).order_by("name")
+            )
+            .order_by("name")
+            .prefetch_related("items__registry_form")
         ]
 
     def _check_metadata(self):
@@ -872,6 +880,12 @@ class CommonDataElement(models.Model):
             )
             return ""
 
+    @property
+    def pv_index(self):
+        # code -> display value map for the permitted value group ( None if not a range )
+        if self.pv_group_id:
+            return definition_cache.get_pv_index(self.pv_group_id)
+
     def get_display_value(self, stored_value):
         if stored_value is None:
             return ""
@@ -880,31 +894,21 @@ class CommonDataElement(models.Model):
             return ":NaN"
         elif self.widget_name == "DataSourceSelect" and self.widget_config:
             return self._get_display_value_datasource(stored_value)
-        elif self.pv_group and not self.allow_multiple:
+        elif self.pv_group_id and not self.allow_multiple:
             # if a range, return the display value
             try:
-                values_dict = self.pv_group.as_dict()
-                for value_dict in values_dict["values"]:
-                    if value_dict["code"] == stored_value:
-                        display_value = value_dict["value"]
-                        return display_value
-
+                pv_index = self.pv_index
+                if stored_value in pv_index:
+                    return pv_index.display(stored_value)
             except Exception as ex:
                 logger.error(
                     "bad value for cde %s %s: %s" % (self.code, stored_value, ex)
                 )
-        elif self.pv_group and self.allow_multiple:
-            display_values = []
-            values_dict = self.pv_group.as_dict()
-            for raw_value in stored_value:
-                logger.debug(f"testing {raw_value}")
-                for value_dict in values_dict["values"]:
-                    if value_dict["code"] == raw_value:
-                        logger.debug(
-                            f"display value for {raw_value} = {value_dict['value']}"
-                        )
-                        display_values.append(value_dict["value"])
-            return "+".join(display_values)
+        elif self.pv_group_id and self.allow_multiple:
+            pv_index = self.pv_index
+            return "+".join(
+                [pv_index.display(raw_value) for raw_value in stored_value if raw_value in pv_index]
+            )
 
         elif self.datatype.lower() == "date":
             try:
@@ -918,6 +922,38 @@ class CommonDataElement(models.Model):
 
         return stored_value
 
+    def get_display_values(self, stored_values):
+        """
+        Batch version of get_display_value: maps a column of stored values
+        to display values resolving the permitted value group ( or dropdown
+        lookups ) once for the whole column.
+        """
+        stored_values = list(stored_values)
+        if self.widget_name == "DataSourceSelect" and self.widget_config:
+            tag = json.loads(self.widget_config)["tag"]
+            keys = set(v for v in stored_values if isinstance(v, str) and v != "NaN")
+            labels = {}
+            for value, label in DropdownLookup.objects.filter(tag=tag, value__in=keys).values_list("value", "label"):
+                # multiple values are reported by get_display_value
+                labels[value] = "" if value in labels else label
+            return [
+                labels[v] if isinstance(v, str) and v in labels else self.get_display_value(v)
+                for v in stored_values
+            ]
+        if self.pv_group_id and not self.allow_multiple:
+            pv_index = self.pv_index
+            display_values = []
+            for stored_value in stored_values:
+                try:
+                    if stored_value in pv_index:
+                        display_values.append(pv_index.display(stored_value))
+                        continue
+                except TypeError:
+                    pass
+                display_values.append(self.get_display_value(stored_value))
+            return display_values
+        return [self.get_display_value(stored_value) for stored_value in stored_values]
+
     def clean(self):
         """
         TO BE DELETED
@@ -1279,8 +1315,10 @@ class RegistryForm(models.Model):
         )
 
     @property
-    @use_query_cache
     def section_models(self):
+        compiled_form = definition_cache.get_form(self)
+        if compiled_form is not None:
+            return list(compiled_form.section_models)
         models = []
         for section_code in self.get_sections():
             try:
@@ -2187,6 +2225,9 @@ class ClinicalDataQuerySet(models.QuerySet):
         qs = self.filter(registry_code=registry_code, collection=collection)
         return qs.order_by("pk")
 
+    # find() keys kept in columns as well as in the document
+    COLUMN_KEYS = ("django_id", "django_model", "context_id")
+
     def find(self, obj=None, context_id=None, **query):
         q = {}
         if obj is not None:
@@ -2194,13 +2235,46 @@ class ClinicalDataQuerySet(models.QuerySet):
             q["django_model"] = obj.__class__.__name__
         if context_id is not None:
             q["context_id"] = context_id
+        contains = {}
         for attr, value in query.items():
-            q["data__" + attr] = value
+            if attr in self.COLUMN_KEYS:
+                q[attr] = value
+            elif "__" not in attr and isinstance(value, (str, int, float, bool)):
+                # containment ( data @> {...} ) is served by the gin index on data
+                contains[attr] = value
+            else:
+                q["data__" + attr] = value
+        if contains:
+            q["data__contains"] = contains
         return self.filter(**q)
 
     def data(self):
         return self.values_list("data", flat=True)
 
+    # bulk writes bypass auto_now, so they set updated themselves for
+    # generate_visualisation_dataframe to see the records changed
+    def update(self, **kwargs):
+        kwargs.setdefault("updated", timezone.now())
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if "updated" not in fields:
+            objs = list(objs)
+            now = timezone.now()
+            for obj in objs:
+                obj.updated = now
+            fields = list(fields) + ["updated"]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def snapshots(self):
+        # history data in pk order with delta encoded snapshots rebuilt in full
+        from rdrf.db.history import SnapshotDecoder
+        decoder = SnapshotDecoder()
+        for pk, data in self.order_by("pk").values_list("pk", "data"):
+            yield decoder.decode(pk, data)
+
 
 class ClinicalData(models.Model):
     COLLECTIONS = (
@@ -2220,9 +2294,22 @@ class ClinicalData(models.Model):
         default=True, help_text="Indicate whether an entity is active or not"
     )
     metadata = models.TextField(blank=True, null=True)
+    # null for records last saved before it was added
+    updated = models.DateTimeField(auto_now=True, null=True)
 
     objects = ClinicalDataQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            # the lookups of a patient's records in a collection
+            models.Index(fields=["registry_code", "collection", "django_model", "django_id", "context_id"],
+                         name="rdrf_clinicaldata_record_idx"),
+            # find() and cde queries ( see rdrf.db.cde_query )
+            GinIndex(fields=["data"], opclasses=["jsonb_path_ops"], name="rdrf_clinicaldata_data_gin"),
+            # the records changed since a time ( see generate_visualisation_dataframe )
+            models.Index(fields=["collection", "updated"], name="rdrf_clinicaldata_updated_idx"),
+        ]
+
     @classmethod
     def create(cls, obj, **kwargs):
         self = cls(**kwargs)
@@ -2269,18 +2356,24 @@ class ClinicalData(models.Model):
         self.metadata = json.dumps(metadata)
         self.save()
 
+    @property
+    def cde_index(self):
+        """
+        CdeIndex of the data, kept until the data is replaced or saved
+        """
+        from rdrf.db.dynamic_data import CdeIndex
+        cde_index = getattr(self, "_cde_index", None)
+        if cde_index is None or cde_index.data is not self.data:
+            cde_index = self._cde_index = CdeIndex(self.data)
+        return cde_index
+
     def cde_val(self, form_name, section_code, cde_code):
-        forms = self.data.get("forms", [])
-        form_map = {f.get("name"): f for f in forms}
-        sections = form_map.get(form_name, {}).get("sections", [])
-        section_map = {s.get("code"): s for s in sections}
-        cdes = section_map.get(section_code, {}).get("cdes", [])
-        cde_map = {c.get("code"): c for c in cdes}
-        return cde_map.get(cde_code, {}).get("value")
+        return self.cde_index.value(form_name, section_code, cde_code)
 
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+        self._cde_index = None
 
     def clean(self):
         self._clean_registry_code()
@@ -2338,6 +2431,24 @@ class ClinicalData(models.Model):
             return "normal"  # no associated form group
 
 
+def definition_changed(sender, **kwargs):
+    definition_cache.invalidate()
+
+
+for definition_model in [
+    Registry,
+    RegistryForm,
+    Section,
+    CommonDataElement,
+    CDEPermittedValueGroup,
+    CDEPermittedValue,
+]:
+    post_save.connect(definition_changed, sender=definition_model)
+    post_delete.connect(definition_changed, sender=definition_model)
+
+m2m_changed.connect(definition_changed, sender=RegistryForm.complete_form_cdes.through)
+
+
 @receiver(clinical_data_saved_ok, sender=ClinicalData)
 def sync_patient_identifiers(sender, **kwargs):
     from rdrf.helpers.blackboard_utils import setup_message_router_subscription
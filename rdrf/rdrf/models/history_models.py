@@ -0,0 +1,83 @@
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+
+def snapshot_timestamp(snapshot):
+    timestamp = snapshot["timestamp"]
+    try:
+        return datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        return datetime.datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S")
+
+
+def snapshot_values(record):
+    """
+    (form name, section code, cde code) -> value of the cde in a snapshot
+    record, as get_cde_value gives it: a list of the item values for a
+    multisection.
+    """
+    from rdrf.db.dynamic_data import CdeIndex
+    cde_index = CdeIndex(record)
+    return {key: cde_index.value(*key) for key in cde_index.cde_dicts}
+
+
+class CdeHistory(models.Model):
+    """
+    Index of the history collection with a row for each snapshot which changed
+    the value of a cde in a patient context, so the history of one field is
+    a single range query instead of decoding every snapshot of the patient.
+    Written with each snapshot; history saved before the index existed is
+    indexed by a data migration and the index_history command rebuilds it.
+    Kept in the clinical database next to the history it indexes.
+    """
+    registry_code = models.CharField(max_length=10)
+    django_model = models.CharField(max_length=80, default="Patient")
+    django_id = models.IntegerField()
+    context_id = models.IntegerField(null=True)
+    form_name = models.CharField(max_length=80)
+    section_code = models.CharField(max_length=100)
+    cde_code = models.CharField(max_length=30)
+    timestamp = models.DateTimeField()
+    value = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    username = models.CharField(max_length=254, null=True)
+    # pk of the history row
+    snapshot_id = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["django_model", "django_id", "context_id", "registry_code",
+                                 "form_name", "section_code", "cde_code", "timestamp"],
+                         name="rdrf_cdehistory_field_idx"),
+        ]
+
+    @classmethod
+    def entries(cls, history_model, snapshot, previous_record=None):
+        """
+        Unsaved rows for the cde values of snapshot ( saved as history_model )
+        which differ from those of the previous snapshot record of its chain.
+        """
+        values = snapshot_values(snapshot["record"])
+        previous_values = snapshot_values(previous_record) if previous_record is not None else {}
+        changed = {key: value for key, value in values.items()
+                   if key not in previous_values or previous_values[key] != value}
+        for key in previous_values.keys() - values.keys():
+            # removed, the value is now as get_cde_value gives it
+            value = [] if isinstance(previous_values[key], list) else None
+            if previous_values[key] != value:
+                changed[key] = value
+
+        timestamp = snapshot_timestamp(snapshot)
+        return [cls(registry_code=history_model.registry_code,
+                    django_model=history_model.django_model,
+                    django_id=history_model.django_id,
+                    context_id=history_model.context_id,
+                    form_name=form_name,
+                    section_code=section_code,
+                    cde_code=cde_code,
+                    timestamp=timestamp,
+                    value=value,
+                    username=snapshot.get("username"),
+                    snapshot_id=history_model.pk)
+                for (form_name, section_code, cde_code), value in changed.items()]
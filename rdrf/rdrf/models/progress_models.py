@@ -0,0 +1,42 @@
+from django.db import models
+from rdrf.models.definition.models import Registry
+from registry.patients.models import Patient
+
+
+class ProgressSummary(models.Model):
+    """
+    Copy of a patient's group progress metrics ( kept in the progress records
+    of the clinical database ) so the patient listing can sort on them in SQL.
+    Written whenever the progress of a registry without contexts is saved.
+    """
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="progress_summaries")
+    registry = models.ForeignKey(Registry, on_delete=models.CASCADE)
+    group = models.CharField(max_length=80)
+    progress = models.IntegerField(null=True)
+    current = models.BooleanField(null=True)
+    has_data = models.BooleanField(null=True)
+
+    METRICS = (("_group_progress", "progress"),
+               ("_group_current", "current"),
+               ("_group_has_data", "has_data"))
+
+    class Meta:
+        unique_together = ("patient", "registry", "group")
+        indexes = [
+            models.Index(fields=["registry", "group", "progress"], name="rdrf_progsum_progress_idx"),
+            models.Index(fields=["registry", "group", "current"], name="rdrf_progsum_current_idx"),
+            models.Index(fields=["registry", "group", "has_data"], name="rdrf_progsum_has_data_idx"),
+        ]
+
+    @classmethod
+    def update(cls, patient_model, registry_model, progress_data):
+        groups = {}
+        for key, value in progress_data.items():
+            for suffix, field in cls.METRICS:
+                if key.endswith(suffix):
+                    groups.setdefault(key[:-len(suffix)], {})[field] = value
+        for group, values in groups.items():
+            cls.objects.update_or_create(patient=patient_model,
+                                         registry=registry_model,
+                                         group=group,
+                                         defaults=values)
@@ -1,19 +1,23 @@
+from multiprocessing import Pool
 import sqlalchemy as alc
 from sqlalchemy import create_engine, MetaData
 from django.conf import settings
+from django.db import connections
 from rdrf.models.definition.models import ContextFormGroup
 from rdrf.models.definition.models import CommonDataElement
 from rdrf.models.definition.models import ClinicalData
-from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.models.definition.models import RDRFContext
+from rdrf.models.definition.models import Registry
+from rdrf.db.dynamic_data import DynamicDataWrapper, build_form_data
 from rdrf.forms.progress.form_progress import FormProgress
-from rdrf.helpers.utils import cached
+from rdrf.helpers.utils import cached, id_ranges
+from rdrf.services.io.reporting.loader import RowLoader, stream_rows
 from registry.patients.models import Patient
 import logging
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
 import re
 from functools import lru_cache
-from operator import attrgetter
 
 logger = logging.getLogger(__name__)
 
@@ -135,6 +139,53 @@ def get_nested_clinical_data(registry_code, patient_id, context_id):
     return wrapper.load_dynamic_data(registry_code, "cdes", flattened=False)
 
 
+@lru_cache(maxsize=100)
+def get_form_users(registry_code, patient_id):
+    """
+    (context id, form name) -> the last user to save the form, from one
+    pass over the patient's history
+    """
+    history = ClinicalData.objects.collection(registry_code, "history")
+    snapshots = history.filter(django_model="Patient",
+                               django_id=patient_id,
+                               data__record_type="snapshot").snapshots()
+    form_users = {}
+    # ordered by pk so later snapshots win
+    for snapshot in snapshots:
+        if snapshot and "record" in snapshot and "context_id" in snapshot["record"]:
+            if "form_name" in snapshot and "form_user" in snapshot:
+                key = (snapshot["record"]["context_id"], snapshot["form_name"])
+                form_users[key] = snapshot["form_user"]
+    return form_users
+
+
+def get_form_timestamp(nested_data, form_model):
+    # as Patient.get_form_timestamp, from an already loaded record
+    if not nested_data:
+        return None
+    timestamp = nested_data.get(form_model.name + "_timestamp", None)
+    if timestamp and "timestamp" in timestamp:
+        return timestamp["timestamp"]
+    return timestamp
+
+
+class ClinicalRecord:
+    """
+    The cdes record of one patient context, loaded once and shared by
+    every table built from it.
+    """
+
+    def __init__(self, nested_data):
+        self.nested_data = nested_data
+        self._flattened_data = None
+
+    @property
+    def flattened_data(self):
+        if self._flattened_data is None and self.nested_data is not None:
+            self._flattened_data = build_form_data(self.nested_data)
+        return self._flattened_data
+
+
 class DataSource:
     def __init__(self,
                  registry_model,
@@ -164,13 +215,16 @@ class DataSource:
     def column_name(self):
         return self.column.name
 
-    def get_value(self, patient_model, context_model):
+    def get_value(self, patient_model, context_model, record=None):
+        """
+        record is the loaded ( ClinicalRecord ) data for the context, if any
+        """
         if self.field:
-            return self._get_field_value(patient_model, context_model)
+            return self._get_field_value(patient_model, context_model, record)
         else:
-            return self._get_cde_value(patient_model, context_model)
+            return self._get_cde_value(patient_model, context_model, record)
 
-    def _get_field_value(self, patient_model, context_model):
+    def _get_field_value(self, patient_model, context_model, record=None):
         if self.field == "patient_id":
             return patient_model.pk
         elif self.field == "form":
@@ -184,6 +238,8 @@ class DataSource:
         elif self.field == "username":
             return self._get_last_user(patient_model, context_model)
         elif self.field == "timestamp":
+            if record is not None:
+                return get_form_timestamp(record.nested_data, self.form_model)
             return patient_model.get_form_timestamp(self.form_model, context_model)
         elif self.field == "progress":
             return self._get_form_progress(patient_model, context_model)
@@ -199,27 +255,17 @@ class DataSource:
 
     def _get_last_user(self, patient_model, context_model):
         # last user to edit the _form_ in this context
-        history = ClinicalData.objects.collection(
-            self.registry_model.code, "history")
-        snapshots = history.find(patient_model, record_type="snapshot")
-        snapshots = sorted([s for s in snapshots],
-                           key=attrgetter("pk"), reverse=True)
-        for snapshot in snapshots:
-            if snapshot.data and "record" in snapshot.data:
-                record = snapshot.data["record"]
-                if "context_id" in record:
-                    if context_model.pk == record["context_id"]:
-                        if "form_name" in snapshot.data:
-                            form_name = snapshot.data["form_name"]
-                            if form_name == self.form_model.name:
-                                if "form_user" in snapshot.data:
-                                    return snapshot.data["form_user"]
-
-    def _get_cde_value(self, patient_model, context_model):
+        form_users = get_form_users(self.registry_model.code, patient_model.pk)
+        return form_users.get((context_model.pk, self.form_model.name))
+
+    def _get_cde_value(self, patient_model, context_model, record=None):
         try:
-            data = get_clinical_data(self.registry_model.code,
-                                     patient_model.pk,
-                                     context_model.pk)
+            if record is not None:
+                data = record.flattened_data
+            else:
+                data = get_clinical_data(self.registry_model.code,
+                                         patient_model.pk,
+                                         context_model.pk)
 
             raw_value = patient_model.get_form_value(self.registry_model.code,
                                                      self.form_model.name,
@@ -335,21 +381,28 @@ class MultiSectionExtractor:
         self.clinical_table = clinical_table
         self.datasources = datasources
 
-    def get_rows(self, patient_model, context_model):
-
-        nested_clinical_data = get_nested_clinical_data(self.registry_model.code,
-                                                        patient_model.pk,
-                                                        context_model.pk)
+    def get_rows(self, patient_model, context_model, record=None):
+        if record is not None:
+            nested_clinical_data = record.nested_data
+        else:
+            nested_clinical_data = get_nested_clinical_data(self.registry_model.code,
+                                                            patient_model.pk,
+                                                            context_model.pk)
 
         items_list = patient_model.evaluate_field_expression(self.registry_model,
                                                              self.field_expression,
-                                                             clinical_data=nested_clinical_data)
+                                                             clinical_data=nested_clinical_data,
+                                                             context_model=context_model)
+
+        if record is not None:
+            form_timestamp = get_form_timestamp(nested_clinical_data, self.clinical_table.form_model)
+        else:
+            form_timestamp = patient_model.get_form_timestamp(self.clinical_table.form_model,
+                                                              context_model=context_model)
 
-        return self._convert_to_rows(patient_model, context_model, items_list)
+        return self._convert_to_rows(patient_model, context_model, items_list, form_timestamp)
 
-    def _convert_to_rows(self, patient_model, context_model, items_list):
-        form_timestamp = patient_model.get_form_timestamp(
-            self.clinical_table.form_model, context_model=context_model)
+    def _convert_to_rows(self, patient_model, context_model, items_list, form_timestamp):
 
         for index, item_dict in enumerate(items_list):
             item_number = index + 1
@@ -362,7 +415,7 @@ class MultiSectionExtractor:
             row_dict["timestamp"] = form_timestamp
 
             for cde_code in item_dict:
-                cde_model = CommonDataElement.objects.get(code=cde_code)
+                cde_model = get_cde_model(cde_code)
                 is_file = lower_strip(cde_model.datatype) == "file"
                 # column_name = no_space_lower(cde_code)
                 column_name = unambigious_name(self.clinical_table.section_model.code, cde_code)
@@ -392,7 +445,22 @@ class MultiSectionExtractor:
         return fix_display_value(cde_model.datatype.lower().strip(), display_value)
 
 
+def extract_partition(args):
+    # runs in a worker process, filling the staging tables for one range of patients
+    registry_code, db, id_range = args
+    registry_model = Registry.objects.get(code=registry_code)
+    generator = Generator(registry_model, db=db)
+    generator.define_clinical_tables(create=False)
+    generator._extract_clinical_data(id_range)
+    return id_range
+
+
 class Generator:
+    # patients ( and their clinical data ) fetched per round trip
+    chunk_size = 500
+    # rows buffered per table before each COPY
+    buffer_size = 2000
+
     def __init__(self, registry_model, db="reporting"):
         self.registry_model = registry_model
         self.clinical_engine = self._create_engine("clinical")
@@ -403,6 +471,7 @@ class Generator:
         self.clinical_tables = []
         self.column_map = {}
 
+        self.db = db
         if db == "clinical":
             self.reporting_engine = self.clinical_engine
         elif db == "default":
@@ -443,14 +512,12 @@ class Generator:
                           MetaData(engine), autoload=True)
         return table
 
-    def _copy_table_data(self, src_engine, dest_engine, table):
-        dest_engine.execute("DROP TABLE IF EXISTS %s CASCADE" % table.name)
-        table.create(dest_engine)
-        rows = src_engine.execute(table.select()).fetchall()
-
-        with dest_engine.begin() as con:
-            for row in rows:
-                con.execute(table.insert().values(**row))
+    def _copy_table_data(self, src_engine, dest_engine, table, dest_table=None):
+        dest_table = table if dest_table is None else dest_table
+        dest_table.drop(dest_engine, checkfirst=True)
+        dest_table.create(dest_engine)
+        with RowLoader(dest_engine, dest_table, self.buffer_size) as row_loader:
+            row_loader.extend(stream_rows(src_engine, table.select(), self.chunk_size))
 
     def clear(self):
         # drop tables etc
@@ -539,26 +606,80 @@ class Generator:
         return models
 
     def _mirror_table(self, table_name, source_engine, target_engine):
-        try:
-            self._drop_table(table_name)
-        except BaseException:
-            pass
-
         source_meta = MetaData(bind=source_engine)
         table = alc.Table(table_name, source_meta, autoload=True)
-        table.metadata.create_all(self.reporting_engine)
-        self._copy_table_data(source_engine, target_engine, table)
+        # the staging copy has no foreign keys: the demographic tables are
+        # copied in no particular order, so a dependent table ( e.g. the
+        # patient addresses ) may be loaded before the table it refers to
+        staging_table = alc.Table(table_name, MetaData(), schema=self.staging_schema, *[
+            alc.Column(column.name, column.type, nullable=column.nullable,
+                       primary_key=column.primary_key, autoincrement=False)
+            for column in table.columns])
+        for index in table.indexes:
+            alc.Index(index.name, *[staging_table.c[column.name] for column in index.columns],
+                      unique=index.unique)
+        self._copy_table_data(source_engine, target_engine, table, staging_table)
 
-    def create_tables(self):
+    @property
+    def staging_schema(self):
+        return "staging_" + nice_name(self.registry_model.code)
+
+    def _create_staging_schema(self):
+        with self.reporting_engine.begin() as conn:
+            conn.execute("DROP SCHEMA IF EXISTS %s CASCADE" % self.staging_schema)
+            conn.execute("CREATE SCHEMA %s" % self.staging_schema)
+
+    def _swap_in_staging_tables(self):
+        """
+        Replaces the live tables with the staged ones in one transaction, so
+        readers see either the old tables or the complete new ones.
+        """
+        table_names = alc.inspect(self.reporting_engine).get_table_names(schema=self.staging_schema)
+        with self.reporting_engine.begin() as conn:
+            for table_name in table_names:
+                conn.execute('DROP TABLE IF EXISTS public."%s" CASCADE' % table_name)
+            for table_name in table_names:
+                conn.execute('ALTER TABLE %s."%s" SET SCHEMA public' % (self.staging_schema, table_name))
+            conn.execute("DROP SCHEMA %s CASCADE" % self.staging_schema)
+
+    def create_tables(self, workers=1):
+        """
+        Builds every table in a staging schema, extracting the clinical data
+        in workers processes, then swaps the finished tables in.
+        """
+        self._create_staging_schema()
         if self.reporting_engine is not self.default_engine:
             self._create_demographic_tables()
 
+        self.define_clinical_tables()
+
+        if workers > 1:
+            self._extract_parallel(workers)
+        else:
+            self._extract_clinical_data()
+
+        self._swap_in_staging_tables()
+
+    def _extract_parallel(self, workers):
+        patient_ids = list(self.patients.order_by("pk").values_list("pk", flat=True))
+        # more partitions than workers so a slow range doesn't hold up the rest
+        tasks = [(self.registry_model.code, self.db, id_range)
+                 for id_range in id_ranges(patient_ids, workers * 4)]
+        # forked workers must not share the parent's connections
+        connections.close_all()
+        for engine in (self.clinical_engine, self.default_engine, self.reporting_engine):
+            engine.dispose()
+        with Pool(workers) as pool:
+            for id_range in pool.imap_unordered(extract_partition, tasks):
+                logger.info("extracted patients %s to %s" % id_range)
+
+    def define_clinical_tables(self, create=True):
         for form_model in self.registry_model.forms:
             if form_model.name.startswith("GeneratedQuestionnaire"):
                 continue
 
             columns = self._create_form_columns(form_model)
-            table = self._create_table(form_model.name, columns)
+            table = self._create_table(form_model.name, columns, create)
 
             single_form_table = ClinicalTable(TableType.CLINICAL_FORM,
                                               table,
@@ -580,7 +701,7 @@ class Generator:
                     if "!" in table_name:
                         table_name = table_name.replace("!", "")
 
-                    table = self._create_table(table_name, columns)
+                    table = self._create_table(table_name, columns, create)
                     multisection_table = ClinicalTable(TableType.MULTISECTION,
                                                        table,
                                                        columns,
@@ -589,48 +710,87 @@ class Generator:
 
                     self.clinical_tables.append(multisection_table)
 
-        self._extract_clinical_data()
-
     @property
     def patients(self):
         return Patient.objects.filter(rdrf_registry__in=[self.registry_model])
 
-    def _extract_clinical_data(self):
+    def _patient_chunks(self, id_range=None):
+        patients = self.patients.order_by("pk")
+        if id_range is not None:
+            patients = patients.filter(pk__gte=id_range[0], pk__lte=id_range[1])
+        chunk = []
+        for patient_model in patients.iterator(chunk_size=self.chunk_size):
+            chunk.append(patient_model)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _clinical_records(self, id_range=None):
+        """
+        Yields (patient model, context model, ClinicalRecord) for the registry's
+        patient contexts, loading the contexts and cdes records a chunk of
+        patients at a time.
+        """
+        patient_type = ContentType.objects.get_for_model(Patient)
+        for patients in self._patient_chunks(id_range):
+            patient_ids = [patient_model.pk for patient_model in patients]
+            contexts = {}
+            context_models = (RDRFContext.objects.filter(registry=self.registry_model,
+                                                         content_type=patient_type,
+                                                         object_id__in=patient_ids)
+                              .select_related("context_form_group")
+                              .order_by("created_at"))
+            for context_model in context_models:
+                contexts.setdefault(context_model.object_id, []).append(context_model)
+
+            records = {}
+            cdes = (ClinicalData.objects.collection(self.registry_model.code, "cdes")
+                    .filter(django_model="Patient", django_id__in=patient_ids)
+                    .values_list("django_id", "context_id", "data"))
+            for patient_id, context_id, data in cdes:
+                # the first record of a context is the one used elsewhere
+                records.setdefault((patient_id, context_id), data)
+
+            for patient_model in patients:
+                for context_model in contexts.get(patient_model.pk, []):
+                    nested_data = records.get((patient_model.pk, context_model.pk))
+                    yield patient_model, context_model, ClinicalRecord(nested_data)
+
+    def _extract_clinical_data(self, id_range=None):
+        # one pass over the patients, feeding every table from each
+        # record as it is loaded
         form_tables = [
             t for t in self.clinical_tables if not t.is_multisection]
         multi_tables = [t for t in self.clinical_tables if t.is_multisection]
-        for clinical_table in form_tables:
-            row_count = 0
-            datasources = [self.column_map[column]
-                           for column in clinical_table.columns]
-            for patient_model in self.patients:
-                for context_model in patient_model.context_models:
-                    if context_model.registry.id == self.registry_model.id:
-                        if in_context(context_model, clinical_table):
-                            row = {ds.column_name: ds.get_value(
-                                patient_model, context_model) for ds in datasources}
-                            self.reporting_engine.execute(
-                                clinical_table.table.insert().values(**row))
-                            row_count += 1
-
-        for clinical_table in multi_tables:
-            row_count = 0
-            current_column_names = set(
-                [col.name for col in clinical_table.table.columns])
-            datasources = [self.column_map[column]
-                           for column in clinical_table.columns]
-            multisection_extractor = MultiSectionExtractor(
-                self.registry_model, clinical_table, datasources)
-            for patient_model in self.patients:
-                for context_model in patient_model.context_models:
-                    if context_model.registry.id == self.registry_model.id:
-                        if in_context(context_model, clinical_table):
-                            for item_row in multisection_extractor.get_rows(
-                                    patient_model, context_model):
-                                self._clean_row(item_row, current_column_names)
-                                self.reporting_engine.execute(
-                                    clinical_table.table.insert().values(**item_row))
-                                row_count += 1
+        loaders = {clinical_table: RowLoader(self.reporting_engine, clinical_table.table, self.buffer_size)
+                   for clinical_table in self.clinical_tables}
+        datasources = {clinical_table: [self.column_map[column] for column in clinical_table.columns]
+                       for clinical_table in form_tables}
+        extractors = {clinical_table: MultiSectionExtractor(self.registry_model,
+                                                            clinical_table,
+                                                            [self.column_map[column]
+                                                             for column in clinical_table.columns])
+                      for clinical_table in multi_tables}
+        column_names = {clinical_table: set([col.name for col in clinical_table.table.columns])
+                        for clinical_table in multi_tables}
+
+        for patient_model, context_model, record in self._clinical_records(id_range):
+            for clinical_table in form_tables:
+                if in_context(context_model, clinical_table):
+                    row = {ds.column_name: ds.get_value(patient_model, context_model, record)
+                           for ds in datasources[clinical_table]}
+                    loaders[clinical_table].add(row)
+
+            for clinical_table in multi_tables:
+                if in_context(context_model, clinical_table):
+                    for item_row in extractors[clinical_table].get_rows(patient_model, context_model, record):
+                        self._clean_row(item_row, column_names[clinical_table])
+                        loaders[clinical_table].add(item_row)
+
+        for row_loader in loaders.values():
+            row_loader.flush()
 
     def _clean_row(self, row, current_column_names):
         bad_keys = set(row.keys()) - current_column_names
@@ -671,15 +831,15 @@ class Generator:
     def _get_table_name(self, name):
         return no_space_lower(name)
 
-    def _create_table(self, table_code, columns):
+    def _create_table(self, table_code, columns, create=True):
         table_name = self._get_table_name(table_code)
         if "!" in table_name:
             table_name = table_name.replace("!", "")
 
-        self._drop_table(table_name)
         table = alc.Table(table_name, MetaData(
-            self.reporting_engine), *columns, schema=None)
-        table.create()
+            self.reporting_engine), *columns, schema=self.staging_schema)
+        if create:
+            table.create()
         # these cause failures in migration ...
         return table
 
@@ -433,7 +433,7 @@ class ReportGenerator:
         )
         if isinstance(raw_value, list):
             display_value = "|".join(
-                [str(cde_model.get_display_value(x)) for x in raw_value]
+                [str(x) for x in cde_model.get_display_values(raw_value)]
             )
         else:
             display_value = cde_model.get_display_value(raw_value)
@@ -43,6 +43,17 @@ def get_display_value(cde_code, raw_value):
         return dv
 
 
+def get_display_values(cde_code, raw_values):
+    try:
+        cde_model = get_cde_model(cde_code)
+    except CommonDataElement.DoesNotExist:
+        logger.error(f"{cde_code} does not exist")
+        return ["NOCDE" for _ in raw_values]
+    if cde_model.datatype == "date":
+        return [aus_date_string(raw_value) for raw_value in raw_values]
+    return [";".join(dv) if type(dv) is list else dv for dv in cde_model.get_display_values(raw_values)]
+
+
 @cached(maxsize=None)
 def get_questionnaire_number(code):
     try:
@@ -58,12 +69,7 @@ def is_address_field(cde_code):
 
 
 def retrieve(cd, cde):
-    for f in cd.data["forms"]:
-        for s in f["sections"]:
-            if not s["allow_multiple"]:
-                for c in s["cdes"]:
-                    if c["code"] == cde:
-                        return c["value"]
+    return cd.cde_index.first_value(cde)
 
 
 def aus_date_string(us_date_string):
@@ -374,9 +380,7 @@ class Downloader:
 
             try:
                 if type(value) is list:
-                    display_value = ";".join(
-                        [get_display_value(code, x) for x in value]
-                    )
+                    display_value = ";".join(get_display_values(code, value))
                 else:
                     display_value = get_display_value(code, value)
             except Exception as ex:
@@ -62,12 +62,7 @@ def is_address_field(cde_code):
 
 
 def retrieve(cd, cde):
-    for f in cd.data["forms"]:
-        for s in f["sections"]:
-            if not s["allow_multiple"]:
-                for c in s["cdes"]:
-                    if c["code"] == cde:
-                        return c["value"]
+    return cd.cde_index.first_value(cde)
 
 
 def aus_date_string(us_date_string):
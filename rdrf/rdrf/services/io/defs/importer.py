@@ -6,6 +6,7 @@ from django.core.exceptions import MultipleObjectsReturned
 from django.core.exceptions import ValidationError
 from explorer.models import Query
 from intframework.models import HL7Mapping
+from rdrf.helpers.compiled_registry import invalidate_definition_cache
 from rdrf.helpers.utils import create_permission
 from rdrf.models.definition.models import CDEPermittedValue
 from rdrf.models.definition.models import CDEPermittedValueGroup
@@ -126,6 +127,8 @@ class Importer(object):
             self.state = ImportState.VALID
 
         self._create_registry_objects()
+        # drop any compiled copy of the definition we've just replaced
+        invalidate_definition_cache()
 
         if self.check_soundness:
             self._check_soundness()
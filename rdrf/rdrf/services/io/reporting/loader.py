@@ -0,0 +1,85 @@
+import io
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RowLoader(object):
+    """
+    Bounded buffer of rows for one SQLAlchemy table.
+
+    Rows are written every buffer_size rows with COPY FROM STDIN when the
+    engine uses psycopg2, otherwise with a single executemany insert, so
+    memory stays flat however many rows are loaded.
+    """
+
+    def __init__(self, engine, table, buffer_size=2000):
+        self.engine = engine
+        self.table = table
+        self.buffer_size = buffer_size
+        self.column_names = [column.name for column in table.columns]
+        self.use_copy = engine.dialect.driver == "psycopg2"
+        self.rows = []
+        self.row_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        with self.engine.begin() as connection:
+            if self.use_copy:
+                self._copy(connection.connection)
+            else:
+                connection.execute(self.table.insert(), self.rows)
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    def _copy(self, dbapi_connection):
+        preparer = self.engine.dialect.identifier_preparer
+        columns = ", ".join(preparer.quote(name) for name in self.column_names)
+        table_name = preparer.format_table(self.table)
+        sql = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table_name, columns)
+        stream = io.StringIO()
+        for row in self.rows:
+            stream.write(",".join(self._csv_value(row.get(name)) for name in self.column_names))
+            stream.write("\n")
+        stream.seek(0)
+        with dbapi_connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream)
+
+    def _csv_value(self, value):
+        # COPY csv reads an unquoted empty field as NULL and any quoted
+        # field, "" included, as the value it holds
+        if value is None:
+            return ""
+        return '"%s"' % str(value).replace('"', '""')
+
+
+def stream_rows(engine, query, chunk_size=2000):
+    """
+    Yields the result rows of query as dicts, fetched chunk_size at a
+    time from a server side cursor.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
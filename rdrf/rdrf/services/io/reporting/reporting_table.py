@@ -1,7 +1,9 @@
 from copy import copy
 import sqlalchemy as alc
 from sqlalchemy import create_engine, MetaData
+from rdrf.helpers.compiled_registry import get_compiled_registry
 from rdrf.helpers.utils import timed
+from rdrf.services.io.reporting.loader import RowLoader
 from datetime import datetime
 from django.conf import settings
 from rdrf.models.definition.models import ClinicalData
@@ -28,13 +30,32 @@ def pg_uri(db):
 
 class ColumnLabeller(object):
 
+    def __init__(self, registry_model=None):
+        self.registry_model = registry_model
+        self.compiled_registry = None
+
+    def _get_models(self, form_pk, section_pk, cde_code):
+        from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
+        if self.registry_model is not None:
+            if self.compiled_registry is None:
+                self.compiled_registry = get_compiled_registry(self.registry_model)
+            compiled_form = self.compiled_registry.forms_by_pk.get(form_pk)
+            compiled_section = self.compiled_registry.sections_by_pk.get(section_pk)
+            cde_model = self.compiled_registry.cdes.get(cde_code)
+            if compiled_form and compiled_section and cde_model:
+                return compiled_form.form_model, compiled_section.section_model, cde_model
+
+        form_model = RegistryForm.objects.get(pk=form_pk)
+        section_model = Section.objects.get(pk=section_pk)
+        cde_model = CommonDataElement.objects.get(code=cde_code)
+        return form_model, section_model, cde_model
+
     def get_label(self, column_name):
         s = self._get_label(column_name)
         return s.upper()
 
     def _get_label(self, column_name):
         # relies on the encoding of the column names
-        from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
         try:
             column_tuple = column_name.split("_")
             num_parts = len(column_tuple)
@@ -52,9 +73,7 @@ class ColumnLabeller(object):
             else:
                 return column_name
 
-            form_model = RegistryForm.objects.get(pk=int(form_pk))
-            section_model = Section.objects.get(pk=int(section_pk))
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            form_model, section_model, cde_model = self._get_models(int(form_pk), int(section_pk), cde_code)
             if column_index:
                 s = form_model.name[:3] + "_" + section_model.display_name[
                     :3] + "_" + cde_model.name[:30] + "_" + column_index
@@ -112,7 +131,7 @@ class ReportingTableGenerator(object):
         self.multisection_handler = multisection_handler
         self.humaniser = humaniser
         self.max_items = max_items
-        self.column_labeller = ColumnLabeller()
+        self.column_labeller = ColumnLabeller(registry_model)
 
         self.error_messages = []
         self.warning_messages = []
@@ -362,19 +381,16 @@ class ReportingTableGenerator(object):
 
         sql_only = len(dynamic_data) == 0
 
-        values = []
-        for row in generate_func(self.reverse_map,
-                                 self.col_map,
-                                 max_items=self.max_items,
-                                 collection=collection,
-                                 history=history,
-                                 sql_only=sql_only):
-            new_row = copy(blank_row)
-            new_row.update(row)
-            values.append(new_row)
-            # row_num += 1
-
-        self.engine.execute(self.table.insert(), values)
+        with RowLoader(self.engine, self.table) as row_loader:
+            for row in generate_func(self.reverse_map,
+                                     self.col_map,
+                                     max_items=self.max_items,
+                                     collection=collection,
+                                     history=history,
+                                     sql_only=sql_only):
+                new_row = copy(blank_row)
+                new_row.update(row)
+                row_loader.add(new_row)
 
         if errors > 0:
             logger.warning("query errors: %s" % errors)
@@ -457,12 +473,13 @@ class MongoFieldSelector(object):
     @property
     def fields(self):
         self.field_info = []
-        for form_model in self.registry_model.forms:
+        compiled_registry = get_compiled_registry(self.registry_model)
+        for compiled_form in compiled_registry.compiled_forms:
+            form_model = compiled_form.form_model
             if self.user.can_view(form_model) and not form_model.is_questionnaire:
-                for section_model in form_model.section_models:
-                    for cde_model in section_model.cde_models:
-                        self._get_field_info(
-                            form_model, section_model, cde_model)
+                for section_model, cde_model in compiled_form.cde_triples():
+                    self._get_field_info(
+                        form_model, section_model, cde_model)
 
         return self.field_info
 
@@ -558,7 +575,7 @@ class ReportTable(object):
         self.user = user
         self.engine = self._create_engine()
         self.table_name = temporary_table_name(self.query_model, self.user)
-        self.column_labeller = ColumnLabeller()
+        self.column_labeller = ColumnLabeller(self.query_model.registry)
         self.table = self._get_table()
         self._converters = {
             "date_of_birth": str,
@@ -2,9 +2,8 @@ import openpyxl as xl
 import logging
 import json
 import functools
-from rdrf.helpers.utils import get_cde_value
 from rdrf.helpers.utils import cached
-from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.dynamic_data import CdeIndex, DynamicDataWrapper
 from rdrf.models.definition.models import CommonDataElement, ClinicalData
 from rdrf.db.generalised_field_expressions import GeneralisedFieldExpressionParser
 from django.conf import settings
@@ -15,10 +14,13 @@ logger = logging.getLogger(__name__)
 class Cache:
     LIMIT_SNAPSHOT = 2000
     LIMIT_CURRENT = 2000
+    LIMIT_INDEX = 2000
 
     def __init__(self):
         self.snapshots = {}
         self.current = {}
+        # id of a record -> (record, CdeIndex of the record)
+        self.indexes = {}
 
     def _get_data(self, patient, name, cached_data, limit, retriever):
         if patient.id in cached_data:
@@ -48,6 +50,17 @@ class Cache:
             self.LIMIT_SNAPSHOT,
             snapshots_retriever)
 
+    def get_index(self, record):
+        # the index is read once per cde column of the record
+        entry = self.indexes.get(id(record))
+        if entry is not None and entry[0] is record:
+            return entry[1]
+        if len(self.indexes) >= self.LIMIT_INDEX:
+            del self.indexes[next(iter(self.indexes))]
+        cde_index = CdeIndex(record)
+        self.indexes[id(record)] = (record, cde_index)
+        return cde_index
+
 
 def attempt(func):
     @functools.wraps(func)
@@ -194,11 +207,10 @@ class SpreadSheetReport:
                 form_model,
                 section_model,
                 cde_model,
-                get_cde_value(
-                    form_model,
-                    section_model,
-                    cde_model,
-                    patient_record))
+                self.cache.get_index(patient_record).value(
+                    form_model.name,
+                    section_model.code,
+                    cde_model.code))
         except Exception as ex:
             patient_id = patient_record["django_id"]
             from registry.patients.models import Patient
@@ -372,7 +384,7 @@ class SpreadSheetReport:
         if patient_record is None:
             return None
         try:
-            return get_cde_value(form_model, section_model, cde_model, patient_record)
+            return self.cache.get_index(patient_record).value(form_model.name, section_model.code, cde_model.code)
         except Exception as ex:
             cde = "%s/%s/%s" % (form_model.name,
                                 section_model.code, cde_model.code)
@@ -397,4 +409,4 @@ class SpreadSheetReport:
         #     if before is not None:
         #         snapshots = snapshots.filter(data__timestamp__lte=before.isoformat())
 
-        return list(snapshots.data())
+        return list(snapshots.snapshots())
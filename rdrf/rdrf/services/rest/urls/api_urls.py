@@ -14,6 +14,7 @@ router.register(r'countries', api_views.ListCountries, basename='country')
 router.register(r'registries/(?P<registry_code>\w+)/indices',
                 api_views.LookupIndex, basename='index')
 router.register(r'calculatedcdes', api_views.CalculatedCdeValue, basename='calculatedcde')
+router.register(r'calculatedcdes/batch', api_views.CalculatedCdeValues, basename='calculatedcdebatch')
 router.register(r'tasks/(?P<task_id>[0-9a-z_\-]+)', api_views.TaskInfoView, basename='task')
 router.register(r'taskdownloads/(?P<task_id>[0-9a-z_\-]+)',
                 api_views.TaskResultDownloadView, basename='download')
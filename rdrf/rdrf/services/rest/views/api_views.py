@@ -4,7 +4,6 @@ import subprocess
 from datetime import datetime
 import json
 
-from django.db.models import Q
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.conf import settings
 from rest_framework import generics
@@ -25,10 +24,18 @@ from django.http import HttpResponse
 from rdrf.models.task_models import CustomActionExecution
 from rdrf.models.definition.models import CommonDataElement
 from rdrf.helpers.utils import same_working_group, is_calculated_cde_in_registry
+from rdrf.helpers.compiled_registry import get_compiled_registry
+from rdrf.helpers.recalc_logic import get_calculation_graph
+from rdrf.forms.fields import calculated_functions
 
 import logging
 logger = logging.getLogger(__name__)
 
+# type-ahead results returned by LookupIndex, which sends the limit and
+# whether there were more matches in the X-Result-Limit and
+# X-Result-Truncated headers
+LOOKUP_INDEX_LIMIT = 20
+
 
 class BadRequestError(APIException):
     status_code = status.HTTP_400_BAD_REQUEST
@@ -303,11 +310,10 @@ class LookupIndex(APIView):
         if not registry.has_feature('family_linkage'):
             return Response([])
 
-        if request.user.is_superuser:
-            query = Q(given_names__icontains=term) | Q(family_name__icontains=term)
-        else:
-            query = (Q(given_names__icontains=term) | Q(family_name__icontains=term)) & \
-                Q(working_groups__in=request.user.working_groups.all(), active=True)
+        # index_patients excludes inactive patients, as Patient.is_index did for superusers before
+        patients = Patient.objects.lookup(term).index_patients()
+        if not request.user.is_superuser:
+            patients = patients.filter(working_groups__in=request.user.working_groups.all())
 
         def to_dict(patient):
             return {
@@ -317,8 +323,11 @@ class LookupIndex(APIView):
                 'label': "%s" % patient,
             }
 
-        return Response(
-            list(map(to_dict, [p for p in Patient.objects.filter(query) if p.is_index])))
+        patients = list(patients[:LOOKUP_INDEX_LIMIT + 1])
+        truncated = len(patients) > LOOKUP_INDEX_LIMIT
+        return Response([to_dict(p) for p in patients[:LOOKUP_INDEX_LIMIT]],
+                        headers={"X-Result-Limit": str(LOOKUP_INDEX_LIMIT),
+                                 "X-Result-Truncated": "true" if truncated else "false"})
 
 
 class CalculatedCdeValue(APIView):
@@ -367,6 +376,60 @@ class CalculatedCdeValue(APIView):
             raise Exception(f"Trying to call unknown calculated function {request.data['cde_code']}()")
 
 
+class CalculatedCdeValues(APIView):
+    """
+    Evaluates every calculated cde on a form in one request.
+    Outputs are evaluated in dependency order and each result is added to
+    the form values, so outputs using other outputs see the new values.
+    Returns a dict of cde code -> value.
+    """
+    permission_classes = (IsAuthenticatedOrReadOnly,)
+
+    def get(self, request, format=None):
+        return Response("Use the POST method")
+
+    def post(self, request, format=None):
+        # curl -H 'Content-Type: application/json' -X POST -u admin:admin http://localhost:8000/api/v1/calculatedcdes/batch/ -d '{"registry_code":"reg", "patient_id":1, "form_name":"Diagnosis", "form_values":{"DateOfDiagnosis":"2019-05-01"},"patient_sex":1, "patient_date_of_birth":"2000-05-17"}'
+        try:
+            patient_id = request.data["patient_id"]
+            patient = Patient.objects.get(pk=patient_id)
+            registry_code = request.data["registry_code"]
+            registry = Registry.objects.get_by_natural_key(registry_code)
+        except Patient.DoesNotExist:
+            raise BadRequestError(f"Patient {patient_id} does not exist")
+        except Registry.DoesNotExist:
+            raise BadRequestError(f"Registry {registry_code} does not exist")
+
+        if not same_working_group(patient, request.user, registry):
+            raise BadRequestError("Patient is not assigned to this centre")
+
+        form_name = request.data["form_name"]
+        if form_name not in get_compiled_registry(registry).forms_by_name:
+            raise BadRequestError(f"Form {form_name} does not exist in this registry")
+
+        patient_values = {'date_of_birth': datetime.strptime(request.data["patient_date_of_birth"], '%Y-%m-%d').date(),
+                          'patient_id': patient_id,
+                          'registry_code': registry_code,
+                          'sex': str(request.data["patient_sex"])}
+        form_values = dict(request.data["form_values"])
+
+        results = {}
+        for cde_code in get_calculation_graph(registry).form_outputs(form_name):
+            func = getattr(calculated_functions, cde_code, None)
+            if func is None:
+                logger.error(f"Trying to call unknown calculated function {cde_code}()")
+                continue
+            try:
+                value = func(patient_values, form_values)
+            except Exception as ex:
+                # one bad calculation shouldn't stop the others on the form
+                logger.error(f"Error evaluating calculated cde {cde_code}: {ex}")
+                continue
+            results[cde_code] = value
+            form_values[cde_code] = value
+        return Response(results)
+
+
 class TaskInfoView(APIView):
     """
     View to get task execution info
@@ -234,3 +234,37 @@ def send_proms_request(registry_code, patient_id, survey_name=None, form_name=No
 def check_proms(registry_code, pid):
     # to do
     return registry_code, pid
+
+
+@app.task(name="rdrf.services.tasks.update_field_values")
+def update_field_values(registry_code, patient_id, context_id, changes):
+    """
+    Applies the cde paths changed by a clinical data save to the
+    explorer field values.
+    """
+    from rdrf.models.definition.models import Registry
+    from explorer.utils import FieldValueLoader
+
+    registry_model = Registry.objects.get(code=registry_code)
+    FieldValueLoader(registry_model).apply_changes(patient_id, context_id, changes)
+
+
+@app.task(name="rdrf.services.tasks.process_form_saves", bind=True)
+def process_form_saves(self, patient_id, context_id, token):
+    """
+    Runs the work derived from the form saves of a patient context, unless
+    a later save has scheduled another task to do it.
+    """
+    from django.conf import settings
+    from redis.exceptions import LockError
+    from rdrf.helpers import form_save_queue
+
+    try:
+        pending = form_save_queue.take(patient_id, context_id, token)
+    except LockError:
+        # the work stays pending, so try again later
+        raise self.retry(countdown=settings.FORM_SAVE_TASK_DELAY)
+    if pending is None:
+        return
+    form_save_queue.run(pending["registry_code"], patient_id, context_id, pending["sections"],
+                        pending.get("snapshot_users"))
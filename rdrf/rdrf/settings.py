@@ -220,6 +220,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django_extensions",
     "django.contrib.admin",
+    "django.contrib.postgres",
     "messages_ui",
     "ajax_select",
     "explorer",
@@ -508,6 +509,12 @@ STATIC_SERVER_PATH = STATIC_ROOT
 # a directory that will be writable by the webserver, for storing various files...
 WRITABLE_DIRECTORY = env.get("writable_directory", "/tmp")
 
+# private to the webserver user ( created 0700 ) as the dashboards unpickle
+# the visualisation base data stored there, so it must not be shared like /tmp
+VISUALISATION_BASE_DATA_DIRECTORY = env.get(
+    "visualisation_base_data_directory", os.path.join(WEBAPP_ROOT, "visualisation_base_data")
+)
+
 # valid values django.core.files.storage.FileSystemStorage and
 # storages.backends.database.DatabaseStorage
 DEFAULT_FILE_STORAGE = env.get(
@@ -576,6 +583,8 @@ ALLOWED_HOSTS = env.getlist("allowed_hosts", ["localhost"])
 USE_X_FORWARDED_HOST = env.get("use_x_forwarded_host", True)
 
 CACHE_DISABLED = False
+# seconds between checks that another process hasn't changed the registry definitions
+DEFINITION_CACHE_CHECK_INTERVAL = env.get("definition_cache_check_interval", 1)
 if env.get("memcache", ""):
     backend = "django.core.cache.backends.memcached.MemcachedCache"
     location = env.getlist("memcache")
@@ -868,6 +877,16 @@ REGISTRATION_ENABLED = env.get("registration_enabled", True)
 
 # Celery
 USE_CELERY = env.get("USE_CELERY", False)
+# update explorer field values in a task rather than during the save
+FIELD_VALUE_TASKS = env.get("field_value_tasks", False)
+# recalculations and form progress after a form save in a task, coalesced
+# per patient context over the delay ( in seconds )
+FORM_SAVE_TASKS = env.get("form_save_tasks", False)
+FORM_SAVE_TASK_DELAY = env.get("form_save_task_delay", 2)
+
+# history snapshots are stored as deltas with a full keyframe every
+# this many snapshots of a patient context ( 1 stores them all in full )
+HISTORY_KEYFRAME_INTERVAL = env.get("history_keyframe_interval", 20)
 
 CACHES["redis"] = {
     "BACKEND": "django_redis.cache.RedisCache",
@@ -31,6 +31,7 @@ function _arrayWithoutHoles(arr) {
   var required_cde_inputs = {};
   var calculated_cde_inputs = {};
   var patient_id = "";
+  var form_name = "";
   var patient_date_of_birth = "";
   var patient_sex = "";
   var registry_code = "";
@@ -52,98 +53,92 @@ function _arrayWithoutHoles(arr) {
     document.head.appendChild(fetchScript);
   }
 
-  var update_function = function update_function(calculated_cdes) {
-    calculated_cdes.forEach(function(cde_code) {
-      // Retrieve all values of input
-      var calculated_cde_inputs_json_values = {};
-      calculated_cde_inputs[cde_code].forEach(function(required_input_cde) {
-        var cde_value = $("[id$=__".concat(required_input_cde, "]")).val(); // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
-
-        if (moment(cde_value, "D-M-YYYY", true).isValid()) {
-          cde_value = moment(cde_value, "D-M-YYYY", true).format("YYYY-MM-DD");
-        } // check if it is a number and convert it in a number
-
-        if (
-          $("[id$=__".concat(required_input_cde, "]")).attr("type") === "number"
-        ) {
-          cde_value = parseFloat(cde_value);
+  var input_value = function input_value(cde_code) {
+    var cde_value = $("[id$=__".concat(cde_code, "]")).val(); // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
+
+    if (moment(cde_value, "D-M-YYYY", true).isValid()) {
+      cde_value = moment(cde_value, "D-M-YYYY", true).format("YYYY-MM-DD");
+    } // check if it is a number and convert it in a number
+
+    if ($("[id$=__".concat(cde_code, "]")).attr("type") === "number") {
+      cde_value = parseFloat(cde_value);
+    }
+
+    return cde_value;
+  };
+
+  var apply_results = function apply_results(results) {
+    Object.keys(results).forEach(function(cde_code) {
+      var field = $("[id$=__".concat(cde_code, "]"));
+      var value = results[cde_code] === null ? "" : String(results[cde_code]);
+      // only changed outputs trigger change, so chained outputs settle
+      if (field.val() !== value) {
+        field.val(value);
+        field.trigger("change");
+      }
+    });
+  };
+
+  var post_values = function post_values(body) {
+    return window.fetch(wsurl, {
+      method: "post",
+      headers: {
+        "Content-Type": "application/json",
+        "X-CSRFToken": $("[name=csrfmiddlewaretoken]").val()
+      },
+      body: JSON.stringify(body)
+    })
+      .then(function(response) {
+        if (!response.ok) {
+          throw new Error(response.statusText);
         }
 
-        calculated_cde_inputs_json_values[required_input_cde] = cde_value;
+        return response.json();
+      })
+      .then(function(result) {
+        if (result.stat === "fail") {
+          throw new Error(result.message);
+        }
+
+        apply_results(result);
+      })
+      .catch(function(errormsg) {
+        console.log(errormsg);
       });
-      var body = {
-        cde_code: cde_code,
-        patient_date_of_birth: patient_date_of_birth,
-        patient_sex: patient_sex,
-	patient_id: patient_id,
-	registry_code: registry_code,
-        form_values: calculated_cde_inputs_json_values
-      };
-
-      if(isInetExplorer){
-        setTimeout(function(){
-          window.fetch(wsurl, {
-            method: "post",
-            headers: {
-              "Content-Type": "application/json",
-              "X-CSRFToken": $("[name=csrfmiddlewaretoken]").val()
-            },
-            body: JSON.stringify(body)
-          })
-            .then(function(response) {
-              if (!response.ok) {
-                throw new Error(response.statusText);
-              }
-  
-              return response.json();
-            })
-            .then(function(result) {
-              if (result.stat === "fail") {
-                throw new Error(result.message);
-              }
-  
-              $("[id$=__".concat(cde_code, "]")).val(result);
-              $("[id$=__".concat(cde_code, "]")).trigger("change");
-            })
-            .catch(function(errormsg) {
-              console.log(errormsg);
-            });
-        }, 1000);
-      }
-      else{
-        fetch(wsurl, {
-          method: "post",
-          headers: {
-            "Content-Type": "application/json",
-            "X-CSRFToken": $("[name=csrfmiddlewaretoken]").val()
-          },
-          body: JSON.stringify(body)
-        })
-          .then(function(response) {
-            if (!response.ok) {
-              throw new Error(response.statusText);
-            }
-
-            return response.json();
-          })
-          .then(function(result) {
-            if (result.stat === "fail") {
-              throw new Error(result.message);
-            }
-
-            $("[id$=__".concat(cde_code, "]")).val(result);
-            $("[id$=__".concat(cde_code, "]")).trigger("change");
-          })
-          .catch(function(errormsg) {
-            console.log(errormsg);
-          });
-      }
+  };
+
+  // every calculated field on the form is evaluated by one request
+  var update_function = function update_function() {
+    var form_values = {};
+    Object.keys(required_cde_inputs).forEach(function(required_input_cde) {
+      form_values[required_input_cde] = input_value(required_input_cde);
     });
+    var body = {
+      form_name: form_name,
+      patient_date_of_birth: patient_date_of_birth,
+      patient_sex: patient_sex,
+      patient_id: patient_id,
+      registry_code: registry_code,
+      form_values: form_values
+    };
+
+    if (isInetExplorer) {
+      setTimeout(function() {
+        post_values(body);
+      }, 1000);
+    } else {
+      post_values(body);
+    }
   };
 
+  // input changes ( and the add_calculation calls on page load ) within
+  // the wait are coalesced into a single request
+  var schedule_update = _.debounce(update_function, 250);
+
   $.fn.add_calculation = function(options) {
     patient_date_of_birth = options.patient_date_of_birth;
     patient_id = options.patient_id;
+    form_name = options.form_name;
     registry_code = options.registry_code;
     patient_sex = options.patient_sex;
     wsurl = options.wsurl;
@@ -159,17 +154,12 @@ function _arrayWithoutHoles(arr) {
 
     try {
       // call on initial page load
-      update_function([options.observer]); //call it to ensure if calculation changes on server
+      schedule_update(); //call it to ensure if calculation changes on server
       //update the onchange
 
-      Object.keys(required_cde_inputs).forEach(function(cde_input) {
-        $("[id$=__".concat(cde_input, "]")).off("change");
-        $("[id$=__".concat(cde_input, "]")).on(
-          "change keyup",
-          _.debounce(function(e) {
-            update_function(required_cde_inputs[cde_input]);
-          }, 250)
-        );
+      options.cde_inputs.forEach(function(cde_input) {
+        $("[id$=__".concat(cde_input, "]")).off("change keyup", schedule_update);
+        $("[id$=__".concat(cde_input, "]")).on("change keyup", schedule_update);
       });
     } catch (err) {
       alert(err);
@@ -4,73 +4,91 @@
         let calculated_cde_inputs = {}
         let patient_date_of_birth = '';
         let patient_sex = '';
-        let patient_id = '',
+        let patient_id = '';
+        let form_name = '';
         let registry_code = '';
         let wsurl = '';
 
-        const update_function = function (calculated_cdes) {
+        const input_value = function (cde_code) {
+            let cde_value = $(`[id$=__${cde_code}]`).val();
 
-            calculated_cdes.forEach(cde_code => {
-                // Retrieve all values of input
-                let calculated_cde_inputs_json_values = {};
-                calculated_cde_inputs[cde_code].forEach((required_input_cde) => {
-
-                    let cde_value = $(`[id$=__${required_input_cde}]`).val();
+            // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
+            if (moment(cde_value, "D-M-YYYY",true).isValid()) {
+                cde_value = moment(cde_value, "D-M-YYYY",true).format('YYYY-MM-DD');
+            }
 
-                    // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
-                    if (moment(cde_value, "D-M-YYYY",true).isValid()) {
-                        cde_value = moment(cde_value, "D-M-YYYY",true).format('YYYY-MM-DD');
-                    }
+            // check if it is a number and convert it in a number
+            if ($(`[id$=__${cde_code}]`).attr('type') === 'number') {
+                cde_value = parseFloat(cde_value);
+            }
 
-                    // check if it is a number and convert it in a number
-                    if ($(`[id$=__${required_input_cde}]`).attr('type') === 'number') {
-                        cde_value = parseFloat(cde_value);
-                    }
+            return cde_value;
+        }
 
+        const apply_results = function (results) {
+            Object.keys(results).forEach(cde_code => {
+                const field = $(`[id$=__${cde_code}]`);
+                const value = results[cde_code] === null ? '' : String(results[cde_code]);
+                // only changed outputs trigger change, so chained outputs settle
+                if (field.val() !== value) {
+                    field.val(value);
+                    field.trigger("change");
+                }
+            });
+        }
 
-                    calculated_cde_inputs_json_values[required_input_cde] = cde_value;
-                });
+        // every calculated field on the form is evaluated by one request
+        const update_function = function () {
+            let form_values = {};
+            Object.keys(required_cde_inputs).forEach(required_input_cde => {
+                form_values[required_input_cde] = input_value(required_input_cde);
+            });
 
-                const body = {
-                    'cde_code': cde_code,
-                    'patient_date_of_birth': patient_date_of_birth,
-                    'patient_sex': patient_sex,
-                    'form_values': calculated_cde_inputs_json_values
-                };
-
-                fetch(wsurl, {
-                    method: 'post',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-CSRFToken': $("[name=csrfmiddlewaretoken]").val()
-                    },
-                    body: JSON.stringify(body)
+            const body = {
+                'form_name': form_name,
+                'patient_date_of_birth': patient_date_of_birth,
+                'patient_sex': patient_sex,
+                'patient_id': patient_id,
+                'registry_code': registry_code,
+                'form_values': form_values
+            };
+
+            fetch(wsurl, {
+                method: 'post',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': $("[name=csrfmiddlewaretoken]").val()
+                },
+                body: JSON.stringify(body)
+            })
+                .then(function (response) {
+                    if (!response.ok) {
+                        throw new Error(response.statusText);
+                    }
+                    return response.json()
                 })
-                    .then(function (response) {
-                        if (!response.ok) {
-                            throw new Error(response.statusText);
-                        }
-                        return response.json()
-                    })
-                    .then(function (result) {
-                        if (result.stat === "fail") {
-                            throw new Error(result.message);
-                        }
-                        $("[id$=__".concat(cde_code, "]")).val(result);
-                        $("[id$=__".concat(cde_code, "]")).trigger("change");
-                    })
-                    .catch(function (errormsg) {
-                        console.log(errormsg);
-                    });
-            });
+                .then(function (result) {
+                    if (result.stat === "fail") {
+                        throw new Error(result.message);
+                    }
+                    apply_results(result);
+                })
+                .catch(function (errormsg) {
+                    console.log(errormsg);
+                });
         }
 
+        // input changes ( and the add_calculation calls on page load ) within
+        // the wait are coalesced into a single request
+        const schedule_update = _.debounce(update_function, 250);
+
         $.fn.add_calculation = function (options) {
 
             patient_date_of_birth = options.patient_date_of_birth;
             patient_sex = options.patient_sex;
-	    patient_id = options.patient_id;
-	    registry_code = options.registry_code;
+            patient_id = options.patient_id;
+            form_name = options.form_name;
+            registry_code = options.registry_code;
             wsurl =options.wsurl;
 
             calculated_cde_inputs[options.observer] = options.cde_inputs;
@@ -82,12 +100,12 @@
 
             try {
                 // call on initial page load
-                update_function([options.observer]); //call it to ensure if calculation changes on server
+                schedule_update(); //call it to ensure if calculation changes on server
 
                 //update the onchange
-                Object.keys(required_cde_inputs).forEach(function (cde_input) {
-                    $(`[id$=__${cde_input}]`).off("change");
-                    $(`[id$=__${cde_input}]`).on('change keyup', _.debounce((e) => {update_function(required_cde_inputs[cde_input])}, 250))
+                options.cde_inputs.forEach(cde_input => {
+                    $(`[id$=__${cde_input}]`).off('change keyup', schedule_update);
+                    $(`[id$=__${cde_input}]`).on('change keyup', schedule_update);
                 });
 
             } catch (err) {
@@ -13,7 +13,9 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.management import call_command
 from django.forms.models import model_to_dict
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
 from rdrf.forms.fields import calculated_functions
 from rdrf.helpers.transform_cd_dict import get_cd_form, get_section, transform_cd_dict
 from rdrf.helpers.utils import de_camelcase, TimeStripper
@@ -297,6 +299,64 @@ class CalculatedFunctionsTestCase(TestCase):
         )
 
 
+class FormSaveQueueTestCase(TestCase):
+    @override_settings(USE_CELERY=True, FORM_SAVE_TASKS=True,
+                       CACHES=dict(settings.CACHES, redis={"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}))
+    def test_saves_of_a_context_are_coalesced(self):
+        from rdrf.helpers import form_save_queue
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            form_save_queue.schedule("fh", 1, 2, 10, ["sectionA"])
+            form_save_queue.schedule("fh", 1, 2, 10, ["sectionA", "sectionB"])
+            form_save_queue.schedule("fh", 1, 2, 11, ["sectionC"])
+        self.assertEqual(len(callbacks), 3)
+
+        first_token = form_save_queue.caches["redis"].get("form_save_pending_1_2")["token"]
+        form_save_queue.schedule("fh", 1, 2, 11, ["sectionC"])
+        # only the last scheduled task gets the work
+        self.assertIsNone(form_save_queue.take(1, 2, first_token))
+        last_token = form_save_queue.caches["redis"].get("form_save_pending_1_2")["token"]
+        pending = form_save_queue.take(1, 2, last_token)
+        self.assertEqual(pending["sections"], {"10": ["sectionA", "sectionB"], "11": ["sectionC"]})
+        self.assertIsNone(form_save_queue.take(1, 2, last_token))
+
+    @override_settings(USE_CELERY=True, FORM_SAVE_TASKS=True,
+                       CACHES=dict(settings.CACHES, redis={"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}))
+    def test_pending_work_is_locked(self):
+        from unittest import mock
+        from rdrf.helpers import form_save_queue
+
+        cache = form_save_queue.caches["redis"]
+        lock = cache.lock = mock.MagicMock()
+        try:
+            with self.captureOnCommitCallbacks():
+                form_save_queue.schedule("fh", 1, 2, 10, ["sectionA"])
+            form_save_queue.take(1, 2, cache.get("form_save_pending_1_2")["token"])
+        finally:
+            del cache.lock
+        self.assertEqual([call.args[0] for call in lock.call_args_list],
+                         ["form_save_pending_1_2_lock", "form_save_pending_1_2_lock"])
+        self.assertEqual(lock.return_value.__enter__.call_count, 2)
+
+    @override_settings(USE_CELERY=True, FORM_SAVE_TASKS=True,
+                       CACHES=dict(settings.CACHES, redis={"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}))
+    def test_contended_lock_is_not_scheduled(self):
+        from unittest import mock
+        from redis.exceptions import LockError
+        from rdrf.helpers import form_save_queue
+
+        cache = form_save_queue.caches["redis"]
+        cache.lock = mock.MagicMock()
+        cache.lock.return_value.__enter__.side_effect = LockError("Unable to acquire lock")
+        try:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.assertFalse(form_save_queue.schedule("fh", 1, 2, 10, ["sectionA"]))
+        finally:
+            del cache.lock
+        self.assertEqual(callbacks, [])
+        self.assertIsNone(cache.get("form_save_pending_1_2"))
+
+
 class AbnormalityRulesTestCase(TestCase):
     def setUp(self):
         self.cde = CommonDataElement()
@@ -1153,7 +1213,7 @@ class LongitudinalTestCase(FormTestCase):
         super(LongitudinalTestCase, self).test_simple_form()
         # should have one snapshot
         qs = ClinicalData.objects.collection(self.registry.code, "history")
-        snapshots = qs.find(self.patient, record_type="snapshot").data()
+        snapshots = list(qs.find(self.patient, record_type="snapshot").snapshots())
         self.assertGreater(len(snapshots), 0, "History should be filled in on save")
         for snapshot in snapshots:
             self.assertIn(
@@ -1168,6 +1228,774 @@ class LongitudinalTestCase(FormTestCase):
                 "Each  snapshot should record dict contain a forms field",
             )
 
+    def test_history_is_delta_encoded(self):
+        from rdrf.db.dynamic_data import DynamicDataWrapper
+        from io import StringIO
+        from rdrf.db.history import apply_changes, diff_record, is_delta
+
+        old = {"forms": [{"name": "f", "sections": [{"code": "s", "cdes": [{"code": "a", "value": 1}]}]}], "x": 1}
+        new = {"forms": [{"name": "f", "sections": []}, {"name": "g"}], "y": [1, 2]}
+        self.assertEqual(apply_changes(old, diff_record(old, new)), new)
+        self.assertEqual(apply_changes(new, diff_record(new, old)), old)
+        self.assertEqual(old["forms"][0]["sections"][0]["cdes"][0]["value"], 1)
+
+        record = ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                                     context_id=self.default_context.pk, data={"forms": []})
+        wrapper = DynamicDataWrapper(self.patient, rdrf_context_id=self.default_context.pk)
+        expected = []
+        with override_settings(HISTORY_KEYFRAME_INTERVAL=2):
+            for name in ["Fred", "Barney", "Wilma"]:
+                record.data["forms"] = [{"name": "simple", "sections": [
+                    {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": name}]}]}]
+                expected.append(deepcopy(record.data))
+                wrapper.save_snapshot(self.registry.code, "cdes", record=record)
+
+        history = ClinicalData.objects.collection(self.registry.code, "history").find(self.patient, record_type="snapshot")
+
+        def check(deltas):
+            self.assertEqual([is_delta(data) for data in history.data()], deltas)
+            self.assertEqual([snapshot["record"] for snapshot in history.snapshots()], expected)
+
+        check([False, True, False])
+        call_command("compact_history", expand=True, stdout=StringIO())
+        check([False, False, False])
+        with override_settings(HISTORY_KEYFRAME_INTERVAL=3):
+            call_command("compact_history", stdout=StringIO())
+        check([False, True, True])
+
+    def test_cde_history_index(self):
+        from importlib import import_module
+        from io import StringIO
+        from unittest import mock
+        from django.apps import apps as django_apps
+        from django.db import connections
+        from rdrf.db.dynamic_data import DynamicDataWrapper
+        from rdrf.models.history_models import CdeHistory
+
+        record = ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                                     context_id=self.default_context.pk, data={"forms": []})
+        wrapper = DynamicDataWrapper(self.patient, rdrf_context_id=self.default_context.pk)
+        for name in ["Fred", "Fred", "Barney"]:
+            record.data["forms"] = [{"name": "simple", "sections": [
+                {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": name}]},
+                {"code": "sectionC", "allow_multiple": True, "cdes": [[{"code": "CDEAge", "value": 1}]]},
+            ]}]
+            wrapper.save_snapshot(self.registry.code, "cdes", record=record)
+
+        def history(section_code, cde_code):
+            return [entry["value"] for entry in wrapper.get_cde_history(self.registry.code, "simple", section_code, cde_code)]
+
+        self.assertEqual(history("sectionA", "CDEName"), ["Fred", "Barney"])
+        self.assertEqual(history("sectionC", "CDEAge"), [[1]])
+        # the restore buttons look entries up by id
+        self.assertEqual([entry["id"] for entry in wrapper.get_cde_history(self.registry.code, "simple", "sectionA", "CDEName")],
+                         ["0", "1"])
+
+        CdeHistory.objects.all().delete()
+        call_command("index_history", stdout=StringIO())
+        self.assertEqual(history("sectionA", "CDEName"), ["Fred", "Barney"])
+        self.assertEqual(history("sectionC", "CDEAge"), [[1]])
+
+        # history saved before the index existed is indexed when migrating
+        CdeHistory.objects.all().delete()
+        backfill = import_module("rdrf.migrations.0150_backfill_cdehistory").backfill_cde_history
+        backfill(django_apps, mock.Mock(connection=connections["clinical"]))
+        self.assertEqual(history("sectionA", "CDEName"), ["Fred", "Barney"])
+        self.assertEqual(history("sectionC", "CDEAge"), [[1]])
+
+    def test_history_failure_does_not_fail_save(self):
+        from unittest import mock
+        from django.db import DatabaseError
+        from rdrf.db.dynamic_data import DynamicDataWrapper
+        from rdrf.models.history_models import CdeHistory
+
+        record = ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                                     context_id=self.default_context.pk, data={"forms": []})
+        wrapper = DynamicDataWrapper(self.patient, rdrf_context_id=self.default_context.pk)
+        with mock.patch.object(CdeHistory.objects, "bulk_create", side_effect=DatabaseError("index")):
+            with self.assertLogs("rdrf.db.dynamic_data", level="ERROR"):
+                wrapper.save_snapshot(self.registry.code, "cdes", record=record)
+        # the snapshot goes with its index rows
+        self.assertFalse(ClinicalData.objects.collection(self.registry.code, "history").exists())
+
+
+class CompiledRegistryTestCase(FormTestCase):
+    def test_compiled_definition_matches_models(self):
+        from rdrf.helpers.compiled_registry import CompiledRegistry
+
+        compiled = CompiledRegistry.build(self.registry)
+        compiled_form = compiled.get_form(self.simple_form.name)
+        self.assertEqual(
+            [section_model.code for section_model in compiled_form.section_models],
+            ["sectionA", "sectionB"],
+        )
+        self.assertEqual(
+            [cde_model.code for cde_model in compiled.get_section("sectionB").cde_models],
+            ["CDEHeight", "CDEWeight", "CDEBMI"],
+        )
+        self.assertEqual(
+            [form_model.name for form_model in compiled.form_models],
+            [form_model.name for form_model in RegistryForm.objects.filter(registry=self.registry).order_by("position")],
+        )
+
+    def test_missing_definitions_raise_does_not_exist(self):
+        from rdrf.helpers.compiled_registry import CompiledRegistry
+
+        compiled = CompiledRegistry.build(self.registry)
+        with self.assertRaises(RegistryForm.DoesNotExist):
+            compiled.get_form("nosuchform")
+        with self.assertRaises(Section.DoesNotExist):
+            compiled.get_section("nosuchsection")
+        with self.assertRaises(CommonDataElement.DoesNotExist):
+            compiled.get_cde("nosuchcde")
+
+    def test_section_edit_invalidates_compiled_definition(self):
+        from django.test import override_settings
+        from rdrf.helpers.compiled_registry import definition_cache
+
+        caches_setting = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "queries": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "queries"},
+        }
+        with override_settings(CACHE_DISABLED=False, CACHES=caches_setting):
+            definition_cache.invalidate()
+            self.assertEqual(
+                [cde_model.code for cde_model in self.sectionA.cde_models], ["CDEName", "CDEAge"]
+            )
+            section_model = Section.objects.get(code="sectionA")
+            section_model.elements = "CDEAge"
+            section_model.save()
+            self.assertEqual(
+                [cde_model.code for cde_model in Section.objects.get(code="sectionA").cde_models], ["CDEAge"]
+            )
+            form_model = RegistryForm.objects.get(pk=self.simple_form.pk)
+            self.assertEqual(
+                [cde_model.code for cde_model in form_model.section_models[0].cde_models], ["CDEAge"]
+            )
+            definition_cache.invalidate()
+
+
+class CalculationGraphTestCase(RDRFTestCase):
+    def _graph(self):
+        # in the fh ClinicalData form, LDLCholesterolAdjTreatment is an input of
+        # CDEfhDutchLipidClinicNetwork and both are inputs of CDE00024
+        from rdrf.helpers.compiled_registry import CompiledRegistry
+        from rdrf.helpers.recalc_logic import CalculationGraph
+
+        for cde_model in CommonDataElement.objects.filter(
+                code__in=["LDLCholesterolAdjTreatment", "CDEfhDutchLipidClinicNetwork", "CDE00024"]):
+            cde_model.datatype = "calculated"
+            cde_model.save()
+        return CalculationGraph(CompiledRegistry.build(Registry.objects.get(code="fh")))
+
+    def test_affected_outputs_are_transitive_and_ordered(self):
+        graph = self._graph()
+        self.assertEqual(graph.affected_outputs(["CDE00019"]),
+                         ["LDLCholesterolAdjTreatment", "CDEfhDutchLipidClinicNetwork", "CDE00024"])
+        self.assertEqual(graph.affected_outputs(["FHPersHistCerebralVD"]), ["CDEfhDutchLipidClinicNetwork", "CDE00024"])
+        self.assertEqual(graph.affected_outputs(["CDEHeight"]), ["CDEBMI"])
+        self.assertEqual(graph.affected_outputs(["CDEName"]), [])
+        self.assertEqual(graph.level("LDLCholesterolAdjTreatment"), 0)
+        self.assertEqual(graph.level("CDE00024"), 2)
+
+    def test_cycles_do_not_loop(self):
+        from unittest import mock
+
+        with mock.patch.object(calculated_functions, "CDEBMI_inputs", lambda: ["CDE00024"]), \
+                mock.patch.object(calculated_functions, "CDE00024_inputs", lambda: ["CDEBMI"]):
+            graph = self._graph()
+        self.assertEqual(graph.affected_outputs(["CDEBMI"]), ["CDE00024", "CDEBMI"])
+
+    def test_form_outputs_are_in_dependency_order(self):
+        graph = self._graph()
+        self.assertEqual(graph.form_outputs("ClinicalData"),
+                         ["CDEBMI", "LDLCholesterolAdjTreatment", "CDEfhDutchLipidClinicNetwork", "CDE00024"])
+        self.assertEqual(graph.form_outputs("GeneticData"), [])
+        self.assertEqual(graph.form_outputs("Missing"), [])
+
+
+class FormSaveTestCase(FormTestCase):
+    def post(self, **values):
+        ff = FormFiller(self.simple_form)
+        for cde_code, value in values.items():
+            setattr(ff.sectionA, cde_code, value)
+        request = self._create_request(self.simple_form, ff.data)
+        view = FormView()
+        view.request = request
+        view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.default_context.pk)
+
+    def test_form_save_writes_record_once(self):
+        from django.db import connections, router
+        from django.test.utils import CaptureQueriesContext
+
+        def post():
+            ff = FormFiller(self.simple_form)
+            ff.sectionA.CDEName = "Fred"
+            ff.sectionA.CDEAge = 20
+            ff.sectionB.CDEHeight = 1.73
+            ff.sectionB.CDEWeight = 88.23
+            request = self._create_request(self.simple_form, ff.data)
+            view = FormView()
+            view.request = request
+            view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.default_context.pk)
+
+        post()
+        connection = connections[router.db_for_write(ClinicalData)]
+        with CaptureQueriesContext(connection) as queries:
+            post()
+        writes = [q["sql"] for q in queries.captured_queries
+                  if q["sql"].startswith(('UPDATE "rdrf_clinicaldata"', 'INSERT INTO "rdrf_clinicaldata"'))]
+        # the cdes record, the progress record and one snapshot
+        self.assertEqual(len(writes), 3)
+
+        record = ClinicalData.objects.collection(self.registry.code, "cdes").find(
+            self.patient, self.default_context.pk).data().first()
+        sections = {section["code"] for section in record["forms"][0]["sections"]}
+        self.assertEqual(sections, {"sectionA", "sectionB"})
+        snapshots = ClinicalData.objects.collection(self.registry.code, "history").find(self.patient)
+        self.assertEqual(snapshots.count(), 2)
+
+    def test_snapshot_taken_after_recalculation(self):
+        from rdrf.custom_signals import clinical_data_saved_ok
+        from rdrf.db.dynamic_data import CdeIndex
+
+        def recalculate(sender, patient, saved_sections, **kwargs):
+            # as the recalculation receiver does, save a value straight to the record
+            patient.set_form_value(self.registry.code, self.simple_form.name, "sectionA", "CDEAge", 99,
+                                   context_model=self.default_context)
+
+        clinical_data_saved_ok.connect(recalculate, sender=ClinicalData)
+        try:
+            self.post(CDEName="Fred", CDEAge=20)
+        finally:
+            clinical_data_saved_ok.disconnect(recalculate, sender=ClinicalData)
+
+        history = ClinicalData.objects.collection(self.registry.code, "history").find(self.patient, record_type="snapshot")
+        snapshot = list(history.snapshots())[-1]
+        self.assertEqual(snapshot["form_name"], self.simple_form.name)
+        self.assertEqual(CdeIndex(snapshot["record"]).get(self.simple_form.name, "sectionA", "CDEAge"), 99)
+
+    @override_settings(USE_CELERY=True, FORM_SAVE_TASKS=True,
+                       CACHES=dict(settings.CACHES, redis={"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}))
+    def test_deferred_snapshot_taken_after_recalculation(self):
+        from rdrf.custom_signals import clinical_data_saved_ok
+        from rdrf.db.dynamic_data import CdeIndex
+        from rdrf.helpers import form_save_queue
+
+        def recalculate(sender, patient, saved_sections, **kwargs):
+            patient.set_form_value(self.registry.code, self.simple_form.name, "sectionA", "CDEAge", 99,
+                                   context_model=self.default_context)
+
+        history = ClinicalData.objects.collection(self.registry.code, "history").find(self.patient, record_type="snapshot")
+        with self.captureOnCommitCallbacks():
+            self.post(CDEName="Fred", CDEAge=20)
+        # the snapshot is left to the task
+        self.assertFalse(history.exists())
+
+        key = "form_save_pending_%s_%s" % (self.patient.pk, self.default_context.pk)
+        pending = form_save_queue.take(self.patient.pk, self.default_context.pk,
+                                       form_save_queue.caches["redis"].get(key)["token"])
+        clinical_data_saved_ok.connect(recalculate, sender=ClinicalData)
+        try:
+            form_save_queue.run(pending["registry_code"], self.patient.pk, self.default_context.pk,
+                                pending["sections"], pending["snapshot_users"])
+        finally:
+            clinical_data_saved_ok.disconnect(recalculate, sender=ClinicalData)
+
+        snapshot = list(history.snapshots())[-1]
+        self.assertEqual(snapshot["form_name"], self.simple_form.name)
+        self.assertEqual(snapshot["form_user"], "curator")
+        self.assertEqual(CdeIndex(snapshot["record"]).get(self.simple_form.name, "sectionA", "CDEAge"), 99)
+
+    def test_replaced_file_deleted_on_commit(self):
+        from django.db import router
+        from rdrf.db.dynamic_data import DynamicDataWrapper
+        from rdrf.models.definition.models import CDEFile
+
+        cde_file = CDEFile.objects.create(registry_code=self.registry.code, cde_code="CDEFile", filename="a.txt")
+        current_value = {"django_file_id": cde_file.pk, "file_name": "a.txt"}
+        with self.captureOnCommitCallbacks(using=router.db_for_write(ClinicalData), execute=True) as callbacks:
+            # a cleared file input
+            self.assertIsNone(DynamicDataWrapper.handle_file_upload(self.registry.code, "key", False, current_value))
+            self.assertTrue(CDEFile.objects.filter(pk=cde_file.pk).exists())
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(CDEFile.objects.filter(pk=cde_file.pk).exists())
+
+
+class FormProgressTestCase(FormTestCase):
+    def test_form_progress_only_recalculates_changed_forms(self):
+        from rdrf.db.dynamic_data import CdeIndex
+        from rdrf.forms.progress.form_progress import FormProgress
+
+        def record(name, items):
+            return {
+                "forms": [
+                    {
+                        "name": self.simple_form.name,
+                        "sections": [
+                            {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": name}]},
+                        ],
+                    },
+                    {
+                        "name": self.multi_form.name,
+                        "sections": [
+                            {"code": "sectionC", "allow_multiple": True, "cdes": [[{"code": "CDEName", "value": v}] for v in items]},
+                        ],
+                    },
+                ]
+            }
+
+        cde_index = CdeIndex(record("Fred", ["A", None]))
+        self.assertEqual(cde_index.get(self.simple_form.name, "sectionA", "CDEName"), "Fred")
+        self.assertEqual(cde_index.get_all(self.multi_form.name, "sectionC", "CDEName"), ["A", None])
+        self.assertEqual(cde_index.num_items(self.multi_form.name, "sectionC"), 2)
+        self.assertEqual(cde_index.forms_with_data, {self.simple_form.name, self.multi_form.name})
+
+        FormProgress(self.registry).save_progress(self.patient, record("Fred", ["A"]), self.default_context)
+        # only the simple form is recalculated, the multi form keeps its stored metrics
+        progress = FormProgress(self.registry).save_progress(self.patient, record(None, []), self.default_context,
+                                                             form_names=[self.simple_form.name])
+        self.assertFalse(progress[self.simple_form.name + "_form_has_data"])
+        self.assertTrue(progress[self.multi_form.name + "_form_has_data"])
+
+        progress = FormProgress(self.registry).save_progress(self.patient, record(None, []), self.default_context)
+        self.assertFalse(progress[self.multi_form.name + "_form_has_data"])
+
+        # stored metrics of another version of a form's definition aren't reused
+        FormProgress(self.registry).save_progress(self.patient, record("Fred", ["A"]), self.default_context)
+        self.sectionC.elements = "CDEName,CDEAge"
+        self.sectionC.save()
+        progress = FormProgress(self.registry).save_progress(self.patient, record(None, []), self.default_context,
+                                                             form_names=[self.simple_form.name])
+        self.assertFalse(progress[self.multi_form.name + "_form_has_data"])
+
+    def test_form_group_captions_use_prefetched_forms(self):
+        from rdrf.forms.components import FormGroupButton
+        from rdrf.models.definition.models import ContextFormGroup, ContextFormGroupItem
+
+        direct_group = ContextFormGroup.objects.create(registry=self.registry, name="Direct")
+        ContextFormGroupItem.objects.create(context_form_group=direct_group, registry_form=self.simple_form)
+        group = ContextFormGroup.objects.create(registry=self.registry, name="Group")
+        for form_model in (self.simple_form, self.multi_form):
+            ContextFormGroupItem.objects.create(context_form_group=group, registry_form=form_model)
+
+        form_groups = [form_group for form_group in self.registry.fixed_form_groups
+                       if form_group.pk in (direct_group.pk, group.pk)]
+        with self.assertNumQueries(0):
+            captions = [FormGroupButton(self.registry, None, self.patient, form_group).button_caption
+                        for form_group in form_groups]
+        self.assertEqual(captions, [self.simple_form.nice_name, "Group"])
+
+    def test_progress_loaded_for_listing_page(self):
+        from rdrf.forms.progress.form_progress import FormProgress
+        from rdrf.helpers.utils import consent_checked_patients
+
+        form_progress = FormProgress(self.registry)
+        form_progress.save_progress(self.patient, {"forms": []}, self.default_context)
+        loaded = form_progress.load_for_patients([self.patient.pk, 0])
+        self.assertEqual(list(loaded), [self.patient.pk])
+        form_progress.use_loaded(self.patient, loaded[self.patient.pk])
+        self.assertEqual(form_progress.loaded_data, form_progress._load(self.patient))
+
+        superuser = CustomUser(username="listing_admin", is_superuser=True)
+        self.assertEqual(consent_checked_patients(self.registry, superuser, [self.patient], "see_patient"),
+                         {self.patient.pk})
+
+    def test_progress_summary_sorts_listing(self):
+        from rdrf.models.progress_models import ProgressSummary
+        from rdrf.views.patients_listing import ColumnDiagnosisCurrency, ColumnDiagnosisProgress
+
+        ProgressSummary.update(self.patient, self.registry, {"diagnosis_group_progress": 50,
+                                                             "diagnosis_group_current": True,
+                                                             "genetic_group_has_data": False,
+                                                             "simple_form_progress": {}})
+        ProgressSummary.update(self.patient, self.registry, {"diagnosis_group_progress": 75})
+        summary = ProgressSummary.objects.get(patient=self.patient, registry=self.registry, group="diagnosis")
+        self.assertEqual(summary.progress, 75)
+        self.assertEqual(ProgressSummary.objects.filter(patient=self.patient).count(), 2)
+
+        patients = Patient.objects.filter(pk=self.patient.pk)
+        column = ColumnDiagnosisProgress("label", "perm")
+        column.registry = self.registry
+        sort_field = column.sort_fields[0]
+        self.assertEqual(column.annotate_sort(patients).values_list(sort_field, flat=True).get(), 75)
+        column = ColumnDiagnosisCurrency("label", "perm")
+        column.registry = self.registry
+        self.assertEqual(column.annotate_sort(patients).values_list(column.sort_fields[0], flat=True).get(), 1)
+
+
+class PatientSearchTestCase(FormTestCase):
+    def test_patient_search_index(self):
+        self.patient.family_name = "Sawyer"
+        self.patient.given_names = "Thomas"
+        self.patient.save(update_fields=["family_name", "given_names"])
+        self.assertEqual(Patient.objects.get(pk=self.patient.pk).search_text, "sawyer thomas")
+
+        self.assertEqual(list(Patient.objects.search("SAWY")), [self.patient])
+        self.assertEqual(list(Patient.objects.search("smith")), [])
+        # misspelt type-ahead terms still find the patient
+        self.assertEqual(list(Patient.objects.lookup("sawyre thomas")), [self.patient])
+        # not an index patient without family linkage
+        self.assertEqual(list(Patient.objects.lookup("sawyer").index_patients()), [])
+
+    def test_bulk_writes_keep_search_text(self):
+        Patient.objects.filter(pk=self.patient.pk).update(family_name="Finn", given_names="Huckleberry")
+        self.assertEqual(Patient.objects.get(pk=self.patient.pk).search_text, "finn huckleberry")
+
+        self.patient.refresh_from_db()
+        self.patient.family_name = "Thatcher"
+        Patient.objects.bulk_update([self.patient], ["family_name"])
+        self.assertEqual(list(Patient.objects.search("thatcher huck")), [self.patient])
+
+
+class FieldValueLoaderTestCase(FormTestCase):
+    def _save_record(self):
+        data = {
+            "forms": [
+                {
+                    "name": self.simple_form.name,
+                    "sections": [
+                        {
+                            "code": "sectionA",
+                            "allow_multiple": False,
+                            "cdes": [{"code": "CDEName", "value": "Fred"}, {"code": "CDEAge", "value": 20}],
+                        },
+                    ],
+                },
+                {
+                    "name": self.multi_form.name,
+                    "sections": [
+                        {
+                            "code": "sectionC",
+                            "allow_multiple": True,
+                            "cdes": [
+                                [{"code": "CDEName", "value": "A"}],
+                                [{"code": "CDEName", "value": "B"}, {"code": "NOSUCHCDE", "value": 1}],
+                            ],
+                        },
+                    ],
+                },
+            ]
+        }
+        ClinicalData.create(
+            self.patient, registry_code=self.registry.code, collection="cdes",
+            data=data, context_id=self.default_context.pk
+        ).save()
+
+    def test_bulk_rebuild_matches_record(self):
+        from explorer.models import FieldValue
+        from explorer.utils import FieldValueLoader
+
+        self._save_record()
+        records, rows = FieldValueLoader(self.registry).rebuild()
+        self.assertEqual((records, rows), (1, 4))
+        # rebuilding replaces rather than duplicates
+        FieldValueLoader(self.registry, batch_size=1).rebuild()
+        field_values = FieldValue.objects.filter(registry=self.registry, patient=self.patient)
+        self.assertEqual(field_values.count(), 4)
+        self.assertEqual(
+            sorted(field_values.filter(section__code="sectionC").values_list("index", "raw_value")),
+            [(0, "A"), (1, "B")],
+        )
+        self.assertEqual(field_values.get(cde__code="CDEName", section__code="sectionA").raw_value, "Fred")
+
+    def test_report_rows_pivot_field_values(self):
+        from explorer.models import FieldValue
+        from explorer.utils import DatabaseUtils, FieldValueLoader
+
+        self._save_record()
+        FieldValueLoader(self.registry).rebuild()
+        field_values = FieldValue.objects.filter(registry=self.registry, patient=self.patient)
+
+        # report rows pivot the stored values per patient context
+        database_utils = DatabaseUtils()
+        database_utils.registry_model = self.registry
+        columns = list(field_values.values_list("column_name", flat=True))
+        rows = list(database_utils._pivot_page([{"id": self.patient.pk}], {c: None for c in columns}, columns, 1))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["context_id"], self.default_context.pk)
+        name_column = field_values.get(cde__code="CDEName", section__code="sectionA").column_name
+        self.assertEqual(rows[0][name_column], "Fred")
+        # index 1 of the multisection is beyond max_items
+        self.assertEqual(sum(1 for c in columns if rows[0][c] is not None), 3)
+
+    def test_partitions_are_rebuilt_in_place(self):
+        from explorer.models import FieldValue
+        from explorer.utils import FieldValueLoader
+        from rdrf.management.commands.create_field_values import load_partition
+
+        data = {"forms": [{"name": self.simple_form.name, "sections": [
+            {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": "Fred"}]}]}]}
+        ClinicalData.create(
+            self.patient, registry_code=self.registry.code, collection="cdes",
+            data=data, context_id=self.default_context.pk
+        ).save()
+
+        def field_values():
+            return FieldValue.objects.filter(registry=self.registry, patient=self.patient)
+
+        pk = self.patient.pk
+        self.assertEqual(load_partition((self.registry.code, (pk, pk), 500, 5000)), (1, 1))
+        self.assertEqual(load_partition((self.registry.code, (pk, pk), 500, 5000)), (1, 1))
+        self.assertEqual(field_values().count(), 1)
+        # another partition leaves the patient's rows alone
+        self.assertEqual(load_partition((self.registry.code, (pk + 1, pk + 100), 500, 5000)), (0, 0))
+        self.assertEqual(field_values().count(), 1)
+
+        self.patient.rdrf_registry.clear()
+        FieldValueLoader(self.registry).delete_others()
+        self.assertFalse(field_values().exists())
+
+    def test_form_save_updates_changed_field_values(self):
+        from explorer.models import FieldValue
+
+        def post(**values):
+            ff = FormFiller(self.simple_form)
+            for cde_code, value in values.items():
+                setattr(ff.sectionA, cde_code, value)
+            request = self._create_request(self.simple_form, ff.data)
+            view = FormView()
+            view.request = request
+            view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.default_context.pk)
+
+        def field_values():
+            return FieldValue.objects.filter(registry=self.registry, patient=self.patient, context=self.default_context)
+
+        post(CDEName="Fred", CDEAge=20)
+        self.assertEqual(field_values().get(cde__code="CDEName").raw_value, "Fred")
+        age_row = field_values().get(cde__code="CDEAge")
+
+        post(CDEName="Barney", CDEAge=20)
+        self.assertEqual(field_values().get(cde__code="CDEName").raw_value, "Barney")
+        # unchanged values keep their rows
+        self.assertEqual(field_values().get(cde__code="CDEAge").pk, age_row.pk)
+
+
+class VisualisationDataTestCase(FormTestCase):
+    def test_visualisation_data_refreshed_incrementally(self):
+        import tempfile
+        from io import StringIO
+        from unittest import mock
+        from dashboards import data as dashboard_data
+        from dashboards.data import RegistryDataFrame
+        from dashboards.models import VisualisationBaseDataConfig
+
+        def record(value):
+            return {"forms": [{"name": self.simple_form.name, "sections": [
+                {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": value}]}]}]}
+
+        patient_data = ClinicalData.objects.create(registry_code=self.registry.code, collection="cdes",
+                                                   django_model="Patient", django_id=self.patient.pk,
+                                                   context_id=self.default_context.pk, data=record("Fred"))
+        other_patient = self.create_patient()
+        ClinicalData.objects.create(registry_code=self.registry.code, collection="cdes",
+                                    django_model="Patient", django_id=other_patient.pk,
+                                    context_id=self.default_context.pk, data=record("Barney"))
+        config = VisualisationBaseDataConfig.objects.create(
+            code="test", registry=self.registry, state="E",
+            config={"fields": ["CDEName"], "baseline_form": self.simple_form.name,
+                    "followup_form": self.simple_form.name})
+
+        extracted = []
+        get_patient_rows = RegistryDataFrame._get_patient_rows
+
+        def recording_patient_rows(rdf, pid, cds):
+            extracted.append(pid)
+            return get_patient_rows(rdf, pid, cds)
+
+        def generate():
+            out = StringIO()
+            del extracted[:]
+            dashboard_data._base_data.clear()
+            call_command("generate_visualisation_dataframe", stdout=out)
+            config.refresh_from_db()
+            df = RegistryDataFrame(self.registry, config).data
+            return out.getvalue(), dict(zip(df["PID"], df["CDEName"]))
+
+        both = sorted([self.patient.pk, other_patient.pk])
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(VISUALISATION_BASE_DATA_DIRECTORY=directory), \
+                mock.patch.object(RegistryDataFrame, "_get_patient_rows", recording_patient_rows):
+            with mock.patch.object(dashboard_data, "CHANGED_SINCE_OVERLAP", timedelta(0)):
+                out, values = generate()
+                self.assertEqual(values, {self.patient.pk: "Fred", other_patient.pk: "Barney"})
+                self.assertEqual(sorted(extracted), both)
+
+                patient_data.data = record("George")
+                patient_data.save()
+                out, values = generate()
+                self.assertEqual(values, {self.patient.pk: "George", other_patient.pk: "Barney"})
+                self.assertEqual(extracted, [self.patient.pk])
+
+                out, values = generate()
+                self.assertIn("no changes", out)
+                self.assertEqual(extracted, [])
+
+                # bulk updates bypass auto_now
+                ClinicalData.objects.filter(pk=patient_data.pk).update(data=record("Ringo"))
+                out, values = generate()
+                self.assertEqual(values, {self.patient.pk: "Ringo", other_patient.pk: "Barney"})
+                self.assertEqual(extracted, [self.patient.pk])
+
+                # which patients are active isn't seen from the changed records
+                Patient.objects.filter(pk=other_patient.pk).update(active=False)
+                out, values = generate()
+                self.assertEqual(values, {self.patient.pk: "Ringo"})
+                self.assertEqual(extracted, [self.patient.pk])
+
+                Patient.objects.really_all().filter(pk=other_patient.pk).update(active=True)
+                out, values = generate()
+                self.assertEqual(values, {self.patient.pk: "Ringo", other_patient.pk: "Barney"})
+                self.assertEqual(sorted(extracted), both)
+
+                # a new patient's records are changed records
+                new_patient = self.create_patient()
+                ClinicalData.objects.create(registry_code=self.registry.code, collection="cdes",
+                                            django_model="Patient", django_id=new_patient.pk,
+                                            context_id=self.default_context.pk, data=record("Betty"))
+                out, values = generate()
+                self.assertEqual(values[new_patient.pk], "Betty")
+                self.assertEqual(extracted, [new_patient.pk])
+
+                patient_data.delete()
+                out, values = generate()
+                self.assertNotIn(self.patient.pk, values)
+                self.assertEqual(sorted(extracted), sorted([other_patient.pk, new_patient.pk]))
+
+            # a record stamped before the last run but committed after it
+            late = config.data_as_of - timedelta(minutes=1)
+            ClinicalData.objects.filter(django_id=other_patient.pk).update(data=record("Wilma"), updated=late)
+            out, values = generate()
+            self.assertEqual(values[other_patient.pk], "Wilma")
+            dashboard_data._base_data.clear()
+
+
+class RowLoaderTestCase(TestCase):
+    def test_rows_are_flushed_in_batches(self):
+        import sqlalchemy as alc
+        from rdrf.services.io.reporting.loader import RowLoader, stream_rows
+
+        engine = alc.create_engine("sqlite://")
+        table = alc.Table("loader_test", alc.MetaData(engine),
+                          alc.Column("id", alc.Integer), alc.Column("name", alc.String, nullable=True))
+        table.create()
+        with RowLoader(engine, table, buffer_size=2) as row_loader:
+            row_loader.extend({"id": i, "name": None if i % 2 else str(i)} for i in range(5))
+            # two full batches written, one row still buffered
+            self.assertEqual(row_loader.row_count, 4)
+        self.assertEqual(row_loader.row_count, 5)
+        rows = list(stream_rows(engine, table.select().order_by(table.c.id), chunk_size=2))
+        self.assertEqual([row["name"] for row in rows], ["0", None, "2", None, "4"])
+
+    def test_copy_round_trips_values(self):
+        import sqlalchemy as alc
+        from rdrf.reports.generator import pg_uri
+        from rdrf.services.io.reporting.loader import RowLoader, stream_rows
+
+        engine = alc.create_engine(pg_uri(settings.DATABASES["default"]))
+        table = alc.Table("loader_copy_test", alc.MetaData(engine),
+                          alc.Column("id", alc.Integer), alc.Column("name", alc.String, nullable=True))
+        values = [None, "\\N", "", "a,b", "two\nlines", 'say "hi"']
+        table.create()
+        try:
+            with RowLoader(engine, table) as row_loader:
+                self.assertTrue(row_loader.use_copy)
+                row_loader.extend({"id": i, "name": value} for i, value in enumerate(values))
+            rows = list(stream_rows(engine, table.select().order_by(table.c.id)))
+            self.assertEqual([row["name"] for row in rows], values)
+        finally:
+            table.drop()
+            engine.dispose()
+
+
+class DemographicExportTestCase(TransactionTestCase):
+    # the generator reads through its own connections, so the data is committed
+    databases = {"default", "clinical"}
+    fixtures = ["testing_auth", "testing_users", "testing_rdrf"]
+
+    def test_patient_exported_with_dependents(self):
+        from rdrf.models.definition.models import ConsentQuestion, ConsentSection
+        from rdrf.reports.generator import Generator
+        from registry.patients.models import ConsentValue
+
+        registry = Registry.objects.get(code="fh")
+        patient = Patient.objects.create(
+            consent=True, given_names="Harry", family_name="Potter",
+            date_of_birth=datetime(1978, 6, 15), sex="1")
+        patient.rdrf_registry.set([registry])
+        PatientAddress.objects.create(
+            patient=patient, address_type=AddressType.objects.get_or_create(pk=1)[0],
+            address="1 Line St", suburb="Neverland", state="WA", postcode="1111")
+        consent_section = ConsentSection.objects.create(
+            code="export", section_label="Export", registry=registry)
+        question = ConsentQuestion.objects.create(
+            code="export", section=consent_section, question_label="Export?")
+        ConsentValue.objects.create(patient=patient, consent_question=question, answer=True)
+
+        generator = Generator(registry, db="clinical")
+        generator._create_staging_schema()
+        try:
+            generator._create_demographic_tables()
+            with generator.reporting_engine.connect() as conn:
+                for model in (Patient, PatientAddress, ConsentValue):
+                    count = conn.execute('SELECT COUNT(*) FROM %s."%s"' % (
+                        generator.staging_schema, model._meta.db_table)).scalar()
+                    self.assertEqual(count, model.objects.count())
+        finally:
+            with generator.reporting_engine.begin() as conn:
+                conn.execute("DROP SCHEMA IF EXISTS %s CASCADE" % generator.staging_schema)
+            for engine in (generator.clinical_engine, generator.default_engine):
+                engine.dispose()
+
+
+class PermittedValueDisplayTestCase(TestCase):
+    def setUp(self):
+        self.pvg = CDEPermittedValueGroup.objects.create(code="TestColours")
+        for position, (code, value) in enumerate([("r", "Red"), ("g", "Green"), ("b", "Blue")]):
+            CDEPermittedValue.objects.create(
+                pv_group=self.pvg, code=code, value=value, position=position
+            )
+        self.single = CommonDataElement.objects.create(
+            code="TestColour", name="Colour", datatype="range", pv_group=self.pvg
+        )
+        self.multiple = CommonDataElement.objects.create(
+            code="TestColours", name="Colours", datatype="range", pv_group=self.pvg, allow_multiple=True
+        )
+
+    def test_display_value_lookup(self):
+        self.assertEqual(self.single.get_display_value("g"), "Green")
+        self.assertEqual(self.single.get_display_value("x"), "x")
+        self.assertEqual(self.single.get_display_value(None), "")
+        self.assertEqual(self.multiple.get_display_value(["b", "x", "r"]), "Blue+Red")
+        self.assertEqual(self.single.pv_index.position("b"), 2)
+
+    def test_batch_matches_single_lookups(self):
+        raw_values = ["r", "b", None, "NaN", "x", "g"]
+        self.assertEqual(
+            self.single.get_display_values(raw_values),
+            [self.single.get_display_value(value) for value in raw_values],
+        )
+
+    def test_index_reflects_changed_values(self):
+        from rdrf.helpers.compiled_registry import definition_cache
+
+        # settings_test disables caching, which would build a new index per lookup
+        caches_setting = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "queries": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "queries"},
+        }
+        with override_settings(CACHE_DISABLED=False, CACHES=caches_setting):
+            definition_cache.invalidate()
+            self.assertEqual(self.single.get_display_value("r"), "Red")
+            self.assertIs(self.single.pv_index, self.single.pv_index)
+
+            pv = CDEPermittedValue.objects.get(pv_group=self.pvg, code="r")
+            pv.value = "Crimson"
+            with self.captureOnCommitCallbacks(execute=True):
+                pv.save()
+            self.assertEqual(self.single.get_display_value("r"), "Crimson")
+            definition_cache.invalidate()
+
 
 class DeCamelcaseTestCase(TestCase):
 
@@ -1579,6 +2407,35 @@ class TimeStripperTestCase(TestCase):
             "Expected: %s, Actual: %s" % (expected_dates, ts.converted_date_cdes),
         )
 
+    def test_delta_history_munging(self):
+        from rdrf.db.history import SnapshotDecoder, delta_data
+        from rdrf.helpers.utils import HistoryTimeStripper
+
+        def snapshot(consent_date):
+            return {"django_id": 1, "record_type": "snapshot", "record": {"forms": [{"name": "ClinicalData", "sections": [
+                {"code": "fhDateSection", "allow_multiple": False, "cdes": [
+                    {"code": "CDEIndexOrRelative", "value": "fh_is_index"},
+                    {"code": "FHconsentDate", "value": consent_date}]}]}]}}
+
+        keyframe = snapshot("2017-02-14T00:00:00.000")
+        changed = snapshot("2017-02-15T00:00:00.000")
+        delta = delta_data(changed, 1, 1, keyframe["record"])
+        # a delta which doesn't change the date still decodes to the stored one
+        unchanged = delta_data(snapshot("2017-02-15T00:00:00.000"), 2, 2, changed["record"])
+        rows = [FakeClinicalData(1, keyframe), FakeClinicalData(2, delta), FakeClinicalData(3, unchanged)]
+
+        ts = HistoryTimeStripper(rows)
+        ts.test_mode = True
+        ts.date_cde_codes = ["FHconsentDate"]
+        ts.forward()
+
+        self.assertEqual(ts.num_updates, 3)
+        self.assertEqual([row.data.get("encoding") for row in rows], [None, "delta", "delta"])
+        decoder = SnapshotDecoder()
+        consent_dates = [decoder.decode(row.pk, row.data)["record"]["forms"][0]["sections"][0]["cdes"][1]["value"]
+                         for row in rows]
+        self.assertEqual(consent_dates, ["2017-02-14", "2017-02-15", "2017-02-15"])
+
 
 class MinTypeTest(TestCase):
     def test_string(self):
@@ -1948,6 +2805,96 @@ class RemindersTestCase(TestCase):
         ), "Expected reminder NOT to be sent if two or more already sent"
 
 
+class CdeIndexTestCase(TestCase):
+    def test_cde_index_reads_and_writes_the_document(self):
+        from rdrf.db.dynamic_data import CdeIndex
+        data = {
+            "forms": [
+                {
+                    "name": "F",
+                    "sections": [
+                        {"code": "S", "allow_multiple": False, "cdes": [{"code": "A", "value": "x"}]},
+                        {"code": "M", "allow_multiple": True, "cdes": [[{"code": "B", "value": 1}],
+                                                                       [{"code": "C", "value": 2}]]},
+                    ],
+                },
+            ]
+        }
+        cde_index = CdeIndex(data)
+        self.assertEqual(cde_index.value("F", "S", "A"), "x")
+        self.assertEqual(cde_index.value("F", "M", "B"), [1])
+        self.assertEqual(cde_index.value("F", "M", "X"), [])
+        self.assertIsNone(cde_index.value("F", "S", "X"))
+        self.assertEqual(cde_index.get_item("F", "M", "C", 1), 2)
+        self.assertIsNone(cde_index.get_item("F", "M", "B", 1))
+        self.assertEqual(cde_index.first_value("A"), "x")
+        self.assertIsNone(cde_index.first_value("B"))
+
+        cde_index.set("F", "M", "C", 3, index=1)
+        self.assertEqual(data["forms"][0]["sections"][1]["cdes"][1][0]["value"], 3)
+        cde_index.set("F", "S", "A", "")
+        self.assertEqual(cde_index.filled_codes["F"], {"B", "C"})
+        with self.assertRaises(KeyError):
+            cde_index.set("F", "M", "B", 0, index=1)
+
+        clinical_data = ClinicalData(registry_code="fh", collection="cdes", data=data)
+        self.assertEqual(clinical_data.cde_val("F", "M", "C"), [3])
+        clinical_data.data = {"forms": []}
+        self.assertIsNone(clinical_data.cde_val("F", "M", "C"))
+
+
+class CdePathsTestCase(TestCase):
+    def test_diff_cde_paths(self):
+        from rdrf.db.dynamic_data import cde_paths, diff_cde_paths
+
+        def record(name, items):
+            return {
+                "forms": [
+                    {
+                        "name": "simple",
+                        "sections": [
+                            {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": name}]},
+                            {"code": "sectionC", "allow_multiple": True, "cdes": [[{"code": "CDEAge", "value": v}] for v in items]},
+                        ],
+                    }
+                ]
+            }
+
+        old = cde_paths(record("Fred", [1, 2]))
+        self.assertEqual(old[("simple", "sectionC", 1, "CDEAge")], 2)
+        self.assertEqual(diff_cde_paths(old, cde_paths(record("Fred", [1, 2]))), [])
+        self.assertEqual(
+            diff_cde_paths(old, cde_paths(record("Barney", [1]))),
+            [("simple", "sectionA", 0, "CDEName"), ("simple", "sectionC", 1, "CDEAge")],
+        )
+
+
+class CdeQueryTestCase(FormTestCase):
+    def test_cde_query(self):
+        from rdrf.db.cde_query import patients_where
+
+        ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                            context_id=self.default_context.pk, data={"forms": [
+                                {"name": "simple", "sections": [
+                                    {"code": "sectionA", "allow_multiple": False, "cdes": [{"code": "CDEName", "value": "Fred"},
+                                                                                           {"code": "CDEAge", "value": "42"}]}]},
+                                {"name": "multi", "sections": [
+                                    {"code": "sectionC", "allow_multiple": True, "cdes": [[{"code": "CDEName", "value": "Barney"}],
+                                                                                          [{"code": "CDEName", "value": "Wilma"}]]}]},
+                            ]}).save()
+
+        def matches(*args, **kwargs):
+            return list(patients_where(self.registry, *args, **kwargs)) == [self.patient.pk]
+
+        self.assertTrue(matches("CDEName", "exact", "Fred"))
+        self.assertTrue(matches("CDEName", "exact", "Wilma", form_name="multi"))
+        self.assertFalse(matches("CDEName", "exact", "Fred", form_name="multi"))
+        self.assertTrue(matches("CDEName", "in", ["Betty", "Barney"]))
+        self.assertTrue(matches("CDEAge", "gt", 40))
+        self.assertFalse(matches("CDEAge", "lte", 40))
+        self.assertFalse(matches("CDEAge", "isnull", True))
+
+
 class ClinicalDataTestCase(RDRFTestCase):
     def create_clinicaldata(self, patient_id, registry_code):
         try:
@@ -2087,40 +3034,134 @@ class UpdateCalculatedFieldsTestCase(FormTestCase):
             self.context_id,
         )
 
-    def test_save_new_calculation(self):
-        # Check the CDE value is correctly setup.
+    def test_save_record(self):
+        from rdrf.management.commands.update_calculated_fields import save_record
+
         collection = ClinicalData.objects.collection(self.registry.code, "cdes")
         db_record = collection.find(self.patient, self.context_id).data().first()
-        assert (
-            self.form_value(
-                self.simple_form.name, self.sectionA.code, "CDEAge", db_record
-            )
-            == 20
-        )
-
-        # Change the CDE value and save it.
-        changed_calculated_cdes = {
-            "CDEAge": {"old_value": 20, "new_value": 21, "section_code": "sectionA"}
-        }
-        from rdrf.management.commands.update_calculated_fields import (
-            save_new_calculation,
-        )
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionA.code, "CDEAge", db_record), 20)
 
-        save_new_calculation(
-            changed_calculated_cdes,
-            self.context_id,
-            self.simple_form.name,
-            self.patient,
-            self.registry,
-        )
+        for section in db_record["forms"][0]["sections"]:
+            for cde in section["cdes"]:
+                if cde["code"] == "CDEAge":
+                    cde["value"] = 21
+        save_record(self.patient, self.context_id, self.registry, db_record, [self.simple_form.name])
 
-        # Check that the CDE value has been updated.
         db_record = collection.find(self.patient, self.context_id).data().first()
-
-        cdeage_value = self.form_value(
-            self.simple_form.name, self.sectionA.code, "CDEAge", db_record
-        )
-        self.assertEqual(cdeage_value, 21)
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionA.code, "CDEAge", db_record), 21)
+        self.assertIn("%s_timestamp" % self.simple_form.name, db_record)
+        self.assertEqual(collection.find(self.patient, self.context_id).count(), 1)
+
+    def test_set_form_cde_value(self):
+        from rdrf.management.commands.update_calculated_fields import set_form_cde_value
+
+        form = {"name": "f", "sections": [
+            {"code": "s", "allow_multiple": False, "cdes": [{"code": "a", "value": 1}]},
+            {"code": "m", "allow_multiple": True, "cdes": [[{"code": "a", "value": 1}]]},
+        ]}
+        self.assertTrue(set_form_cde_value(form, "s", "a", 2))
+        self.assertTrue(set_form_cde_value(form, "s", "b", 3))
+        self.assertEqual(form["sections"][0]["cdes"], [{"code": "a", "value": 2}, {"code": "b", "value": 3}])
+        self.assertTrue(set_form_cde_value(form, "t", "a", 4))
+        self.assertEqual(form["sections"][2], {"code": "t", "allow_multiple": False, "cdes": [{"code": "a", "value": 4}]})
+        # multisections are left alone, whether or not they have data
+        self.assertFalse(set_form_cde_value(form, "m", "a", 5))
+        self.assertFalse(set_form_cde_value(form, "n", "a", 5, allow_multiple=True))
+        self.assertEqual(len(form["sections"]), 3)
+        self.assertEqual(form["sections"][1]["cdes"], [[{"code": "a", "value": 1}]])
+
+    def _add_bmi_forms(self):
+        # another form with the bmi section and one with a bmi multisection
+        for position, form_model in enumerate([self.simple_form, self.multi_form]):
+            form_model.position = position
+            form_model.save()
+        bmi_form = self.create_form("bmi", [self.sectionB])
+        multi_section = self.create_section("sectionE", "Multi BMI", ["CDEHeight", "CDEWeight", "CDEBMI"], True)
+        multi_bmi_form = self.create_form("multibmi", [multi_section])
+        for position, form_model in enumerate([bmi_form, multi_bmi_form], 10):
+            form_model.position = position
+            form_model.save()
+
+        def bmi_cdes():
+            return [{"code": "CDEHeight", "value": 1.82}, {"code": "CDEWeight", "value": 86.0}, {"code": "CDEBMI", "value": "38"}]
+
+        record = ClinicalData.objects.collection(self.registry.code, "cdes").find(self.patient, self.context_id).first()
+        record.data["forms"] += [
+            {"name": "bmi", "sections": [{"code": "sectionB", "allow_multiple": False, "cdes": bmi_cdes()}]},
+            {"name": "multibmi", "sections": [{"code": "sectionE", "allow_multiple": True, "cdes": [bmi_cdes()]}]},
+        ]
+        record.save()
+
+    def _snapshots(self):
+        history = ClinicalData.objects.collection(self.registry.code, "history")
+        return list(history.find(self.patient, record_type="snapshot").snapshots())
+
+    def test_update_context_across_forms(self):
+        from rdrf.helpers.recalc_logic import get_calculation_graph
+        from rdrf.management.commands.update_calculated_fields import build_cde_models_tree, update_context
+
+        self._add_bmi_forms()
+        bmi_model = CommonDataElement.objects.get(code="CDEBMI")
+        options = {"form_name": None, "registry_code": [self.registry.code], "section_code": None}
+        cde_models_tree = build_cde_models_tree([bmi_model], options, None)
+        calculations = [("simple", "sectionB", bmi_model), ("bmi", "sectionB", bmi_model),
+                        ("multibmi", "sectionE", bmi_model)]
+        snapshot_count = len(self._snapshots())
+
+        self.assertTrue(update_context(self.patient, self.context_id, self.registry, calculations,
+                                       get_calculation_graph(self.registry), cde_models_tree, [bmi_model]))
+
+        db_record = ClinicalData.objects.collection(self.registry.code, "cdes").find(
+            self.patient, self.context_id).data().first()
+        self.assertEqual(self.form_value("simple", "sectionB", "CDEBMI", db_record), "25.96")
+        self.assertEqual(self.form_value("bmi", "sectionB", "CDEBMI", db_record), "25.96")
+        self.assertIn("bmi_timestamp", db_record)
+        multi_bmi = [form for form in db_record["forms"] if form["name"] == "multibmi"][0]
+        self.assertEqual(len(multi_bmi["sections"]), 1)
+        self.assertEqual(multi_bmi["sections"][0]["cdes"][0][2], {"code": "CDEBMI", "value": "38"})
+        self.assertNotIn("multibmi_timestamp", db_record)
+
+        # one snapshot for the context, named after the last form changed
+        snapshots = self._snapshots()
+        self.assertEqual(len(snapshots), snapshot_count + 1)
+        self.assertEqual(snapshots[-1]["form_name"], "bmi")
+
+        # nothing left to change
+        self.assertFalse(update_context(self.patient, self.context_id, self.registry, calculations,
+                                        get_calculation_graph(self.registry), cde_models_tree, [bmi_model]))
+        self.assertEqual(len(self._snapshots()), snapshot_count + 1)
+
+    def test_update_calculated_fields_workers(self):
+        from io import StringIO
+        from unittest import mock
+        from rdrf.management.commands import update_calculated_fields
+
+        class InlinePool:
+            # runs the tasks in this process, inside the test transaction
+            def __init__(self, processes):
+                self.processes = processes
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def imap_unordered(self, func, tasks):
+                return map(func, tasks)
+
+        self._add_bmi_forms()
+        out = StringIO()
+        with mock.patch.object(update_calculated_fields, "Pool", InlinePool), \
+                mock.patch.object(update_calculated_fields.connections, "close_all"):
+            call_command("update_calculated_fields", registry_code=[self.registry.code],
+                         patient_id=[self.patient.id, self.create_patient().id], workers=2, stdout=out)
+        self.assertIn("1 patients updated", out.getvalue())
+
+        db_record = ClinicalData.objects.collection(self.registry.code, "cdes").find(
+            self.patient, self.context_id).data().first()
+        self.assertEqual(self.form_value("simple", "sectionB", "CDEBMI", db_record), "25.96")
+        self.assertEqual(self.form_value("bmi", "sectionB", "CDEBMI", db_record), "25.96")
 
     def test_update_calculated_fields_command(self):
 
@@ -2714,6 +3755,89 @@ class CalculatedFieldSecurityTestCase(RDRFTestCase):
         # manually tested this in a local build with DD calc fields
 
 
+class CalculatedCdeValuesTestCase(APITestCase):
+    databases = {"default", "clinical"}
+    fixtures = ["testing_auth", "testing_users", "testing_rdrf"]
+
+    # in the fh ClinicalData form, LDLCholesterolAdjTreatment is an input of
+    # CDEfhDutchLipidClinicNetwork and both are inputs of CDE00024
+    CHAIN = ["LDLCholesterolAdjTreatment", "CDEfhDutchLipidClinicNetwork", "CDE00024"]
+
+    def setUp(self):
+        super().setUp()
+        self.registry = Registry.objects.get(code="fh")
+        self.working_group = WorkingGroup.objects.create(name="calculations", registry=self.registry)
+        self.user = CustomUser.objects.get(username="curator")
+        self.user.registry.set([self.registry])
+        self.user.working_groups.add(self.working_group)
+        self.other_user = CustomUser.objects.get(username="clinical")
+        self.other_user.registry.set([self.registry])
+        self.other_user.working_groups.add(WorkingGroup.objects.create(name="other", registry=self.registry))
+
+        self.patient = Patient.objects.create(consent=True, given_names="Harry", family_name="Thomas",
+                                              date_of_birth=datetime(1978, 6, 15), sex="1")
+        self.patient.rdrf_registry.set([self.registry])
+        self.patient.working_groups.add(self.working_group)
+        for cde_model in CommonDataElement.objects.filter(code__in=self.CHAIN):
+            cde_model.datatype = "calculated"
+            cde_model.save()
+
+    def post(self, user, **values):
+        data = {
+            "registry_code": self.registry.code,
+            "patient_id": self.patient.pk,
+            "form_name": "ClinicalData",
+            "form_values": {"CDE00019": "4"},
+            "patient_sex": 1,
+            "patient_date_of_birth": "1978-06-15",
+        }
+        data.update(values)
+        self.client.force_authenticate(user=user)
+        return self.client.post(reverse("v1:calculatedcdebatch-list"), data, format="json")
+
+    def test_outputs_see_the_outputs_they_use(self):
+        from unittest import mock
+
+        def chained(code, suffix):
+            return lambda patient, form_values: form_values[code] + suffix
+
+        with mock.patch.object(calculated_functions, "CDEBMI", lambda patient, form_values: "bmi"), \
+                mock.patch.object(calculated_functions, "LDLCholesterolAdjTreatment",
+                                  lambda patient, form_values: form_values["CDE00019"] + "a"), \
+                mock.patch.object(calculated_functions, "CDEfhDutchLipidClinicNetwork",
+                                  chained("LDLCholesterolAdjTreatment", "b")), \
+                mock.patch.object(calculated_functions, "CDE00024", chained("CDEfhDutchLipidClinicNetwork", "c")):
+            response = self.post(self.user)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            "CDEBMI": "bmi",
+            "LDLCholesterolAdjTreatment": "4a",
+            "CDEfhDutchLipidClinicNetwork": "4ab",
+            "CDE00024": "4abc",
+        })
+
+    def test_other_working_group_rejected(self):
+        response = self.post(self.other_user)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"], "Patient is not assigned to this centre")
+
+    def test_unknown_registry_rejected(self):
+        response = self.post(self.user, registry_code="missing")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"], "Registry missing does not exist")
+
+    def test_unknown_form_rejected(self):
+        response = self.post(self.user, form_name="Missing")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"], "Form Missing does not exist in this registry")
+
+    def test_unknown_patient_rejected(self):
+        response = self.post(self.user, patient_id=0)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["detail"], "Patient 0 does not exist")
+
+
 class HL7HandlerTestCase(RDRFTestCase):
     def _get_yaml_file(self, suffix="original"):
         this_dir = os.path.dirname(__file__)
@@ -2999,6 +4123,35 @@ class FamilyLinkageTestCase(RDRFTestCase):
         )
         return family_linkage_value == "fh_is_relative"
 
+    def test_index_lookup(self):
+        from unittest import mock
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from rdrf.services.rest.views import api_views
+
+        def lookup(term):
+            request = APIRequestFactory().get("/", {"term": term})
+            force_authenticate(request, user=CustomUser.objects.get(username="admin"))
+            return api_views.LookupIndex.as_view()(request, self.registry.code)
+
+        patient_1, patient_2 = Patient.objects.get(pk=self.patient_ids[0]), Patient.objects.get(pk=self.patient_ids[1])
+        with mock.patch.object(api_views, "LOOKUP_INDEX_LIMIT", 1):
+            response = lookup("test")
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response["X-Result-Limit"], "1")
+        self.assertEqual(response["X-Result-Truncated"], "true")
+
+        # a relative of another patient isn't an index
+        relative = self.create_new_patient_relative("Chester", "Test", datetime(1979, 4, 13), "Male", "Living",
+                                                    "AU - WA", patient_1)
+        relative.relative_patient = patient_2
+        relative.save()
+        self.assertEqual([patient.pk for patient in Patient.objects.filter(pk__in=self.patient_ids) if patient.is_index],
+                         [patient_1.pk])
+        self.assertEqual(list(Patient.objects.filter(pk__in=self.patient_ids).index_patients()), [patient_1])
+        response = lookup("test")
+        self.assertEqual([item["pk"] for item in response.data], [patient_1.pk])
+        self.assertEqual(response["X-Result-Truncated"], "false")
+
     def test_family_linkage_manager(self):
         from registry.patients.models import PatientRelative
 
@@ -14,7 +14,7 @@ from rdrf.models.definition.models import RegistryForm, Registry, QuestionnaireR
 from rdrf.models.definition.models import Section, CommonDataElement, ClinicalData
 from registry.patients.models import Patient, ParentGuardian
 from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section
-from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.dynamic_data import DynamicDataWrapper, build_form_data
 from django.http import Http404
 from rdrf.forms.file_upload import wrap_fs_data_for_form
 from rdrf.forms.file_upload import wrap_file_cdes
@@ -30,6 +30,7 @@ from rdrf.views.decorators.patient_decorators import patient_questionnaire_acces
 from rdrf.forms.navigation.wizard import NavigationWizard, NavigationFormType
 from rdrf.models.definition.models import RDRFContext
 from rdrf.custom_signals import clinical_data_saved_ok
+from rdrf.helpers import form_save_queue
 
 from rdrf.forms.consent_forms import CustomConsentFormGenerator
 from rdrf.helpers.utils import consent_status_for_patient
@@ -37,7 +38,6 @@ from rdrf.helpers.utils import anonymous_not_allowed
 
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.db.contexts_api import RDRFContextError
-from explorer.utils import create_field_values
 
 
 from django.shortcuts import redirect
@@ -54,6 +54,7 @@ from rdrf.services.rpc.actions import ActionExecutor
 from rdrf.helpers.utils import FormLink
 from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_consent_section
 from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.helpers.compiled_registry import get_compiled_registry
 
 from rdrf.forms.navigation.locators import PatientLocator
 from rdrf.forms.components import RDRFContextLauncherComponent
@@ -156,6 +157,7 @@ class SectionInfo(object):
         self.is_multiple = is_multiple
         self.registry_code = registry_code
         self.registry = Registry.objects.get(code=registry_code)
+        self.compiled_registry = None
         self.use_new_style_calcs = self.registry.has_feature("use_new_style_calcs")
         self.collection_name = collection_name
         self.data = data
@@ -174,13 +176,21 @@ class SectionInfo(object):
             except ValueError:
                 continue
 
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = self._get_cde_model(cde_code)
             if cde_model.datatype == "calculated":
                 patient = self._get_patient_dict()
                 calculation_context = self._get_calculation_context(cde_model)
                 new_value = cde_model.calculate(patient, calculation_context)
                 self.data[key] = new_value
 
+    def _get_cde_model(self, cde_code):
+        if self.compiled_registry is None:
+            self.compiled_registry = get_compiled_registry(self.registry)
+        cde_model = self.compiled_registry.cdes.get(cde_code)
+        if cde_model is None:
+            cde_model = CommonDataElement.objects.get(code=cde_code)
+        return cde_model
+
     def _get_patient_dict(self):
         patient: Patient = self.patient_wrapper.obj
         # this mirrors what old API call creates
@@ -217,28 +227,27 @@ class SectionInfo(object):
 
         # non-local field value
 
-    def save(self):
+    def get_save_data(self):
+        # the form data and save_dynamic_data options for this section
         if not self.is_multiple:
             if self.use_new_style_calcs:
                 self.update_calculated_fields()
-            self.patient_wrapper.save_dynamic_data(
-                self.registry_code, self.collection_name, self.data
-            )
-        else:
-            self.patient_wrapper.save_dynamic_data(
-                self.registry_code,
-                self.collection_name,
-                self.data,
-                multisection=True,
-                index_map=self.index_map,
-            )
+            return self.data, {}
+        return self.data, {"multisection": True, "index_map": self.index_map}
+
+    def save(self):
+        data, options = self.get_save_data()
+        self.patient_wrapper.save_dynamic_data(
+            self.registry_code, self.collection_name, data, **options
+        )
 
-    def recreate_form_instance(self):
+    def recreate_form_instance(self, current_data=None):
         # called when all sections on a form are valid
         # We do this to create a form instance which has correct links to uploaded files
-        current_data = self.patient_wrapper.load_dynamic_data(
-            self.registry_code, "cdes"
-        )
+        if current_data is None:
+            current_data = self.patient_wrapper.load_dynamic_data(
+                self.registry_code, "cdes"
+            )
         if self.is_multiple:
             # the cleaned data from the form submission
             dynamic_data = self.data[self.section_code]
@@ -658,7 +667,7 @@ class FormView(View):
         section_field_ids_map = {}
 
         for section_index, s in enumerate(sections):
-            section_model = Section.objects.get(code=s)
+            section_model = self._get_section_model(s)
             form_class = create_form_class_for_section(
                 registry,
                 form_obj,
@@ -710,39 +719,55 @@ class FormView(View):
             # to any upload files won't work
             # If any are invalid, nothing needs to be done as the forms have already been created from the form
             # submission data
+            # all the sections are merged into the record and written once
+            record = dyn_patient.save_form_data(
+                registry_code,
+                [section_info.get_save_data() for section_info in sections_to_save],
+            )
+            current_data = build_form_data(record.data)
             for section_info in sections_to_save:
-                section_info.save()
-                form_instance = section_info.recreate_form_instance()
+                form_instance = section_info.recreate_form_instance(current_data)
                 form_section[section_info.section_code] = form_instance
 
-            clinical_data_saved_ok.send(
-                sender=ClinicalData, patient=patient, saved_sections=sections_to_save
-            )
-
-            progress_dict = dyn_patient.save_form_progress(
-                registry_code, context_model=self.rdrf_context
-            )
-            # Save one snapshot after all sections have being persisted
-            dyn_patient.save_snapshot(
+            deferred = form_save_queue.deferred_enabled() and form_save_queue.schedule(
                 registry_code,
-                "cdes",
-                form_name=form_obj.name,
-                form_user=self.request.user.username,
+                patient.pk,
+                dyn_patient.rdrf_context_id,
+                form_obj.pk,
+                [section_info.section_code for section_info in sections_to_save],
+                user_id=self.request.user.pk,
             )
+            if deferred:
+                # recalculations, the snapshot and the stored progress are
+                # brought up to date by a task; the progress shown is worked
+                # out from the saved record
+                progress_dict = FormProgress(registry).calculate_progress(
+                    patient, record.data, context_model=self.rdrf_context, form_names=[form_obj.name]
+                )
+            else:
+                clinical_data_saved_ok.send(
+                    sender=ClinicalData, patient=patient, saved_sections=sections_to_save
+                )
+                # the receivers ( e.g. the recalculation ) may have saved the record again
+                record.refresh_from_db(fields=["data"])
 
-            # save report friendly field values
-            try:
-                if self.rdrf_context:
-                    create_field_values(
-                        registry,
-                        patient,
-                        self.rdrf_context,
-                        remove_existing=True,
-                        form_model=form_obj,
-                    )
-            except Exception as ex:
-                logger.warning("error creating field values: %s" % ex)
-                raise
+                progress_dict = dyn_patient.save_form_progress(
+                    registry_code,
+                    context_model=self.rdrf_context,
+                    dynamic_data=record.data,
+                    form_names=[form_obj.name],
+                )
+                # Save one snapshot of the record just saved
+                dyn_patient.save_snapshot(
+                    registry_code,
+                    "cdes",
+                    form_name=form_obj.name,
+                    form_user=self.request.user.username,
+                    record=record,
+                )
+
+            # report friendly field values are kept up to date from the
+            # clinical_data_changed signal sent by the save
 
             if self.CREATE_MODE and dyn_patient.rdrf_context_id != "add":
                 # we've created the context on the fly so no redirect to the edit view on
@@ -750,22 +775,9 @@ class FormView(View):
                 newly_created_context = RDRFContext.objects.get(
                     id=dyn_patient.rdrf_context_id
                 )
-                dyn_patient.save_form_progress(
-                    registry_code, context_model=newly_created_context
-                )
-
-                try:
-                    create_field_values(
-                        registry,
-                        patient,
-                        newly_created_context,
-                        remove_existing=True,
-                        form_model=form_obj,
-                    )
-                # TODO: the following line is smelly - it is eating all exceptions.
-                except Exception as ex:
-                    logger.warning(
-                        "Error creating field values for new context: %s" % ex
+                if not deferred:
+                    dyn_patient.save_form_progress(
+                        registry_code, context_model=newly_created_context, dynamic_data=record.data
                     )
 
                 return HttpResponseRedirect(
@@ -1053,6 +1065,19 @@ class FormView(View):
             )
         return all_sections_valid, error_count
 
+    @property
+    def compiled_registry(self):
+        # one compiled definition per request
+        if getattr(self, "_compiled_registry", None) is None:
+            self._compiled_registry = get_compiled_registry(self.registry)
+        return self._compiled_registry
+
+    def _get_section_model(self, section_code):
+        compiled_section = self.compiled_registry.sections.get(section_code)
+        if compiled_section is not None:
+            return compiled_section.section_model
+        return Section.objects.get(code=section_code)
+
     def _get_sections(self, form):
         section_parts = form.get_sections()
         sections = []
@@ -1060,7 +1085,7 @@ class FormView(View):
         ids = {}
         for s in section_parts:
             try:
-                sec = Section.objects.get(code=s.strip())
+                sec = self._get_section_model(s.strip())
                 display_names[s] = sec.display_name
                 ids[s] = sec.id
                 sections.append(s)
@@ -1130,7 +1155,7 @@ class FormView(View):
                 self.dynamic_data["questionnaire_context"] = "au"
 
         for s in sections:
-            section_model = Section.objects.get(code=s)
+            section_model = self._get_section_model(s)
             form_class = self._get_form_class_for_section(
                 self.registry, self.registry_form, section_model, rdrf_nonce
             )
@@ -1,4 +1,5 @@
 from itertools import chain
+from operator import attrgetter
 import json
 from django.views.generic.base import View
 from django.template.context_processors import csrf
@@ -8,15 +9,17 @@ from django.shortcuts import redirect, get_object_or_404
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
-from django.db.models import Q
+from django.db.models import CharField, Case, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce
 from django.core.paginator import Paginator, InvalidPage
 from rdrf.models.definition.models import Registry
 from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.models.progress_models import ProgressSummary
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.forms.components import FormGroupButton
-from registry.patients.models import Patient
+from registry.patients.models import Patient, search_q
 from rdrf.helpers.utils import MinType
-from rdrf.helpers.utils import consent_check
+from rdrf.helpers.utils import consent_checked_patients
 from rdrf.helpers.utils import has_external_demographics
 from django.utils.translation import ugettext as _
 
@@ -266,21 +269,24 @@ class PatientsListingView(View):
         return rows
 
     def append_rows(self, page_object, row_list_to_update):
+        # what the cells need is loaded for the whole page up front, so the
+        # number of queries doesn't grow with the page length
+        patients = list(page_object.object_list)
         if self.registry_model.has_feature("consent_checks"):
-            row_list_to_update.extend([self._get_row_dict(obj) for obj in page_object.object_list
-                                       if consent_check(self.registry_model,
-                                                        self.user,
-                                                        obj,
-                                                        "see_patient")])
+            allowed_ids = consent_checked_patients(self.registry_model, self.user, patients, "see_patient")
+            patients = [obj for obj in patients if obj.pk in allowed_ids]
+
+        if self.supports_contexts:
+            # progress columns are blank
+            self.progress_records = {}
         else:
-            row_list_to_update.extend([self._get_row_dict(obj)
-                                       for obj in page_object.object_list])
+            self.progress_records = self.form_progress.load_for_patients([obj.pk for obj in patients])
+
+        row_list_to_update.extend([self._get_row_dict(obj) for obj in patients])
 
     def _get_row_dict(self, instance):
-        # we need to do this so that the progress data for this instance
-        # loaded!
-        self.form_progress.reset()
-        self.form_progress._set_current(instance)
+        # the progress cells read the page's preloaded progress for this instance
+        self.form_progress.use_loaded(instance, self.progress_records.get(instance.pk))
         return {
             col.field: col.fmt(
                 col.cell(
@@ -297,12 +303,7 @@ class PatientsListingView(View):
 
     def apply_search_filter(self):
         if self.search_term:
-            q1 = Q(given_names__icontains=self.search_term)
-            q2 = Q(family_name__icontains=self.search_term)
-            q3 = Q(deident__icontains=self.search_term)
-            q4 = Q(umrn=self.search_term)
-            qry = q1 | q2 | q3 | q4
-            self.patients = self.patients.filter(qry)
+            self.patients = self.patients.filter(search_q(self.search_term) | Q(umrn=self.search_term))
 
     def filter_by_user_group(self):
         if not self.user.is_superuser:
@@ -338,9 +339,11 @@ class PatientsListingView(View):
             def sdir(field):
                 return "-" + field if self.sort_direction == "desc" else field
 
-            sort_fields = chain(*[map(sdir, col.sort_fields)
-                                  for col in self.columns
-                                  if col.field == self.sort_field])
+            sort_columns = [col for col in self.columns if col.field == self.sort_field]
+            for col in sort_columns:
+                self.patients = col.annotate_sort(self.patients)
+
+            sort_fields = chain(*[map(sdir, col.sort_fields) for col in sort_columns])
 
             self.patients = self.patients.order_by(*sort_fields)
 
@@ -371,6 +374,10 @@ class Column(object):
     def get_sort_value_for_none(self):
         return self.bottom
 
+    def annotate_sort(self, patients):
+        # columns not backed by a patient field annotate what they sort on
+        return patients
+
     def sort_key(self, supports_contexts=False,
                  form_progress=None, context_manager=None):
 
@@ -389,7 +396,8 @@ class Column(object):
             patient_field, related_object_field = self.field.split("__")
             related_object = getattr(patient, patient_field)
             if related_object.__class__.__name__ == 'ManyRelatedManager':
-                related_object = related_object.first()
+                # all() uses the prefetched objects where first() would query
+                related_object = min(related_object.all(), key=attrgetter("pk"), default=None)
 
             if related_object is not None:
                 related_value = getattr(related_object, related_object_field)
@@ -442,11 +450,34 @@ class ColumnDateOfBirth(Column):
 
 class ColumnCodeField(Column):
     field = 'code_field'
-    sort_fields = []
+    sort_fields = ["code_field_sort", "patient_type"]
+
+    def annotate_sort(self, patients):
+        # the displayed sex label, so the order matches what is shown
+        labels = {"1": _("Male"), "2": _("Female"), "3": _("Indeterminate")}
+        whens = [When(sex=sex, then=Value(label)) for sex, label in labels.items()]
+        return patients.annotate(code_field_sort=Case(*whens, output_field=CharField()))
 
 
 class ColumnNonContexts(Column):
-    sort_fields = []
+    # the ProgressSummary metric the column shows, if it has one; otherwise
+    # the column is sorted by sort_key
+    progress_group = None
+    progress_field = None
+
+    @property
+    def sort_fields(self):
+        return [self.field + "_sort"] if self.progress_field else []
+
+    def annotate_sort(self, patients):
+        if not self.progress_field:
+            return patients
+        summaries = ProgressSummary.objects.filter(patient=OuterRef("pk"),
+                                                   registry=self.registry,
+                                                   group=self.progress_group)
+        value = Cast(Subquery(summaries.values(self.progress_field)[:1]), IntegerField())
+        # missing values sort lowest, as None did when sorted in python
+        return patients.annotate(**{self.field + "_sort": Coalesce(value, Value(-1))})
 
     def cell(self, patient, supports_contexts=False, form_progress=None, context_manager=None):
         if supports_contexts:
@@ -495,6 +526,8 @@ class ColumnWorkingGroups(Column):
 
 class ColumnDiagnosisProgress(ColumnNonContexts):
     field = "diagnosis_progress"
+    progress_group = "diagnosis"
+    progress_field = "progress"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_progress("diagnosis", patient)
@@ -508,6 +541,9 @@ class ColumnDiagnosisProgress(ColumnNonContexts):
 
 class ColumnDiagnosisCurrency(ColumnNonContexts):
     field = "diagnosis_currency"
+    # the currency shown is the one stored with the progress, as is its copy
+    progress_group = "diagnosis"
+    progress_field = "current"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_currency("diagnosis", patient)
@@ -518,6 +554,8 @@ class ColumnDiagnosisCurrency(ColumnNonContexts):
 
 class ColumnGeneticDataMap(ColumnNonContexts):
     field = "genetic_data_map"
+    progress_group = "genetic"
+    progress_field = "has_data"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_has_data("genetic", patient)
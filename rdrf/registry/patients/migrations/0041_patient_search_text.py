@@ -0,0 +1,43 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+def search_key(*values):
+    # as registry.patients.models.search_key when this migration was written
+    def stripspaces(value):
+        return " ".join(value.split()) if isinstance(value, str) else ""
+    return " ".join(stripspaces(value) for value in values if value).lower()
+
+
+def fill_search_text(apps, schema_editor):
+    Patient = apps.get_model('patients', 'Patient')
+    batch = []
+    for patient in Patient.objects.only('family_name', 'given_names', 'deident').iterator(chunk_size=2000):
+        patient.search_text = search_key(patient.family_name, patient.given_names, patient.deident)
+        batch.append(patient)
+        if len(batch) >= 2000:
+            Patient.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    Patient.objects.bulk_update(batch, ['search_text'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0040_auto_20211108_1429'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='patient',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='patient',
+            index=GinIndex(fields=['search_text'], name='patients_search_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
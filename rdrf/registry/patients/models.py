@@ -6,7 +6,10 @@ from django.core.exceptions import ValidationError
 from django.core import serializers
 from django.core.files.storage import DefaultStorage
 from django.urls import reverse
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import models, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
 from django.db.models.signals import post_save, m2m_changed, post_delete
 from django.dispatch import receiver
 from django.conf import settings
@@ -117,7 +120,91 @@ class NextOfKinRelationship(models.Model):
         return self.relationship
 
 
-class PatientManager(models.Manager):
+# the patient fields search_text is made of
+SEARCH_FIELDS = ("family_name", "given_names", "deident")
+
+
+def search_key(*values):
+    # the normalised text searched by PatientQuerySet.search / lookup
+    return " ".join(stripspaces(value) for value in values if value).lower()
+
+
+def patient_search_key(patient):
+    return search_key(*(getattr(patient, field) for field in SEARCH_FIELDS))
+
+
+def search_q(term):
+    """
+    Matches patients whose names or deidentified id contain term.
+    Uses the trigram index on search_text rather than scanning the table.
+    """
+    return Q(search_text__contains=search_key(term))
+
+
+class PatientQuerySet(models.QuerySet):
+    def search(self, term):
+        return self.filter(search_q(term))
+
+    def lookup(self, term):
+        """
+        Type-ahead matches for term, containing it or similar to it ( misspelt ),
+        ranked with name prefix matches first then by similarity.
+        """
+        term = search_key(term)
+        is_prefix = Q(family_name__istartswith=term) | Q(given_names__istartswith=term)
+        return (
+            self.filter(Q(search_text__contains=term) | Q(search_text__trigram_similar=term))
+            .annotate(
+                search_prefix=Case(When(is_prefix, then=Value(1)), default=Value(0), output_field=IntegerField()),
+                search_similarity=TrigramSimilarity("search_text", term),
+            )
+            .order_by("-search_prefix", "-search_similarity", "family_name", "given_names")
+        )
+
+    def update(self, **kwargs):
+        """
+        Bulk updates bypass Patient.save, so search_text is recomputed here
+        for the updated patients when their names or deident change
+        """
+        if set(SEARCH_FIELDS).isdisjoint(kwargs) or "search_text" in kwargs:
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list("pk", flat=True))
+            rows = super().update(**kwargs)
+            patients = self.model._base_manager.using(self.db).filter(pk__in=pks).only("pk", *SEARCH_FIELDS)
+            for patient in patients:
+                patient.search_text = patient_search_key(patient)
+            self.model._base_manager.using(self.db).bulk_update(patients, ["search_text"], batch_size=2000)
+        return rows
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for patient in objs:
+            patient.search_text = patient_search_key(patient)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if not set(SEARCH_FIELDS).isdisjoint(fields):
+            objs = list(objs)
+            for patient in objs:
+                patient.search_text = patient_search_key(patient)
+            fields = list(fields) + ["search_text"]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def index_patients(self):
+        # the patients for which Patient.is_index holds: active, in a
+        # registry with family linkage and without my_index, the index of
+        # a relative record of theirs ( inactive patients are excluded for
+        # every user, superusers too )
+        registry_ids = [r.pk for r in Registry.objects.all() if r.has_feature("family_linkage")]
+        return (self.filter(active=True, rdrf_registry__in=registry_ids)
+                .exclude(as_a_relative__patient__isnull=False)
+                .distinct())
+
+
+class PatientManager(models.Manager.from_queryset(PatientQuerySet)):
     def get_by_registry(self, *registries):
         return self.model.objects.filter(rdrf_registry__in=registries)
 
@@ -371,9 +458,16 @@ class Patient(models.Model):
         max_length=80, blank=True, null=True, verbose_name=_("Patient Type")
     )
 
+    # maintained on save ( and by the PatientQuerySet bulk operations ) for
+    # patient search, see search_key. Raw SQL writes leave it stale.
+    search_text = models.TextField(blank=True, default="", editable=False)
+
     class Meta:
         ordering = ["family_name", "given_names", "date_of_birth"]
         verbose_name_plural = _("Patient List")
+        indexes = [
+            GinIndex(fields=["search_text"], name="patients_search_trgm_idx", opclasses=["gin_trgm_ops"]),
+        ]
 
         permissions = (
             ("can_see_full_name", _("Can see Full Name column")),
@@ -747,7 +841,7 @@ class Patient(models.Model):
         # update form progress
         registry_model = Registry.objects.get(code=registry_code)
         form_progress_calculator = FormProgress(registry_model)
-        form_progress_calculator.save_for_patient(self, context_model)
+        form_progress_calculator.save_for_patient(self, context_model, form_names=[form_name])
 
         if save_snapshot and user is not None:
             wrapper.save_snapshot(
@@ -892,6 +986,7 @@ class Patient(models.Model):
 
     @property
     def is_index(self):
+        # PatientQuerySet.index_patients is the query for this
         if not self.active:
             return False
 
@@ -937,6 +1032,11 @@ class Patient(models.Model):
             if supports_deidentification_workflow():
                 self.deident = generate_deidentified_id()
 
+        self.search_text = patient_search_key(self)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not set(SEARCH_FIELDS).isdisjoint(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"search_text"}
+
         super(Patient, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):